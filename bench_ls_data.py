@@ -0,0 +1,176 @@
+import io
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import tempfile
+import contextlib
+import yaml
+import gen_ls_data
+import load_ls_data
+from fake_netbox import FakeNetBox
+
+SIZES = '1x2,2x8,4x32'
+LATENCY = 0.002
+METHODS = ('GET', 'POST', 'PATCH', 'PUT', 'DELETE')
+
+@contextlib.contextmanager
+def fake_netbox(fake, http):
+    # Point load_ls_data at the fake: over a local HTTP server, or mounted as
+    # the transport adapter of the session the loader builds so no sockets
+    # are involved at all.
+    if http:
+        server, url = fake.serve()
+        load_ls_data.NB_URL = url
+        try:
+            yield
+        finally:
+            server.shutdown()
+            server.server_close()
+    else:
+        build_session = load_ls_data.build_session
+
+        def mounted_session(*args, **kwargs):
+            session = build_session(*args, **kwargs)
+            session.mount('http://fake-netbox', fake)
+            return session
+
+        load_ls_data.NB_URL = 'http://fake-netbox'
+        load_ls_data.build_session = mounted_session
+        try:
+            yield
+        finally:
+            load_ls_data.build_session = build_session
+
+def run_loader(fake, lsdata_file, loader_args):
+    load_ls_data.PLAN = None
+    load_ls_data.METRICS = load_ls_data.Metrics()
+    fake.stats.clear()
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        load_ls_data.main(loader_args + [lsdata_file])
+    wall_time = time.monotonic() - start
+    return {method: fake.stats[method] for method in METHODS if fake.stats[method]}, wall_time
+
+def bench(spines, leafs, args):
+    gen_args = gen_ls_data.parse_args(['--spines', str(spines), '--leafs', str(leafs)] +
+                                      shlex.split(args.gen_args))
+    ls_data = gen_ls_data.gen_ls_data(gen_args)
+    devices = spines + leafs
+    links = spines * leafs
+    result = {'size': f"{spines}x{leafs}", 'devices': devices, 'links': links, 'runs': dict()}
+    fake = FakeNetBox(latency=args.latency, error_rate=args.error_rate)
+    runs = ['load', 'rerun'] if args.rerun else ['load']
+    # The loader journals next to the data file, so both go in a scratch dir.
+    with tempfile.TemporaryDirectory() as tmpdir, fake_netbox(fake, args.http):
+        lsdata_file = os.path.join(tmpdir, 'ls_data.yaml')
+        with open(lsdata_file, 'w') as f:
+            yaml.safe_dump(ls_data, f, sort_keys=False)
+        for run in runs:
+            objects = sum(len(rows) for table, rows in fake.tables.items()
+                          if table != 'extras/object-changes')
+            by_method, wall_time = run_loader(fake, lsdata_file, shlex.split(args.loader_args))
+            requests = sum(by_method.values())
+            created = sum(len(rows) for table, rows in fake.tables.items()
+                          if table != 'extras/object-changes') - objects
+            result['runs'][run] = {'requests': requests,
+                                   'by_method': by_method,
+                                   'wall_time': round(wall_time, 3),
+                                   'objects_created': created,
+                                   'requests_per_s': round(requests / wall_time, 1),
+                                   'objects_per_s': round(created / wall_time, 1),
+                                   'requests_per_device': round(requests / devices, 2),
+                                   'requests_per_link': round(requests / links, 2)}
+
+    return result
+
+def print_results(results):
+    print(f"{'size':<10} {'run':<6} {'requests':>9} {'GET':>7} {'POST':>7} {'PATCH':>7} "
+          f"{'objects':>8} {'wall(s)':>8} {'req/s':>8} {'obj/s':>8} {'req/dev':>8} {'req/link':>8}")
+    for result in results:
+        for run, stats in result['runs'].items():
+            by_method = stats['by_method']
+            print(f"{result['size']:<10} {run:<6} {stats['requests']:>9} "
+                  f"{by_method.get('GET', 0):>7} {by_method.get('POST', 0):>7} "
+                  f"{by_method.get('PATCH', 0):>7} {stats['objects_created']:>8} "
+                  f"{stats['wall_time']:>8.2f} {stats['requests_per_s']:>8.1f} "
+                  f"{stats['objects_per_s']:>8.1f} {stats['requests_per_device']:>8.2f} "
+                  f"{stats['requests_per_link']:>8.2f}")
+
+def compare_results(results, baseline_file, tolerance):
+    # Request counts don't depend on timing, so any growth is a regression in
+    # how the loader talks to NetBox.
+    with open(baseline_file) as f:
+        baseline = {result['size']: result for result in json.load(f)['results']}
+
+    regressions = 0
+    for result in results:
+        old = baseline.get(result['size'])
+        if old is None:
+            continue
+        for run, stats in result['runs'].items():
+            if run not in old['runs']:
+                continue
+            before = old['runs'][run]['requests']
+            after = stats['requests']
+            change = (after - before) / before * 100 if before else 0
+            status = 'ok'
+            if after > before * (1 + tolerance / 100):
+                status = 'REGRESSION'
+                regressions += 1
+            print(f"{result['size']:<10} {run:<6} requests {before:>7} -> {after:<7} "
+                  f"({change:+.1f}%) {status}")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark load_ls_data.py against an in-process fake NetBox')
+    parser.add_argument('--sizes', default=SIZES,
+                        help=f"Comma separated SPINESxLEAFS fabric sizes (default: {SIZES})")
+    parser.add_argument('--latency', type=float, default=LATENCY,
+                        help=f"Simulated server time per request in seconds (default: {LATENCY})")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of requests answered with a 502 (use with --http, "
+                             "the loader's retries live in its HTTP adapter)")
+    parser.add_argument('--http', action='store_true',
+                        help="Serve the fake over local HTTP instead of mounting it in the "
+                             "session (needed for --backend async)")
+    parser.add_argument('--rerun', action='store_true',
+                        help="Run the loader a second time against the loaded fake")
+    parser.add_argument('--gen-args', default='',
+                        help="Extra gen_ls_data.py options, "
+                             "e.g. --gen-args=\"--vlans 50 --vrfs 4\"")
+    parser.add_argument('--loader-args', default='',
+                        help="Extra load_ls_data.py options, "
+                             "e.g. --loader-args=\"--plan --workers 8\"")
+    parser.add_argument('--save', metavar='FILE', help="Write the results as JSON")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Compare request counts with results saved by --save and exit "
+                             "non-zero if any grew")
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help="Allowed request count growth in percent for --compare")
+    args = parser.parse_args()
+    if not args.http and any(arg.split('=')[0] == '--processes'
+                             for arg in shlex.split(args.loader_args)):
+        parser.error("--processes in --loader-args needs --http: shard processes can't reach "
+                     "a fake mounted in this process")
+
+    results = list()
+    for size in args.sizes.split(','):
+        spines, leafs = [int(n) for n in size.lower().split('x')]
+        print(f"Benchmarking {spines} spine(s) x {leafs} leaf(s)...", file=sys.stderr)
+        results.append(bench(spines, leafs, args))
+
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2)
+
+    if args.compare and compare_results(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
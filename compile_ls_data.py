@@ -0,0 +1,194 @@
+import os
+import csv
+import argparse
+import ipaddress
+import yaml
+import load_ls_data
+from load_ls_data import log, device_names, spine_leaf_links
+
+# The import forms require a color where the API defaults it to grey.
+DEFAULT_COLOR = '9e9e9e'
+
+def interface_prefixes(ls_data):
+    prefixes = {dt['model']: dt['interface_prefix'] for dt in ls_data['device_types']}
+    return {name: prefixes[device['device_type']['model']]
+            for device in ls_data['devices'].values() for name in device_names(device)}
+
+def compile_ls_data(ls_data):
+    # The expanded fabric as (file name, rows) in the order the files have
+    # to be imported, with columns named as NetBox's bulk import forms name
+    # them.  Everything is referred to by name; subnets are handed out the
+    # way the loader does in an empty container.
+    files = list()
+    files.append(('sites', [{'name': site['name'], 'slug': site['slug']}
+                            for site in ls_data['sites']]))
+    files.append(('device_roles', [{'name': role['name'], 'slug': role['slug'],
+                                    'color': role.get('color', DEFAULT_COLOR)}
+                                   for role in ls_data['roles']]))
+    files.append(('manufacturers', [{'name': m['name'], 'slug': m['slug']}
+                                    for m in ls_data['manufacturers']]))
+    # Device types are imported as YAML documents with their interface
+    # templates, the only format the device type import takes components in.
+    files.append(('device_types', [{'manufacturer': dt['manufacturer']['name'],
+                                    'model': dt['model'], 'slug': dt['slug'],
+                                    'interfaces': [{'name': f"{dt['interface_prefix']}{i}",
+                                                    'type': '1000base-t'}
+                                                   for i in range(1, dt['interface_qty'] + 1)]}
+                                   for dt in ls_data['device_types']]))
+    files.append(('tags', [{'name': tag['name'], 'slug': tag['slug'],
+                            'color': tag.get('color', DEFAULT_COLOR),
+                            'description': tag.get('description', '')}
+                           for tag in ls_data['tags']]))
+    files.append(('custom_fields', [
+        {'name': 'l3vni', 'type': 'integer', 'content_types': 'ipam.vrf'},
+        {'name': 'vnivrf', 'type': 'boolean', 'content_types': 'ipam.l2vpn'},
+        {'name': 'staticroute', 'type': 'boolean', 'content_types': 'ipam.prefix'},
+        {'name': 'nexthop', 'type': 'text', 'content_types': 'ipam.prefix'},
+        {'name': 'bgp_originate', 'type': 'boolean', 'content_types': 'ipam.prefix'},
+        {'name': 'origindevice', 'type': 'object', 'content_types': 'ipam.prefix',
+         'object_type': 'dcim.device'},
+    ]))
+    files.append(('rirs', [{'name': ls_data['rir']['name'], 'slug': ls_data['rir']['slug'],
+                            'is_private': ls_data['rir'].get('is_private', False)}]))
+
+    spines = device_names(ls_data['devices']['spines'])
+    leafs = device_names(ls_data['devices']['leafs'])
+    leaf_asn = ls_data['asns']['leaf']['range_start']
+    if ls_data['asns']['leaf'].get('sameasn'):
+        asns = [(leaf_asn, 'Leaf ASN')]
+    else:
+        asns = [(leaf_asn + i, f'Leaf {leaf} ASN') for i, leaf in enumerate(leafs)]
+    asns.insert(0, (ls_data['asns']['spine']['asn'], 'Spine ASN'))
+    asns = list(dict(reversed(asns)).items())[::-1]
+    files.append(('asns', [{'asn': asn, 'rir': ls_data['rir']['name'], 'description': description}
+                           for asn, description in asns]))
+
+    files.append(('vrfs', [{'name': vrf['name'], 'enforce_unique': False,
+                            'cf_l3vni': vrf.get('vni', '')} for vrf in ls_data['vrfs']]))
+    files.append(('vlans', [{'name': vlan['name'], 'vid': vlan['vid'], 'status': 'active'}
+                            for vlan in ls_data['vlans']]))
+    vni_vlans = [vlan for vlan in ls_data['vlans'] if vlan.get('vni')]
+    files.append(('l2vpns', [{'name': vlan['name'], 'slug': vlan['name'], 'type': 'vxlan-evpn',
+                              'identifier': vlan['vni'],
+                              'cf_vnivrf': bool(vlan.get('svi', {}).get('vrf-svi'))}
+                             for vlan in vni_vlans]))
+    files.append(('l2vpn_terminations', [{'l2vpn': vlan['name'], 'vlan': vlan['name']}
+                                         for vlan in vni_vlans]))
+
+    devices = list()
+    for device in ls_data['devices'].values():
+        devicetype = [dt for dt in ls_data['device_types']
+                      if dt['model'] == device['device_type']['model']][0]
+        devices.extend({'name': name, 'device_role': device['device_role']['name'],
+                        'manufacturer': devicetype['manufacturer']['name'],
+                        'device_type': devicetype['model'], 'site': device['site']['name'],
+                        'status': 'active'} for name in device_names(device))
+    files.append(('devices', devices))
+
+    # The Ethernet interfaces come with the devices, from the device type.
+    interfaces = [{'device': device['name'], 'name': 'Loopback0', 'type': 'virtual'}
+                  for device in devices]
+    svi_ips = list()
+    for vlan in ls_data['vlans']:
+        svi = vlan.get('svi')
+        if not svi:
+            continue
+        tags = [tag for tag in ('anycast-gateway', 'vrf-svi') if svi.get(tag)]
+        for leaf in leafs:
+            interfaces.append({'device': leaf, 'name': f"Vlan{vlan['vid']}", 'type': 'virtual',
+                               'vrf': svi['vrf'], 'tags': ','.join(tags)})
+            if svi.get('ip'):
+                svi_ips.append({'address': svi['ip'], 'vrf': svi['vrf'], 'status': 'active',
+                                'device': leaf, 'interface': f"Vlan{vlan['vid']}"})
+    ext_intfs = ls_data.get('ext_interfaces') or []
+    interfaces.extend({'device': e['device'], 'name': e['interface'], 'type': 'virtual',
+                       'vrf': e['vrf']} for e in ext_intfs)
+    files.append(('interfaces', interfaces))
+
+    links = spine_leaf_links(spines, leafs, interface_prefixes(ls_data).__getitem__)
+    files.append(('cables', [{'side_a_device': spine, 'side_a_type': 'dcim.interface',
+                              'side_a_name': spineintf, 'side_b_device': leaf,
+                              'side_b_type': 'dcim.interface', 'side_b_name': leafintf,
+                              'status': 'connected'}
+                             for spine, spineintf, leaf, leafintf in links]))
+
+    prefixes = list()
+    ips = list()
+    for kind in ('transit_prefix', 'loopback_prefix'):
+        prefixes.append({'prefix': ls_data[kind]['prefix'], 'status': 'container',
+                         'site': ls_data[kind]['site']['name']})
+    tnets = ipaddress.ip_network(ls_data['transit_prefix']['prefix']).subnets(new_prefix=31)
+    for (spine, spineintf, leaf, leafintf), tnet in zip(links, tnets):
+        prefixes.append({'prefix': str(tnet), 'status': 'active'})
+        for address, device, intf in zip(tnet, (spine, leaf), (spineintf, leafintf)):
+            ips.append({'address': f"{address}/31", 'status': 'active',
+                        'device': device, 'interface': intf})
+    # The loader reserves the first /32 of the loopback container.
+    loopbacks = ipaddress.ip_network(ls_data['loopback_prefix']['prefix']).subnets(new_prefix=32)
+    reserved = next(loopbacks)
+    prefixes.append({'prefix': str(reserved), 'status': 'active'})
+    ips.append({'address': str(reserved), 'status': 'active', 'description': 'RESERVED'})
+    for device, loopback in zip(devices, loopbacks):
+        prefixes.append({'prefix': str(loopback), 'status': 'active'})
+        ips.append({'address': str(loopback), 'status': 'active',
+                    'device': device['name'], 'interface': 'Loopback0'})
+    ips.extend(svi_ips)
+    ips.extend({'address': e['ip'], 'vrf': e['vrf'], 'status': 'active',
+                'device': e['device'], 'interface': e['interface']} for e in ext_intfs)
+    files.append(('prefixes', prefixes))
+    files.append(('ip_addresses', ips))
+
+    return files
+
+def csv_value(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    return value
+
+def write_files(files, outdir, fmt):
+    os.makedirs(outdir, exist_ok=True)
+    paths = list()
+    for i, (name, rows) in enumerate(files, 1):
+        if name == 'device_types' or fmt == 'yaml':
+            path = os.path.join(outdir, f"{i:02d}_{name}.yaml")
+            with open(path, 'w') as f:
+                if name == 'device_types':
+                    yaml.safe_dump_all(rows, f, sort_keys=False)
+                else:
+                    yaml.safe_dump(rows, f, sort_keys=False)
+        else:
+            path = os.path.join(outdir, f"{i:02d}_{name}.csv")
+            columns = list(dict.fromkeys(column for row in rows for column in row))
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, columns)
+                writer.writeheader()
+                writer.writerows({k: csv_value(v) for k, v in row.items()} for row in rows)
+        log(f"Writing {len(rows)} {name.replace('_', ' ')} to {path}...done")
+        paths.append(path)
+    return paths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Expand a leaf/spine data file into NetBox bulk import files, one per '
+                    'object type, without connecting to Netbox')
+    parser.add_argument('lsdata', help="The leaf/spine data file in YAML format")
+    parser.add_argument('-o', '--output-dir',
+                        help="Directory to write the files to "
+                             "(default: the data file name with _import appended)")
+    parser.add_argument('--format', choices=['csv', 'yaml'], default='csv',
+                        help="Import format of the files (device types are always YAML)")
+    args = parser.parse_args(argv)
+
+    with open(args.lsdata, 'rb') as ndf:
+        ls_data = load_ls_data.parse_ls_data(ndf)
+    load_ls_data.exit_if_invalid(parser, args.lsdata, ls_data)
+
+    outdir = args.output_dir or f"{os.path.splitext(args.lsdata)[0]}_import"
+    write_files(compile_ls_data(ls_data), outdir, args.format)
+    # The import formats can't refer to a device by id (origindevice) or
+    # update the interfaces the devices get from their type.
+    log(f"Import the files in {outdir} in order, then run load_ls_data.py --plan {args.lsdata} "
+        f"for the static routes, BGP sessions, L3 base tags and trunks")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,776 @@
+import re
+import json
+import time
+import uuid
+import random
+import ipaddress
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit, parse_qs, urlencode
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+# An in-process stand-in for the parts of the NetBox 3.4 REST API (plus the
+# netbox_bgp plugin) and GraphQL API that load_ls_data.py talks to.  It is mounted on a
+# requests.Session as a transport adapter, so pynetbox runs unmodified and
+# no sockets, database or web server are involved.  serve() puts the same
+# object behind a local HTTP server for clients that bring their own HTTP
+# stack (the aiohttp backend).  Per-request latency and a rate of injected
+# 502 replies can be configured to model a loaded server.
+
+NESTED_FIELDS = ('name', 'slug', 'model', 'vid', 'prefix', 'address', 'asn', 'identifier')
+
+# Filters answered from an index rather than a table scan, on top of every
+# foreign key.  Unique constraints are indexed too, so large fabrics don't
+# make each create or filtered read linear in the table size.
+INDEXED_FIELDS = ('name', 'model', 'prefix', 'vid', 'asn', 'assigned_object_id')
+
+# The change log names objects by app label and model rather than by API
+# path; these are the paths that don't just drop the dashes and plural s.
+CHANGED_OBJECT_TYPES = {
+    'ipam/prefixes': 'ipam.prefix',
+    'ipam/ip-addresses': 'ipam.ipaddress',
+    'plugins/bgp/session': 'netbox_bgp.bgpsession',
+}
+
+# path -> (foreign keys, natural lookup fields, unique constraints)
+# A unique constraint is (fields, error field, error message).
+MODELS = {
+    'dcim/sites': ({}, ('name', 'slug'),
+                   [(('name',), 'name', 'site with this name already exists.')]),
+    'dcim/device-roles': ({}, ('name', 'slug'),
+                          [(('name',), 'name', 'device role with this name already exists.')]),
+    'dcim/manufacturers': ({}, ('name', 'slug'),
+                           [(('name',), 'name', 'manufacturer with this name already exists.')]),
+    'dcim/device-types': ({'manufacturer': 'dcim/manufacturers'}, ('model', 'slug'),
+                          [(('manufacturer', 'model'), 'non_field_errors',
+                            'The fields manufacturer, model must make a unique set.')]),
+    'dcim/interface-templates': ({'device_type': 'dcim/device-types'}, ('name',),
+                                 [(('device_type', 'name'), 'non_field_errors',
+                                   'The fields device_type, name must make a unique set.')]),
+    'dcim/devices': ({'device_role': 'dcim/device-roles', 'device_type': 'dcim/device-types',
+                      'site': 'dcim/sites'}, ('name',),
+                     [(('name', 'site'), 'name', 'A device with this name already exists.')]),
+    'dcim/interfaces': ({'device': 'dcim/devices', 'vrf': 'ipam/vrfs'}, ('name',),
+                        [(('device', 'name'), 'non_field_errors',
+                          'The fields device, name must make a unique set.')]),
+    'dcim/cables': ({}, (), []),
+    'extras/tags': ({}, ('name', 'slug'),
+                    [(('name',), 'name', 'tag with this name already exists.')]),
+    'extras/custom-fields': ({}, ('name',),
+                             [(('name',), 'name', 'custom field with this name already exists.')]),
+    'extras/object-changes': ({}, (), []),
+    'ipam/prefixes': ({'site': 'dcim/sites', 'vrf': 'ipam/vrfs'}, ('prefix',), []),
+    'ipam/ip-addresses': ({'vrf': 'ipam/vrfs'}, ('address',), []),
+    'ipam/rirs': ({}, ('name', 'slug'),
+                  [(('name',), 'name', 'RIR with this name already exists.')]),
+    'ipam/asns': ({'rir': 'ipam/rirs'}, ('asn',),
+                  [(('asn',), 'asn', 'ASN with this ASN already exists.')]),
+    'ipam/vrfs': ({}, ('name',), []),
+    'ipam/vlans': ({'site': 'dcim/sites'}, ('name', 'vid'), []),
+    'ipam/l2vpns': ({}, ('name', 'slug'),
+                    [(('name',), 'name', 'L2VPN with this name already exists.')]),
+    'ipam/l2vpn-terminations': ({'l2vpn': 'ipam/l2vpns'}, (),
+                                [(('assigned_object_type', 'assigned_object_id'), 'non_field_errors',
+                                  'L2VPN termination with this Assigned object type and '
+                                  'Assigned object id already exists.')]),
+    'plugins/bgp/session': ({'site': 'dcim/sites', 'device': 'dcim/devices',
+                             'local_as': 'ipam/asns', 'remote_as': 'ipam/asns',
+                             'local_address': 'ipam/ip-addresses',
+                             'remote_address': 'ipam/ip-addresses'}, ('name',),
+                            [(('device', 'local_address', 'local_as', 'remote_address', 'remote_as'),
+                              'non_field_errors',
+                              'BGP Session with this Device, Local address, Local AS, Remote '
+                              'address and Remote AS already exists.')]),
+}
+
+M2M_FIELDS = {
+    'tags': 'extras/tags',
+    'tagged_vlans': 'ipam/vlans',
+}
+
+OBJECT_TYPES = {
+    'dcim.interface': 'dcim/interfaces',
+    'ipam.vlan': 'ipam/vlans',
+    'dcim.device': 'dcim/devices',
+}
+
+# GraphQL list queries answered by graphql(), and the GraphQL type names of
+# the tables for inline fragments.
+GRAPHQL_LISTS = {
+    'device_list': 'dcim/devices',
+    'interface_list': 'dcim/interfaces',
+    'ip_address_list': 'ipam/ip-addresses',
+    'vrf_list': 'ipam/vrfs',
+    'vlan_list': 'ipam/vlans',
+}
+GRAPHQL_TYPES = {
+    'dcim/devices': 'DeviceType',
+    'dcim/interfaces': 'InterfaceType',
+    'ipam/ip-addresses': 'IPAddressType',
+    'ipam/vrfs': 'VRFType',
+    'ipam/vlans': 'VLANType',
+}
+
+GRAPHQL_TOKEN = re.compile(r'\s*(?:(\.\.\.)|([{}()\[\]:,!$=])|"((?:[^"\\]|\\.)*)"|'
+                           r'(-?\d+(?:\.\d+)?)|([_A-Za-z][_0-9A-Za-z]*))')
+
+
+class GraphQLQuery:
+    # Parser for the subset of GraphQL the loader sends: one operation with
+    # optional variables, fields with arguments, nested selections and
+    # inline fragments.
+    def __init__(self, text, variables):
+        self.tokens = list()
+        pos = 0
+        text = re.sub(r'#.*', '', text)
+        while text[pos:].strip():
+            m = GRAPHQL_TOKEN.match(text, pos)
+            if not m:
+                raise ValueError(f"Syntax Error: unexpected character at {pos}")
+            kind = m.lastindex
+            value = m.group(kind)
+            self.tokens.append((kind, json.loads(f'"{value}"') if kind == 3 else value))
+            pos = m.end()
+        self.pos = 0
+        self.variables = variables or {}
+        if self.peek() in ('query', 'mutation'):
+            self.next()
+            if self.peek() not in ('{', '('):
+                self.next()
+            if self.peek() == '(':
+                while self.next() != ')':
+                    pass
+        self.selections = self.selection_set()
+
+    def peek(self):
+        return self.tokens[self.pos][1] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        self.pos += 1
+        return self.tokens[self.pos - 1][1]
+
+    def expect(self, token):
+        if self.next() != token:
+            raise ValueError(f"Syntax Error: expected {token}")
+
+    def selection_set(self):
+        self.expect('{')
+        selections = list()
+        while self.peek() != '}':
+            if self.peek() == '...':
+                self.next()
+                self.expect('on')
+                selections.append(('fragment', self.next(), {}, self.selection_set()))
+                continue
+            name = self.next()
+            args = dict()
+            if self.peek() == '(':
+                self.next()
+                while self.peek() != ')':
+                    key = self.next()
+                    self.expect(':')
+                    args[key] = self.value()
+                    if self.peek() == ',':
+                        self.next()
+                self.next()
+            sub = self.selection_set() if self.peek() == '{' else None
+            selections.append(('field', name, args, sub))
+            if self.peek() == ',':
+                self.next()
+        self.next()
+        return selections
+
+    def value(self):
+        kind, token = self.tokens[self.pos]
+        self.pos += 1
+        if token == '$':
+            return self.variables.get(self.next())
+        if token == '[':
+            values = list()
+            while self.peek() != ']':
+                values.append(self.value())
+                if self.peek() == ',':
+                    self.next()
+            self.next()
+            return values
+        if kind == 4:
+            return json.loads(token)
+        if kind == 5 and token in ('true', 'false', 'null'):
+            return json.loads(token)
+        return token
+
+
+class ValidationError(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+class FakeNetBox(BaseAdapter):
+    def __init__(self, latency=0.0, error_rate=0.0):
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.RLock()
+        self.tables = defaultdict(dict)
+        self.next_id = Counter()
+        self.ip_counts = Counter()
+        self.cabled = dict()
+        self.stats = Counter()
+        self.change_id = 0
+        self.request_id = None
+        self.index = defaultdict(lambda: defaultdict(set))
+        self.unique = defaultdict(dict)
+
+    # -- transport ---------------------------------------------------------
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(request.url)
+        path = url.path.split('/api/', 1)[-1].strip('/')
+        query = parse_qs(url.query, keep_blank_values=True)
+        body = json.loads(request.body) if request.body else None
+        method = request.method.upper()
+        request_id = str(uuid.uuid4())
+        self.stats[method] += 1
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats['502'] += 1
+            status, data = 502, None
+        else:
+            with self.lock:
+                self.request_id = request_id
+                try:
+                    status, data = self.dispatch(method, path, query, body)
+                except ValidationError as E:
+                    status, data = 400, E.errors
+                except KeyError:
+                    status, data = 404, {'detail': 'Not found.'}
+
+        resp = requests.models.Response()
+        resp.status_code = status
+        resp.reason = {200: 'OK', 201: 'Created', 204: 'No Content',
+                       400: 'Bad Request', 404: 'Not Found', 409: 'Conflict',
+                       502: 'Bad Gateway'}.get(status, '')
+        resp._content = b'' if data is None else json.dumps(data).encode()
+        resp.headers = CaseInsensitiveDict({'Content-Type': 'application/json',
+                                            'API-Version': '3.4',
+                                            'X-Request-ID': request_id})
+        resp.encoding = 'utf-8'
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        return resp
+
+    def close(self):
+        pass
+
+    def session(self, base='http://fake-netbox'):
+        session = requests.Session()
+        session.mount(base, self)
+        return session
+
+    def serve(self, port=0):
+        # Start a threaded HTTP server in front of the fake on localhost and
+        # return it with its base URL.
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_any(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else None
+                request = requests.Request(self.command, 'http://fake-netbox' + self.path,
+                                           data=body).prepare()
+                resp = fake.send(request)
+                # Object and pagination URLs point back at this server.
+                content = resp.content.replace(b'http://fake-netbox',
+                                               f"http://{self.headers['Host']}".encode())
+                self.send_response(resp.status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('X-Request-ID', resp.headers['X-Request-ID'])
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = handle_any
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+    # -- routing -----------------------------------------------------------
+
+    def dispatch(self, method, path, query, body):
+        if path in ('', 'status'):
+            return 200, {'netbox-version': '3.4.6', 'plugins': {'netbox_bgp': '0.9.0'}}
+        if path == 'graphql':
+            return 200, self.graphql(body)
+        m = re.match(r'^(.+?)/(\d+)(?:/(available-prefixes|available-ips))?$', path)
+        if m:
+            table, key, detail = m.group(1), int(m.group(2)), m.group(3)
+            if table not in MODELS:
+                raise KeyError(table)
+            if detail == 'available-prefixes':
+                return self.available_prefix(key, body)
+            if detail == 'available-ips':
+                return self.available_ip(key, body)
+            if method == 'GET':
+                return 200, self.serialize(table, self.tables[table][key])
+            if method in ('PATCH', 'PUT'):
+                return 200, self.update(table, dict(body, id=key))
+            if method == 'DELETE':
+                self.delete(table, key)
+                return 204, None
+        if path not in MODELS:
+            raise KeyError(path)
+        if method == 'GET':
+            return 200, self.list(path, query)
+        if method == 'POST':
+            return 201, self.create_many(path, body)
+        if method == 'PATCH':
+            return 200, self.bulk(path, body, self.update)
+        if method == 'DELETE':
+            for item in body:
+                self.delete(path, item['id'])
+            return 204, None
+        raise KeyError(method)
+
+    def bulk(self, table, body, func):
+        if not isinstance(body, list):
+            return func(table, body)
+        results, errors = [], []
+        for item in body:
+            try:
+                results.append(func(table, item))
+                errors.append({})
+            except ValidationError as E:
+                errors.append(E.errors)
+        if any(errors):
+            raise ValidationError(errors)
+        return results
+
+    def create_many(self, table, body):
+        if not isinstance(body, list):
+            return self.create(table, body)
+        # Validate the whole batch before writing anything, like NetBox's
+        # atomic bulk create.
+        errors = list()
+        for item in body:
+            try:
+                self.validate(table, self.normalize(table, item))
+                errors.append({})
+            except ValidationError as E:
+                errors.append(E.errors)
+        if any(errors):
+            raise ValidationError(errors)
+        return [self.create(table, item) for item in body]
+
+    # -- object handling ---------------------------------------------------
+
+    def resolve(self, table, value):
+        if value is None or isinstance(value, int):
+            return value
+        if isinstance(value, dict):
+            if 'id' in value:
+                return value['id']
+            matches = [o['id'] for o in self.tables[table].values()
+                       if all(str(self.plain(o, k)) == str(v) for k, v in value.items())]
+            if len(matches) != 1:
+                raise ValidationError({'__all__': [
+                    f"Related object not found using the provided attributes: {value}"]})
+            return matches[0]
+        raise ValidationError({'__all__': [f"Invalid related object {value!r}"]})
+
+    def plain(self, obj, key):
+        return obj.get(key)
+
+    def normalize(self, table, data):
+        fks = MODELS[table][0]
+        obj = dict()
+        for k, v in data.items():
+            if k in fks:
+                obj[k] = self.resolve(fks[k], v)
+            elif k in M2M_FIELDS:
+                obj[k] = [self.resolve(M2M_FIELDS[k], i) for i in v]
+            else:
+                obj[k] = v
+        return obj
+
+    def validate(self, table, obj, pk=None):
+        for fields, field, message in MODELS[table][2]:
+            key = tuple(obj.get(f) for f in fields)
+            if None in key:
+                continue
+            other = self.unique[(table, fields)].get(key)
+            if other is not None and other != pk:
+                raise ValidationError({field: [message]})
+        if table == 'dcim/cables':
+            for side in ('a_terminations', 'b_terminations'):
+                for term in obj.get(side, []):
+                    if ('dcim.interface', term['object_id']) in self.cabled:
+                        raise ValidationError({'__all__': [
+                            f"Duplicate termination found for dcim.interface:"
+                            f"{term['object_id']}"]})
+
+    # -- indexes -----------------------------------------------------------
+
+    def indexed_fields(self, table):
+        return set(MODELS[table][0]) | set(INDEXED_FIELDS)
+
+    def add_to_index(self, table, obj):
+        for field in self.indexed_fields(table):
+            if obj.get(field) is not None:
+                self.index[(table, field)][str(obj[field])].add(obj['id'])
+        for fields, field, message in MODELS[table][2]:
+            key = tuple(obj.get(f) for f in fields)
+            if None not in key:
+                self.unique[(table, fields)][key] = obj['id']
+
+    def drop_from_index(self, table, obj):
+        for field in self.indexed_fields(table):
+            if obj.get(field) is not None:
+                self.index[(table, field)][str(obj[field])].discard(obj['id'])
+        for fields, field, message in MODELS[table][2]:
+            key = tuple(obj.get(f) for f in fields)
+            if self.unique[(table, fields)].get(key) == obj['id']:
+                del self.unique[(table, fields)][key]
+
+    def lookup(self, table, field, values):
+        found = set()
+        for value in values:
+            found |= self.index[(table, field)].get(str(value), set())
+        return found
+
+    def candidates(self, table, query):
+        # Narrow a filtered list down to the rows the indexes allow, in id
+        # order; matches() still checks every filter on what is left.
+        fks = MODELS[table][0]
+        ids = None
+        for key, values in query.items():
+            if key == 'devicetype_id':
+                key = 'device_type_id'
+            if key == 'id':
+                found = {int(v) for v in values if v.isdigit()}
+            elif table == 'ipam/ip-addresses' and key == 'device_id':
+                found = self.lookup(table, 'assigned_object_id',
+                                    self.lookup('dcim/interfaces', 'device', values))
+            elif key.endswith('_id') and key[:-3] in fks:
+                found = self.lookup(table, key[:-3], values)
+            elif key in INDEXED_FIELDS:
+                found = self.lookup(table, key, values)
+            else:
+                continue
+            ids = found if ids is None else ids & found
+
+        if ids is None:
+            return list(self.tables[table].values())
+        return [self.tables[table][pk] for pk in sorted(ids) if pk in self.tables[table]]
+
+    def new_id(self, table):
+        self.next_id[table] += 1
+        return self.next_id[table]
+
+    def log_change(self, table, pk, action):
+        self.change_id += 1
+        self.tables['extras/object-changes'][self.change_id] = {
+            'id': self.change_id,
+            'time': f"{time.time():.6f}",
+            'action': {'value': action},
+            'changed_object_type': CHANGED_OBJECT_TYPES.get(
+                table, table.replace('-', '').rstrip('s').replace('/', '.')),
+            'changed_object_id': pk,
+            'request_id': self.request_id,
+        }
+
+    def create(self, table, data):
+        obj = self.normalize(table, data)
+        self.validate(table, obj)
+        obj['id'] = self.new_id(table)
+        obj.setdefault('tags', [])
+        obj.setdefault('custom_fields', {})
+        self.tables[table][obj['id']] = obj
+        self.add_to_index(table, obj)
+        self.log_change(table, obj['id'], 'create')
+        if table == 'dcim/devices':
+            templates = self.lookup('dcim/interface-templates', 'device_type', [obj['device_type']])
+            for pk in sorted(templates):
+                tmpl = self.tables['dcim/interface-templates'][pk]
+                self.create('dcim/interfaces', {'device': obj['id'], 'name': tmpl['name'],
+                                                'type': tmpl.get('type')})
+        if table == 'ipam/ip-addresses' and obj.get('assigned_object_type') == 'dcim.interface':
+            self.ip_counts[obj['assigned_object_id']] += 1
+        if table == 'dcim/cables':
+            for side in ('a_terminations', 'b_terminations'):
+                for term in obj.get(side, []):
+                    self.cabled[(term['object_type'], term['object_id'])] = obj['id']
+        return self.serialize(table, obj)
+
+    def update(self, table, data):
+        obj = self.tables[table][data['id']]
+        changes = self.normalize(table, {k: v for k, v in data.items() if k != 'id'})
+        if 'custom_fields' in changes:
+            changes['custom_fields'] = dict(obj.get('custom_fields', {}), **changes['custom_fields'])
+        new = dict(obj, **changes)
+        self.validate(table, new, pk=obj['id'])
+        self.drop_from_index(table, obj)
+        obj.update(changes)
+        self.add_to_index(table, obj)
+        self.log_change(table, obj['id'], 'update')
+        return self.serialize(table, obj)
+
+    def delete(self, table, pk):
+        obj = self.tables[table].pop(pk)
+        self.drop_from_index(table, obj)
+        self.log_change(table, pk, 'delete')
+        # The cascades NetBox does for the objects the loader creates.
+        if table == 'dcim/devices':
+            for intf in sorted(self.lookup('dcim/interfaces', 'device', [pk])):
+                self.delete('dcim/interfaces', intf)
+        if table == 'dcim/device-types':
+            for template in sorted(self.lookup('dcim/interface-templates', 'device_type', [pk])):
+                self.delete('dcim/interface-templates', template)
+        if table == 'ipam/l2vpns':
+            for term in sorted(self.lookup('ipam/l2vpn-terminations', 'l2vpn', [pk])):
+                self.delete('ipam/l2vpn-terminations', term)
+        if table in ('dcim/interfaces', 'ipam/vlans'):
+            object_type, related = {'dcim/interfaces': ('dcim.interface', 'ipam/ip-addresses'),
+                                    'ipam/vlans': ('ipam.vlan', 'ipam/l2vpn-terminations')}[table]
+            for obj_pk in sorted(self.lookup(related, 'assigned_object_id', [pk])):
+                if self.tables[related][obj_pk].get('assigned_object_type') == object_type:
+                    self.delete(related, obj_pk)
+        if table == 'ipam/ip-addresses' and obj.get('assigned_object_type') == 'dcim.interface':
+            self.ip_counts[obj['assigned_object_id']] -= 1
+        if table == 'dcim/cables':
+            for side in ('a_terminations', 'b_terminations'):
+                for term in obj.get(side, []):
+                    self.cabled.pop((term['object_type'], term['object_id']), None)
+
+    def brief(self, table, pk):
+        if pk is None:
+            return None
+        obj = self.tables[table].get(pk)
+        if obj is None:
+            return {'id': pk}
+        nested = {'id': pk, 'url': f"http://fake-netbox/api/{table}/{pk}/"}
+        for field in NESTED_FIELDS:
+            if field in obj:
+                nested[field] = obj[field]
+        if table == 'dcim/interfaces':
+            nested['device'] = self.brief('dcim/devices', obj['device'])
+        nested['display'] = str(obj.get('name') or obj.get('model') or obj.get('prefix')
+                                or obj.get('address') or pk)
+        return nested
+
+    def serialize(self, table, obj):
+        fks = MODELS[table][0]
+        data = {'url': f"http://fake-netbox/api/{table}/{obj['id']}/"}
+        for k, v in obj.items():
+            if k in fks:
+                data[k] = self.brief(fks[k], v)
+            elif k in M2M_FIELDS:
+                data[k] = [self.brief(M2M_FIELDS[k], i) for i in v]
+            else:
+                data[k] = v
+        if table == 'dcim/interfaces':
+            data['count_ipaddresses'] = self.ip_counts[obj['id']]
+            data.setdefault('vrf', None)
+            data.setdefault('mode', None)
+            data.setdefault('tags', [])
+            data.setdefault('tagged_vlans', [])
+            cable = self.cabled.get(('dcim.interface', obj['id']))
+            data['cable'] = None if cable is None else {'id': cable, 'display': f"#{cable}"}
+            if obj.get('mode'):
+                data['mode'] = {'value': obj['mode'], 'label': obj['mode'].title()}
+        if obj.get('assigned_object_type') in OBJECT_TYPES:
+            data['assigned_object'] = self.brief(OBJECT_TYPES[obj['assigned_object_type']],
+                                                 obj['assigned_object_id'])
+        data['display'] = str(obj.get('name') or obj.get('model') or obj.get('prefix')
+                              or obj.get('address') or obj['id'])
+        return data
+
+    # -- filtering ---------------------------------------------------------
+
+    def matches(self, table, obj, key, values):
+        fks = MODELS[table][0]
+        if key in ('limit', 'offset', 'brief', 'ordering'):
+            return True
+        if key == 'name__ic':
+            return any(v.lower() in obj.get('name', '').lower() for v in values)
+        if key == 'id':
+            return str(obj['id']) in values
+        if key == 'within':
+            net = self.net(obj.get('prefix'))
+            return net is not None and any(
+                net != ipaddress.ip_network(v) and net.subnet_of(ipaddress.ip_network(v))
+                for v in values)
+        if key == 'mask_length':
+            net = self.net(obj.get('prefix'))
+            return net is not None and str(net.prefixlen) in values
+        if key == 'parent':
+            if not obj.get('address'):
+                return False
+            addr = ipaddress.ip_interface(obj['address']).ip
+            return any(addr in ipaddress.ip_network(v) for v in values)
+        if key == 'time_after':
+            return float(obj['time']) >= float(values[0])
+        if table == 'ipam/ip-addresses' and key in ('device', 'device_id', 'interface',
+                                                    'interface_id'):
+            if obj.get('assigned_object_type') != 'dcim.interface':
+                return False
+            intf = self.tables['dcim/interfaces'].get(obj['assigned_object_id'])
+            if intf is None:
+                return False
+            if key == 'interface_id':
+                return str(intf['id']) in values
+            if key == 'interface':
+                return intf['name'] in values
+            if key == 'device_id':
+                return str(intf['device']) in values
+            return self.tables['dcim/devices'][intf['device']]['name'] in values
+        if key == 'devicetype_id':
+            key = 'device_type_id'
+        if key.endswith('_id') and key[:-3] in fks:
+            return str(obj.get(key[:-3])) in values
+        if key in fks:
+            related = self.tables[fks[key]].get(obj.get(key))
+            if related is None:
+                return False
+            return any(str(related.get(f)) in values for f in MODELS[fks[key]][1])
+        if key in M2M_FIELDS:
+            names = [self.tables[M2M_FIELDS[key]][i].get('slug') for i in obj.get(key, [])]
+            return any(v in names for v in values)
+        value = obj.get(key)
+        if isinstance(value, dict):
+            value = value.get('value')
+        if isinstance(value, bool):
+            value = str(value).lower()
+        return str(value) in values
+
+    @staticmethod
+    def net(prefix):
+        return ipaddress.ip_network(prefix) if prefix else None
+
+    def list(self, table, query):
+        objs = [o for o in self.candidates(table, query)
+                if all(self.matches(table, o, k, v) for k, v in query.items())]
+        if table == 'extras/object-changes':
+            # NetBox lists the change log newest first.
+            objs.reverse()
+        limit = int(query.get('limit', ['50'])[0]) or 1000
+        offset = int(query.get('offset', ['0'])[0])
+        page = objs[offset:offset + min(limit, 1000)]
+        nxt = None
+        if offset + len(page) < len(objs):
+            params = {k: v for k, v in query.items()}
+            params['offset'] = [str(offset + len(page))]
+            params['limit'] = [str(min(limit, 1000))]
+            nxt = f"http://fake-netbox/api/{table}/?{urlencode(params, doseq=True)}"
+        return {'count': len(objs), 'next': nxt, 'previous': None,
+                'results': [self.serialize(table, o) for o in page]}
+
+    # -- GraphQL -----------------------------------------------------------
+
+    def graphql(self, body):
+        try:
+            query = GraphQLQuery(body['query'], body.get('variables'))
+        except (ValueError, IndexError) as E:
+            return {'errors': [{'message': str(E) or 'Syntax Error'}]}
+        data = dict()
+        for kind, name, args, sub in query.selections:
+            if name not in GRAPHQL_LISTS:
+                return {'errors': [{'message': f"Cannot query field '{name}' on type 'Query'."}]}
+            table = GRAPHQL_LISTS[name]
+            filters = {k: [str(i) for i in (v if isinstance(v, list) else [v])]
+                       for k, v in args.items() if v is not None}
+            objs = [o for o in self.candidates(table, filters)
+                    if all(self.matches(table, o, k, v) for k, v in filters.items())]
+            data[name] = [self.resolve_graphql(table, o, sub) for o in objs]
+        return {'data': data}
+
+    def graphql_related(self, table, obj, name):
+        # (table, objects) behind a relation of obj, or None for a plain field.
+        fks = MODELS[table][0]
+        if name in fks:
+            return fks[name], self.tables[fks[name]].get(obj.get(name))
+        if name in M2M_FIELDS:
+            return M2M_FIELDS[name], [self.tables[M2M_FIELDS[name]][i] for i in obj.get(name, [])]
+        if table == 'dcim/devices' and name == 'interfaces':
+            return 'dcim/interfaces', [self.tables['dcim/interfaces'][pk] for pk in
+                                       sorted(self.lookup('dcim/interfaces', 'device', [obj['id']]))]
+        if table == 'dcim/interfaces' and name == 'ip_addresses':
+            ips = self.tables['ipam/ip-addresses']
+            return 'ipam/ip-addresses', [
+                ips[pk] for pk in sorted(self.lookup('ipam/ip-addresses', 'assigned_object_id',
+                                                     [obj['id']]))
+                if ips[pk].get('assigned_object_type') == 'dcim.interface']
+        if table == 'dcim/interfaces' and name == 'cable':
+            cable = self.cabled.get(('dcim.interface', obj['id']))
+            return 'dcim/cables', cable and self.tables['dcim/cables'][cable]
+        if table == 'dcim/interfaces' and name == 'link_peers':
+            cable = self.cabled.get(('dcim.interface', obj['id']))
+            if cable is None:
+                return 'dcim/interfaces', []
+            sides = [[term['object_id'] for term in self.tables['dcim/cables'][cable][side]]
+                     for side in ('a_terminations', 'b_terminations')]
+            peers = sides[1] if obj['id'] in sides[0] else sides[0]
+            return 'dcim/interfaces', [self.tables['dcim/interfaces'][pk] for pk in peers]
+        return None
+
+    def resolve_graphql(self, table, obj, selections):
+        data = dict()
+        for kind, name, args, sub in selections:
+            if kind == 'fragment':
+                if GRAPHQL_TYPES.get(table) == name:
+                    data.update(self.resolve_graphql(table, obj, sub))
+                continue
+            related = self.graphql_related(table, obj, name)
+            if related is None:
+                value = obj.get(name)
+                if name == 'mode' and value:
+                    # Choice fields come back as enum names.
+                    value = value.upper()
+                data[name] = value
+                continue
+            related_table, value = related
+            if isinstance(value, list):
+                data[name] = [self.resolve_graphql(related_table, o, sub) for o in value]
+            else:
+                data[name] = value and self.resolve_graphql(related_table, value, sub)
+        return data
+
+    # -- IPAM allocation ---------------------------------------------------
+
+    def children(self, parent):
+        return [self.net(p['prefix']) for p in self.tables['ipam/prefixes'].values()
+                if self.net(p['prefix']) != parent and self.net(p['prefix']).subnet_of(parent)]
+
+    def available_prefix(self, pk, body):
+        parent = self.net(self.tables['ipam/prefixes'][pk]['prefix'])
+        used = self.children(parent)
+        for candidate in parent.subnets(new_prefix=body['prefix_length']):
+            if not any(candidate.overlaps(u) for u in used):
+                data = {k: v for k, v in body.items() if k != 'prefix_length'}
+                data['prefix'] = str(candidate)
+                return 201, self.create('ipam/prefixes', data)
+        return 409, {'detail': 'Insufficient space is available to accommodate the requested prefix size(s)'}
+
+    def available_ip(self, pk, body):
+        parent = self.net(self.tables['ipam/prefixes'][pk]['prefix'])
+        used = {ipaddress.ip_interface(a['address']).ip
+                for a in self.tables['ipam/ip-addresses'].values()}
+        hosts = list(parent) if parent.prefixlen >= 31 else list(parent.hosts())
+        for addr in hosts:
+            if addr not in used:
+                data = dict(body)
+                data['address'] = f"{addr}/{parent.prefixlen}"
+                return 201, self.create('ipam/ip-addresses', data)
+        return 409, {'detail': 'Insufficient space is available to accommodate the requested IP address(es)'}
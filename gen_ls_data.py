@@ -0,0 +1,261 @@
+import sys
+import math
+import argparse
+import itertools
+import ipaddress
+import yaml
+
+SITE = 'vagrantlab'
+SPINE_ASN = 65100
+LEAF_ASN = 64601
+LEAF_ASN_4B = 4200000000
+MAX_ASN = 4294967294
+MAX_VID = 4094
+ACCESS_VNI_BASE = 10000
+VRF_VNI_BASE = 20000
+SVI_SUPERNET = '172.16.0.0/12'
+EXT_SUPERNET = '192.168.0.0/16'
+STATIC_SUPERNET = '100.64.0.0/10'
+EXT_SUBINTF = 20
+
+VENDORS = {
+    'n9kv': {'manufacturer': 'Cisco', 'slug': 'cisco', 'model': 'n9kv-switch',
+             'model_slug': 'n9kv-switch', 'interface_prefix': 'Ethernet1/'},
+    'ceos': {'manufacturer': 'Arista', 'slug': 'arista', 'model': 'ceos-switch',
+             'model_slug': 'ceosswitch', 'interface_prefix': 'Ethernet'},
+}
+
+# Leaf port layout: uplinks to the spines on ports 1..spines, then one trunk
+# port and one port carrying the external subinterface.  Spine port j goes
+# to leaf j.
+def ports_needed(spines, leafs):
+    return max(leafs, spines + 2)
+
+def sized_prefix(base, count, prefixlen):
+    # Smallest prefix at base that holds count /prefixlen subnets
+    bits = math.ceil(math.log2(count)) if count > 1 else 0
+    return str(ipaddress.ip_network(f"{base}/{prefixlen - bits}", strict=False))
+
+def subnet_count(prefix, prefixlen):
+    network = ipaddress.ip_network(prefix)
+    if network.prefixlen > prefixlen:
+        return 0
+    return 2 ** (prefixlen - network.prefixlen)
+
+def subnets(supernet, prefixlen, count):
+    return list(itertools.islice(ipaddress.ip_network(supernet).subnets(new_prefix=prefixlen), count))
+
+def check_args(args):
+    errors = list()
+    if args.spines < 1 or args.leafs < 1:
+        errors.append("need at least one spine and one leaf")
+
+    needed = ports_needed(args.spines, args.leafs)
+    if args.interface_qty < needed:
+        errors.append(f"interface_qty {args.interface_qty} is too small: spines need {args.leafs} "
+                      f"ports and leafs need {args.spines + 2} (uplinks, trunk and external port)")
+
+    links = args.spines * args.leafs
+    try:
+        if subnet_count(args.transit_prefix, 31) < links:
+            errors.append(f"transit_prefix {args.transit_prefix} has room for "
+                          f"{subnet_count(args.transit_prefix, 31)} /31s, {links} links need "
+                          f"at least {sized_prefix('0.0.0.0', links, 31).split('/')[1]} bits")
+        # The loader reserves the first /32 of the loopback prefix
+        devices = args.spines + args.leafs
+        if subnet_count(args.loopback_prefix, 32) < devices + 1:
+            errors.append(f"loopback_prefix {args.loopback_prefix} has room for "
+                          f"{subnet_count(args.loopback_prefix, 32)} /32s, {devices} devices "
+                          f"and the reserved address need {devices + 1}")
+        if ipaddress.ip_network(args.transit_prefix).overlaps(
+                ipaddress.ip_network(args.loopback_prefix)):
+            errors.append("transit_prefix and loopback_prefix overlap")
+    except ValueError as E:
+        errors.append(str(E))
+
+    if args.same_leaf_asn:
+        leaf_asns = range(args.leaf_asn, args.leaf_asn + 1)
+    else:
+        leaf_asns = range(args.leaf_asn, args.leaf_asn + args.leafs)
+    if args.spine_asn in leaf_asns:
+        errors.append(f"spine ASN {args.spine_asn} falls in the leaf ASN range "
+                      f"{leaf_asns[0]}-{leaf_asns[-1]}")
+    if leaf_asns[-1] > MAX_ASN:
+        errors.append(f"leaf ASN range ends at {leaf_asns[-1]}, past {MAX_ASN}")
+
+    if args.vrfs < 1:
+        errors.append("need at least one VRF")
+    last_vid = args.vlan_start + args.vlans + args.vrfs - 1
+    if args.vlan_start < 2 or last_vid > MAX_VID:
+        errors.append(f"VLANs {args.vlan_start}-{last_vid} (access VLANs plus one SVI VLAN per "
+                      f"VRF) don't fit in 2-{MAX_VID}")
+    if args.vlans > subnet_count(SVI_SUPERNET, 24):
+        errors.append(f"at most {subnet_count(SVI_SUPERNET, 24)} access VLANs")
+
+    if args.ext_interfaces > args.leafs:
+        errors.append(f"{args.ext_interfaces} external interfaces for {args.leafs} leafs")
+    if args.trunks > args.leafs:
+        errors.append(f"{args.trunks} trunk interfaces for {args.leafs} leafs")
+    if args.statics and not args.ext_interfaces:
+        errors.append("static routes need at least one external interface as next hop")
+    if args.statics > subnet_count(STATIC_SUPERNET, 24):
+        errors.append(f"at most {subnet_count(STATIC_SUPERNET, 24)} static routes")
+
+    return errors
+
+def gen_ls_data(args):
+    vendor = VENDORS[args.vendor]
+    intf_prefix = vendor['interface_prefix']
+    site = {'name': SITE}
+    ls_data = {
+        'sites': [{'name': SITE, 'slug': SITE}],
+        'roles': [{'name': 'leaf', 'slug': 'leaf'}, {'name': 'spine', 'slug': 'spine'}],
+        'manufacturers': [{'name': vendor['manufacturer'], 'slug': vendor['slug']}],
+        'device_types': [{'model': vendor['model'],
+                          'manufacturer': {'name': vendor['manufacturer']},
+                          'interface_qty': args.interface_qty,
+                          'interface_prefix': intf_prefix,
+                          'slug': vendor['model_slug']}],
+        'devices': {
+            'spines': {'device_role': {'name': 'spine'}, 'device_type': {'model': vendor['model']},
+                       'prefix': f"{args.vendor}-spine-", 'qty': args.spines, 'site': dict(site)},
+            'leafs': {'device_role': {'name': 'leaf'}, 'device_type': {'model': vendor['model']},
+                      'prefix': f"{args.vendor}-leaf-", 'qty': args.leafs, 'site': dict(site)},
+        },
+        'transit_prefix': {'prefix': args.transit_prefix, 'site': dict(site)},
+        'loopback_prefix': {'prefix': args.loopback_prefix, 'site': dict(site)},
+        'rir': {'is_private': True, 'name': 'VagrantLabRIR', 'slug': 'vagrantlabrir'},
+        'asns': {'leaf': {'range_start': args.leaf_asn}, 'spine': {'asn': args.spine_asn}},
+        'tags': [
+            {'description': "Signify that an interface is an L3 base interface (i.e., 'no switchport')",
+             'name': 'l3base', 'slug': 'l3base'},
+            {'description': 'Signify that an interface is an Anycast Gateway',
+             'name': 'anycast-gateway', 'slug': 'anycast-gateway'},
+            {'description': 'Signify that an interface is the L3 SVI for a VRF',
+             'name': 'vrf-svi', 'slug': 'vrf-svi'},
+        ],
+    }
+    if args.same_leaf_asn:
+        ls_data['asns']['leaf']['sameasn'] = True
+
+    vrfnames = [f"vrf-{SITE}-{i:02d}" for i in range(1, args.vrfs + 1)]
+    vlans = list()
+    access_vids = list()
+    for i, network in enumerate(subnets(SVI_SUPERNET, 24, args.vlans)):
+        vid = args.vlan_start + i
+        access_vids.append(vid)
+        vlans.append({'name': f"access-{vid}", 'vid': vid, 'vni': ACCESS_VNI_BASE + vid,
+                      'svi': {'ip': f"{network[1]}/24", 'vrf': vrfnames[i % args.vrfs],
+                              'anycast-gateway': True}})
+
+    vrfs = list()
+    for i, vrfname in enumerate(vrfnames):
+        vid = args.vlan_start + args.vlans + i
+        vlans.append({'name': f"svi-{vrfname}", 'vid': vid, 'vni': VRF_VNI_BASE + vid,
+                      'svi': {'vrf': vrfname, 'vrf-svi': True}})
+        vrfs.append({'name': vrfname, 'vni': VRF_VNI_BASE + vid})
+
+    ls_data['vlans'] = vlans
+    ls_data['vrfs'] = vrfs
+
+    leafnames = [f"{args.vendor}-leaf-{i:02d}" for i in range(1, args.leafs + 1)]
+    ext_interfaces = list()
+    nexthops = list()
+    for i, network in enumerate(subnets(EXT_SUPERNET, 30, args.ext_interfaces)):
+        ext_interfaces.append({'device': leafnames[i],
+                               'interface': f"{intf_prefix}{args.spines + 2}.{EXT_SUBINTF}",
+                               'ip': f"{network[1]}/30",
+                               'vrf': vrfnames[i % args.vrfs]})
+        nexthops.append(str(network[2]))
+
+    # Static routes point at the far end of the external /30s in turn
+    statics = list()
+    for i, network in enumerate(subnets(STATIC_SUPERNET, 24, args.statics)):
+        ext_intf = ext_interfaces[i % len(ext_interfaces)]
+        statics.append({'prefix': str(network), 'nexthop': nexthops[i % len(nexthops)],
+                        'vrf': ext_intf['vrf'], 'origindevice': ext_intf['device']})
+
+    if statics:
+        ls_data['statics'] = statics
+    if ext_interfaces:
+        ls_data['ext_interfaces'] = ext_interfaces
+    if args.trunks and access_vids:
+        ls_data['trunk_interfaces'] = [{'device': leafname,
+                                        'interface': f"{intf_prefix}{args.spines + 1}",
+                                        'vlans': list(access_vids)}
+                                       for leafname in leafnames[:args.trunks]]
+
+    return ls_data
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate leaf/spine data files for load_ls_data.py of any size')
+    parser.add_argument('--vendor', choices=sorted(VENDORS), default='n9kv',
+                        help="Device naming, manufacturer and interface naming")
+    parser.add_argument('--spines', type=int, default=2)
+    parser.add_argument('--leafs', type=int, default=4)
+    parser.add_argument('--interface-qty', type=int,
+                        help="Ports per device type (default: enough for the fabric, at least 24)")
+    parser.add_argument('--transit-prefix',
+                        help="Container for the /31 transit links (default: sized at 10.254.0.0)")
+    parser.add_argument('--loopback-prefix',
+                        help="Container for the /32 loopbacks (default: sized at 10.255.0.0)")
+    parser.add_argument('--spine-asn', type=int, default=SPINE_ASN)
+    parser.add_argument('--leaf-asn', type=int,
+                        help=f"First leaf ASN (default: {LEAF_ASN}, or {LEAF_ASN_4B} if the "
+                             f"leafs don't fit below the spine ASN)")
+    parser.add_argument('--same-leaf-asn', action='store_true',
+                        help="Give every leaf the same ASN")
+    parser.add_argument('--vlans', type=int, default=2,
+                        help="Access VLANs with a VNI and an anycast gateway SVI on every leaf")
+    parser.add_argument('--vlan-start', type=int, default=301)
+    parser.add_argument('--vrfs', type=int, default=1,
+                        help="VRFs, each with an L3 VNI and a VRF SVI VLAN")
+    parser.add_argument('--ext-interfaces', type=int, default=1,
+                        help="Leafs with an external routed subinterface")
+    parser.add_argument('--statics', type=int, default=1,
+                        help="Static routes, spread over the external interfaces")
+    parser.add_argument('--trunks', type=int,
+                        help="Leafs with a trunk interface carrying the access VLANs "
+                             "(default: all leafs)")
+    parser.add_argument('-o', '--output', help="Output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    links = args.spines * args.leafs
+    if args.interface_qty is None:
+        args.interface_qty = max(24, ports_needed(args.spines, args.leafs))
+    if args.transit_prefix is None:
+        args.transit_prefix = sized_prefix('10.254.0.0', links, 31)
+    if args.loopback_prefix is None:
+        args.loopback_prefix = sized_prefix('10.255.0.0', args.spines + args.leafs + 1, 32)
+    if args.leaf_asn is None:
+        leafs = 1 if args.same_leaf_asn else args.leafs
+        if LEAF_ASN + leafs <= args.spine_asn or LEAF_ASN > args.spine_asn:
+            args.leaf_asn = LEAF_ASN
+        else:
+            args.leaf_asn = LEAF_ASN_4B
+    if args.trunks is None:
+        args.trunks = args.leafs
+
+    errors = check_args(args)
+    if errors:
+        for error in errors:
+            print(f"error: {error}", file=sys.stderr)
+        sys.exit(1)
+
+    return args
+
+def main():
+    args = parse_args()
+    links = args.spines * args.leafs
+    ls_data = gen_ls_data(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            yaml.safe_dump(ls_data, f, sort_keys=False)
+        print(f"Wrote {args.spines} spine(s), {args.leafs} leaf(s), {links} link(s), "
+              f"{len(ls_data['vlans'])} VLAN(s) to {args.output}")
+    else:
+        yaml.safe_dump(ls_data, sys.stdout, sort_keys=False)
+
+if __name__ == '__main__':
+    main()
@@ -1,630 +1,2774 @@
 import os
 import re
+import json
+import time
+import math
+import sqlite3
+import hashlib
+import random
+import asyncio
 import argparse
+import ipaddress
+import threading
+import traceback
+import multiprocessing
+import concurrent.futures
+from collections import Counter, deque
+from urllib.parse import urlsplit
 import yaml
-import pynetbox
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orm_load_ls_data.py imports this module from NetBox's own venv,
+    # which doesn't have pynetbox.
+    import pynetbox
+except ImportError:
+    pynetbox = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 NB_URL = 'http://localhost'
 NB_API_TOKEN = None
+BATCH_SIZE = 100
+WORKERS = 4
+CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+# A 500 or 504 can come back after NetBox committed a write, so writes are
+# only retried when the request never reached gunicorn.
+WRITE_RETRY_STATUSES = (502, 503)
 
 api_token_file = os.environ['HOME'] + "/nb_api_token"
 if not NB_API_TOKEN and os.path.isfile(api_token_file):
     with open(api_token_file) as f:
         NB_API_TOKEN = f.read().strip()
 
-def create_sites(nb, ls_data):
-    for site in ls_data['sites']:
+print_lock = threading.Lock()
+
+def log(message):
+    # Stages print from worker threads; write each line in one go so they
+    # don't interleave.
+    with print_lock:
+        print(message, flush=True)
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def bulk_filter(endpoint, field, values, **filters):
+    # One paginated filtered read per BATCH_SIZE values, so long lists of
+    # names or ids don't overflow the query string.
+    for batch in chunked(list(values), BATCH_SIZE):
+        yield from endpoint.filter(**{field: batch}, **filters)
+
+def raw_filter(endpoint, field, values, **filters):
+    # bulk_filter() yielding the API's JSON dicts as they are, for reads of
+    # many objects whose pynetbox Records (nested records, lazy loading)
+    # would only be used for a few of their fields.
+    for batch in chunked(list(values), BATCH_SIZE):
+        yield from endpoint.filter(**{field: batch}, **filters).response
+
+def batch_errors(E, count):
+    # A rejected list POST/PATCH carries one error dict per submitted item,
+    # with an empty dict for the items that were valid.  Batches that failed
+    # to send carry none.
+    if not isinstance(E, pynetbox.core.query.RequestError):
+        return None
+    try:
+        errors = E.req.json()
+    except ValueError:
+        return None
+
+    if isinstance(errors, list) and len(errors) == count:
+        return errors
+
+    return None
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Metrics:
+    # Request counters, payload sizes and latencies per load stage.  Requests
+    # are attributed to the stage running in the calling thread; recording
+    # one is a few dict updates under a lock, so it is always on.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = dict()
+
+    def set_stage(self, name):
+        self.local.stage = name
+
+    def current_stage(self):
+        return getattr(self.local, 'stage', 'main')
+
+    def entry(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {'requests': Counter(), 'status': Counter(),
+                                  'bytes_sent': 0, 'bytes_received': 0, 'latencies': list(),
+                                  'errors': 0, 'retries': 0, 'skips': 0, 'wall_time': 0.0}
+        return self.stages[stage]
+
+    def request(self, stage, method, url, sent, received, elapsed, status, retries=0):
+        path = urlsplit(url).path.split('/api/', 1)[-1].strip('/')
+        endpoint = re.sub(r'/\d+(?=/|$)', '/{id}', path)
+        with self.lock:
+            entry = self.entry(stage)
+            entry['requests'][(method, endpoint)] += 1
+            entry['status'][str(status)] += 1
+            entry['bytes_sent'] += sent
+            entry['bytes_received'] += received
+            entry['latencies'].append(elapsed)
+            entry['retries'] += retries
+            if status is None or status >= 400:
+                entry['errors'] += 1
+
+    def skip(self, count=1):
+        with self.lock:
+            self.entry(self.current_stage())['skips'] += count
+
+    def wall(self, stage, seconds):
+        with self.lock:
+            self.entry(stage)['wall_time'] += seconds
+
+    def merge(self, stages):
+        # Fold in the stage entries of a shard process.  The shards run side
+        # by side, so a stage took as long as its slowest shard.
+        with self.lock:
+            for name, other in stages.items():
+                entry = self.entry(name)
+                for key, value in other.items():
+                    if key == 'wall_time':
+                        entry[key] = max(entry[key], value)
+                    elif isinstance(value, Counter):
+                        entry[key].update(value)
+                    else:
+                        entry[key] += value
+
+    @staticmethod
+    def summary(entries):
+        requests = dict()
+        status = Counter()
+        latencies = list()
+        for entry in entries:
+            for (method, endpoint), count in entry['requests'].items():
+                requests.setdefault(method, Counter())[endpoint] += count
+            status.update(entry['status'])
+            latencies.extend(entry['latencies'])
+
+        latencies.sort()
+        histogram = dict.fromkeys([str(b) for b in LATENCY_BUCKETS_MS] + ['inf'], 0)
+        for latency in latencies:
+            bucket = next((b for b in LATENCY_BUCKETS_MS if latency * 1000 <= b), 'inf')
+            histogram[str(bucket)] += 1
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[math.ceil(p / 100 * len(latencies)) - 1] * 1000, 1)
+
+        return {'wall_time': round(sum(e['wall_time'] for e in entries), 3),
+                'request_count': len(latencies),
+                'requests': {method: dict(counts) for method, counts in requests.items()},
+                'status': dict(status),
+                'bytes_sent': sum(e['bytes_sent'] for e in entries),
+                'bytes_received': sum(e['bytes_received'] for e in entries),
+                'latency_ms': {'p50': percentile(50), 'p95': percentile(95),
+                               'p99': percentile(99), 'histogram': histogram},
+                'errors': sum(e['errors'] for e in entries),
+                'retries': sum(e['retries'] for e in entries),
+                'skips': sum(e['skips'] for e in entries)}
+
+    def report(self, wall_time, **options):
+        with self.lock:
+            stages = {name: self.summary([entry]) for name, entry in self.stages.items()}
+            total = self.summary(list(self.stages.values()))
+        total['wall_time'] = round(wall_time, 3)
+        return {'options': options, 'total': total, 'stages': stages}
+
+METRICS = Metrics()
+
+# NetBox tags every change with the id of the request that made it and
+# returns that id in the X-Request-ID header.  The ids of this run's writes
+# let IdCache tell its own updates from everyone else's.  Shard processes
+# only write objects whose changes the cache ignores.
+REQUEST_IDS = set()
+
+def record_request_id(method, headers):
+    if method != 'GET' and headers.get('X-Request-ID'):
+        REQUEST_IDS.add(headers['X-Request-ID'])
+
+class MeteredSession(requests.Session):
+    # Records every request pynetbox makes in METRICS.  Retries done by the
+    # transport adapter show up as one request with a retry count.
+    def send(self, request, **kwargs):
+        stage = METRICS.current_stage()
+        sent = len(request.body or b'')
+        start = time.monotonic()
         try:
-            print(f"Creating site '{site['name']}'...", end='')
-            nb.dcim.sites.create(name=site['name'], slug=site['slug'])
-            print("done")
+            resp = super().send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            METRICS.request(stage, request.method, request.url, sent, 0,
+                            time.monotonic() - start, None)
+            raise
 
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("name already exists") != -1:
-                print("site already exists, skipping")
+        record_request_id(request.method, resp.headers)
+        retries = getattr(getattr(resp.raw, 'retries', None), 'history', ())
+        METRICS.request(stage, request.method, request.url, sent,
+                        int(resp.headers.get('Content-Length') or len(resp.content)),
+                        time.monotonic() - start, resp.status_code, len(retries))
+        return resp
+
+class JitteredRetry(Retry):
+    # Exponential backoff with full jitter, so concurrent workers that hit
+    # the same 502 don't all come back at the same moment.
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method != 'GET' and status_code not in WRITE_RETRY_STATUSES:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+def build_session(pool_size, retries=RETRIES, backoff=BACKOFF):
+    # Keep-alive session with a connection pool sized for the number of
+    # threads sharing it.  Connection failures and 5xx replies to reads are
+    # retried with jittered backoff, writes only on connection failures and
+    # 502/503 (e.g. nginx while gunicorn is busy).  Reads of the reply that
+    # fail after the request was sent, and 4xx validation errors, are never
+    # retried.
+    retry = JitteredRetry(total=retries, connect=retries, read=0, other=0, status=retries,
+                          status_forcelist=RETRY_STATUSES, allowed_methods=None,
+                          backoff_factor=backoff, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          pool_block=True, max_retries=retry)
+    session = MeteredSession()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Connection': 'keep-alive', 'Accept-Encoding': 'gzip'})
+    return session
+
+class SyncBackend:
+    # Sends bulk batches one after another through pynetbox.  send() returns
+    # (records, None) for every accepted batch and (None, RequestError) for
+    # every batch NetBox rejected or that failed to send, so callers can
+    # journal the batches that went through before they give up.  Sending
+    # stops at the first batch that failed for anything but per-item
+    # errors.  Deleted batches come back as they were sent.
+    def send(self, endpoint, verb, batches):
+        results = list()
+        for batch in batches:
+            try:
+                if verb == 'post':
+                    results.append((endpoint.create(batch), None))
+                elif verb == 'patch':
+                    results.append((endpoint.update(batch), None))
+                else:
+                    endpoint.delete([item['id'] for item in batch])
+                    results.append((batch, None))
+
+            except (pynetbox.core.query.RequestError,
+                    requests.exceptions.RequestException) as E:
+                results.append((None, E))
+                if batch_errors(E, len(batch)) is None:
+                    break
+
+        return results
+
+    def close(self):
+        pass
+
+class ConcurrencyLimit:
+    # In-flight limit of the async backend.  A fixed limit has lower == upper.
+    # Otherwise it is adjusted AIMD-style after every window of `limit` (at
+    # least WINDOW) replies: one more slot if the window's p95 latency stayed
+    # under the target and no reply was a 5xx or connection failure, a
+    # quarter fewer if the p95 was over it and half as many on failures.
+    # Without an explicit target (seconds) the target is `tolerance` times a
+    # baseline that follows the lowest p95 seen and slowly drifts up, as the
+    # endpoints of later stages can be slower.  It lives on the event loop
+    # thread, so it needs no locking.
+    WINDOW = 10
+    READOUT_INTERVAL = 1.0
+
+    def __init__(self, start, lower=None, upper=None, target=None, tolerance=2.0):
+        self.lower = lower or start
+        self.upper = upper or start
+        self.limit = min(max(start, self.lower), self.upper)
+        self.target = target
+        self.tolerance = tolerance
+        self.baseline = None
+        self.in_flight = 0
+        self.waiters = deque()
+        self.window = list()
+        self.failures = 0
+        self.history = Counter({self.limit: 1})
+        self.readout = 0.0
+
+    @property
+    def adaptive(self):
+        return self.lower < self.upper
+
+    async def acquire(self):
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        # release() hands the slot over before waking us.
+        await waiter
+
+    def release(self, latency, failed):
+        self.in_flight -= 1
+        if self.adaptive:
+            self.window.append(latency)
+            self.failures += failed
+            if len(self.window) >= max(self.limit, self.WINDOW):
+                self.adjust()
+        while self.waiters and self.in_flight < self.limit:
+            self.in_flight += 1
+            self.waiters.popleft().set_result(None)
+
+    def adjust(self):
+        window = sorted(self.window)
+        p95 = window[math.ceil(0.95 * len(window)) - 1]
+        failures = self.failures
+        self.window = list()
+        self.failures = 0
+        if self.baseline is None or p95 < self.baseline:
+            self.baseline = p95
+        else:
+            self.baseline += (p95 - self.baseline) * 0.1
+        target = self.target or self.baseline * self.tolerance
+
+        before = self.limit
+        if failures:
+            self.limit = max(self.lower, self.limit // 2)
+        elif p95 > target:
+            self.limit = max(self.lower, min(self.limit - 1, self.limit * 3 // 4))
+        else:
+            self.limit = min(self.upper, self.limit + 1)
+        self.history[self.limit] += 1
+
+        now = time.monotonic()
+        if self.limit < before or (self.limit > before and
+                                   now - self.readout >= self.READOUT_INTERVAL):
+            self.readout = now
+            log(f"Concurrency {before} -> {self.limit}: p95 {p95 * 1000:.0f}ms "
+                f"(target {target * 1000:.0f}ms), {failures} failed of {len(window)} "
+                f"replies, {len(self.waiters)} waiting")
+
+    def summary(self):
+        return {'final': self.limit, 'low': min(self.history), 'high': max(self.history),
+                'windows': dict(sorted(self.history.items()))}
+
+class AsyncBackend:
+    # Sends bulk batches concurrently over one shared aiohttp connection
+    # pool, with at most `concurrency` requests in flight across all stages,
+    # or a ConcurrencyLimit that adapts between its bounds.  The event loop
+    # runs in its own thread so the stage threads can hand it work; results
+    # come back in the same form as SyncBackend.send().
+    def __init__(self, nb, concurrency=CONCURRENCY, pool_size=CONCURRENCY,
+                 retries=RETRIES, backoff=BACKOFF, limit=None):
+        self.nb = nb
+        self.retries = retries
+        self.backoff = backoff
+        self.limit = limit or ConcurrencyLimit(concurrency)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.call(self.open(max(pool_size, self.limit.upper)))
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def open(self, pool_size):
+        headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip'}
+        if self.nb.token:
+            headers['Authorization'] = f"Token {self.nb.token}"
+        self.session = aiohttp.ClientSession(
+            headers=headers, connector=aiohttp.TCPConnector(limit=pool_size))
+
+    async def request(self, stage, method, url, batch):
+        # Same retry policy as build_session(): connection failures and the
+        # 5xx replies of RETRY_STATUSES for reads, WRITE_RETRY_STATUSES for
+        # writes, with jittered exponential backoff.
+        statuses = RETRY_STATUSES if method == 'GET' else WRITE_RETRY_STATUSES
+        data = json.dumps(batch).encode()
+        attempt = 0
+        start = time.monotonic()
+        while True:
+            await self.limit.acquire()
+            sent = time.monotonic()
+            reply = None
+            try:
+                async with self.session.request(
+                        method, url, data=data,
+                        headers={'Content-Type': 'application/json'}) as resp:
+                    reply = resp.status, resp.reason, await resp.read()
+                    record_request_id(method, resp.headers)
+            except aiohttp.ClientConnectorError:
+                if attempt >= self.retries:
+                    METRICS.request(stage, method, url, len(data), 0,
+                                    time.monotonic() - start, None, attempt)
+                    raise
+            finally:
+                self.limit.release(time.monotonic() - sent,
+                                   reply is None or reply[0] in RETRY_STATUSES)
+
+            if reply is not None and (reply[0] not in statuses or attempt >= self.retries):
+                METRICS.request(stage, method, url, len(data), len(reply[2]),
+                                time.monotonic() - start, reply[0], attempt)
+                return reply
+
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            attempt += 1
+
+    async def gather(self, stage, method, url, batches):
+        # A batch that raises doesn't take the replies of the others with
+        # it; NetBox may already have saved them.
+        return await asyncio.gather(*[self.request(stage, method, url, batch)
+                                      for batch in batches], return_exceptions=True)
+
+    def send(self, endpoint, verb, batches):
+        method = verb.upper()
+        url = endpoint.url.rstrip('/') + '/'
+        results = list()
+        replies = self.call(self.gather(METRICS.current_stage(), method, url, batches))
+        for batch, reply in zip(batches, replies):
+            if isinstance(reply, BaseException):
+                results.append((None, reply))
                 continue
-            else:
-                raise
-
-def create_roles(nb, ls_data):
-    for role in ls_data['roles']:
-        try:
-            print(f"Creating role '{role['name']}'...", end='')
-            nb.dcim.device_roles.create(name=role['name'], slug=role['slug'])
-            print("done")
-
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("name already exists") != -1:
-                print("role already exists, skipping")
+            status, reason, body = reply
+            if 200 <= status < 300 and verb == 'delete':
+                results.append((batch, None))
+                continue
+            if 200 <= status < 300:
+                results.append(([endpoint.return_obj(values, endpoint.api, endpoint)
+                                 for values in json.loads(body)], None))
                 continue
-            else:
-                raise
-
-def create_manufacturers(nb, ls_data):
-    for manufacturer in ls_data['manufacturers']:
-        try:
-            print(f"Creating manufacturer '{manufacturer['name']}'...", end='')
-            nb.dcim.manufacturers.create(name=manufacturer['name'], slug=manufacturer['slug'])
-            print("done")
 
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("name already exists") != -1:
-                print("manufacturer already exists, skipping")
+            results.append((None, pynetbox.core.query.RequestError(
+                self.response(method, url, batch, status, reason, body))))
+
+        return results
+
+    @staticmethod
+    def response(method, url, batch, status, reason, body):
+        # Wrap a failed reply in a requests.Response so it surfaces as the
+        # same pynetbox RequestError the synchronous backend raises.
+        resp = requests.models.Response()
+        resp.status_code = status
+        resp.reason = reason
+        resp._content = body
+        resp.url = url
+        resp.request = requests.Request(method, url, json=batch).prepare()
+        return resp
+
+    def close(self):
+        self.call(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+BACKEND = SyncBackend()
+PLAN = None
+JOURNAL = None
+DELTA = None
+SHARD = None
+
+def log_skip(message):
+    # In --plan mode unchanged objects have already been listed in the plan.
+    METRICS.skip()
+    if PLAN is None:
+        log(message)
+
+def in_shard(*names):
+    # In a sharded load each process only loads the objects of its own
+    # leafs (see Shard).
+    return SHARD is None or SHARD.owns(names)
+
+def in_scope(*names):
+    # With --incremental only the objects of new devices (and the links to
+    # them) are created; without it every device is in scope.
+    return in_shard(*names) and (DELTA is None or DELTA.touches(*names))
+
+def new_items(ls_data, section):
+    # The entries of a list section an incremental load still has to load.
+    if DELTA is None:
+        return ls_data[section]
+    return DELTA.new_items(section, ls_data[section])
+
+def scoped_devices(ls_devices):
+    # The devices an incremental or sharded load has to look at: the ones
+    # in scope and the ones at the other end of the links in scope.
+    devices = [device for ls_device in ls_devices.values() for device in ls_device]
+    if DELTA is None and SHARD is None:
+        return devices
+    wanted = {device.name for device in devices if in_scope(device.name)}
+    for spine in ls_devices['spines']:
+        for leaf in ls_devices['leafs']:
+            if in_scope(spine.name, leaf.name):
+                wanted.update((spine.name, leaf.name))
+    return [device for device in devices if device.name in wanted]
+
+def bulk_create(endpoint, payloads, labels, kind, skip_error="already exists", group=1):
+    # Create objects with list POSTs of up to BATCH_SIZE items.  NetBox
+    # rejects the whole list if any item fails, so items whose error matches
+    # skip_error (any error when skip_error is None) are reported and dropped
+    # and the remainder of the batch is resubmitted.  Returns the created
+    # records in payload order, with None for the skipped items.  With a
+    # plan, items it found unchanged are skipped without being sent, and
+    # so are items the journal of a resumed load says were created.  Runs
+    # of `group` items always go in the same batch.  If a batch fails, the
+    # ones that went through are journaled before the error is raised.
+    created = [None] * len(payloads)
+    wanted = list()
+    for i in range(len(payloads)):
+        if PLAN is not None and not PLAN.pending(kind, labels[i]):
+            METRICS.skip()
+        elif JOURNAL is not None and JOURNAL.done('create', kind, labels[i]):
+            log_skip(f"{kind} {labels[i]} was created by the interrupted load, skipping")
+        else:
+            wanted.append(i)
+    pending = list(chunked(wanted, max(group, BATCH_SIZE - BATCH_SIZE % group)))
+    while pending:
+        results = BACKEND.send(endpoint, 'post',
+                               [[payloads[i] for i in batch] for batch in pending])
+        retry = list()
+        failure = None
+        for batch, (records, E) in zip(pending, results):
+            if E is None:
+                for i, record in zip(batch, records):
+                    created[i] = record
+                if JOURNAL is not None:
+                    JOURNAL.record('create', kind, [labels[i] for i in batch],
+                                   [record.id for record in records])
+                log(f"Creating {len(batch)} {kind}(s)...done")
                 continue
-            else:
-                raise
 
-def create_devicetypes(nb, ls_data):
-    for devicetype in ls_data['device_types']:
-        try:
-            print(f"Creating device type'{devicetype['model']}'...", end='')
-            nb.dcim.device_types.create(model=devicetype['model'],
-                                        manufacturer=devicetype['manufacturer'],
-                                        slug=devicetype['slug'])
-            print("done")
-
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("must make a unique set") != -1:
-                print("device type already exists, skipping")
+            errors = batch_errors(E, len(batch))
+            if errors is None:
+                failure = failure or E
                 continue
+
+            remaining = list()
+            for i, error in zip(batch, errors):
+                if not error:
+                    remaining.append(i)
+                elif skip_error is None or str(error).find(skip_error) != -1:
+                    log_skip(f"{kind} {labels[i]} already exists, skipping")
+                else:
+                    log(f"Creating {len(batch)} {kind}(s)...failed on {kind} {labels[i]}")
+                    failure = failure or E
+                    break
             else:
-                raise
+                if remaining:
+                    retry.append(remaining)
+
+        if failure is not None:
+            raise failure
+        pending = retry
+
+    return created
+
+def bulk_update(endpoint, payloads, kind, labels=None):
+    if labels is None:
+        labels = [None] * len(payloads)
+    wanted = list()
+    for payload, label in zip(payloads, labels):
+        if PLAN is not None and label is not None and not PLAN.pending(kind, label):
+            METRICS.skip()
+        elif JOURNAL is not None and JOURNAL.done('update', kind, label):
+            log_skip(f"{kind} {label} was updated by the interrupted load, skipping")
+        else:
+            wanted.append((payload, label))
+    batches = list(chunked(wanted, BATCH_SIZE))
+    results = BACKEND.send(endpoint, 'patch', [[payload for payload, label in batch]
+                                               for batch in batches])
+    failure = None
+    for batch, (records, E) in zip(batches, results):
+        if E is not None:
+            failure = failure or E
+            continue
+        if JOURNAL is not None:
+            JOURNAL.record('update', kind, [label for payload, label in batch],
+                           [payload['id'] for payload, label in batch])
+        log(f"Updating {len(batch)} {kind}(s)...done")
+    if failure is not None:
+        raise failure
+
+def bulk_delete(endpoint, ids, kind):
+    batches = list(chunked([{'id': obj_id} for obj_id in ids], BATCH_SIZE))
+    for batch, (records, E) in zip(batches, BACKEND.send(endpoint, 'delete', batches)):
+        if E is not None:
+            raise E
+        log(f"Deleting {len(batch)} {kind}(s)...done")
+
+class RefResolver:
+    # Maps the objects ls_data refers to by name (sites, roles, device types,
+    # VRFs, VLANs, tags, ASNs, devices) to their NetBox ids, so payloads can
+    # carry plain ids instead of nested {'name': ...} references that NetBox
+    # has to resolve on every write.  A VLAN's vid is only unique within its
+    # site or group, so VLANs are keyed on (name, vid) like the baseline's
+    # vlans.get(name=..., vid=...).
+    KINDS = {
+        'sites': ('dcim', 'sites', 'name'),
+        'roles': ('dcim', 'device_roles', 'name'),
+        'manufacturers': ('dcim', 'manufacturers', 'name'),
+        'device_types': ('dcim', 'device_types', 'model'),
+        'devices': ('dcim', 'devices', 'name'),
+        'tags': ('extras', 'tags', 'name'),
+        'rirs': ('ipam', 'rirs', 'name'),
+        'vrfs': ('ipam', 'vrfs', 'name'),
+        'vlans': ('ipam', 'vlans', ('name', 'vid')),
+        'asns': ('ipam', 'asns', 'asn'),
+    }
+
+    def __init__(self, nb):
+        self.nb = nb
+        self.ids = {kind: dict() for kind in self.KINDS}
+        self.lock = threading.RLock()
+
+    def endpoint(self, kind):
+        app, name, field = self.KINDS[kind]
+        return getattr(getattr(self.nb, app), name)
+
+    def key(self, kind, record):
+        field = self.KINDS[kind][2]
+        if isinstance(field, tuple):
+            return tuple(getattr(record, name) for name in field)
+        return getattr(record, field)
+
+    def register(self, kind, keys, records=()):
+        # Record the ids of freshly created objects, then look up whichever
+        # of keys are still unknown with one filtered read per batch.  Keys
+        # of several fields are looked up by their last one (a VLAN's vid)
+        # and records that don't match the whole key are ignored.
+        field = self.KINDS[kind][2]
+        with self.lock:
+            for record in records:
+                if record is not None:
+                    self.ids[kind][self.key(kind, record)] = record.id
+
+            missing = [key for key in dict.fromkeys(keys) if key not in self.ids[kind]]
+            if isinstance(field, tuple):
+                wanted = set(missing)
+                for record in bulk_filter(self.endpoint(kind), field[-1],
+                                          list(dict.fromkeys(key[-1] for key in missing))):
+                    if self.key(kind, record) in wanted:
+                        self.ids[kind][self.key(kind, record)] = record.id
+                return
+            for record in bulk_filter(self.endpoint(kind), field, missing):
+                self.ids[kind][getattr(record, field)] = record.id
+
+    def prefetch(self, ls_data):
+        self.register('sites', [site['name'] for site in ls_data['sites']])
+        self.register('roles', [role['name'] for role in ls_data['roles']])
+        self.register('manufacturers', [m['name'] for m in ls_data['manufacturers']])
+        self.register('device_types', [dt['model'] for dt in ls_data['device_types']])
+        self.register('devices', [name for device in ls_data['devices'].values()
+                                  for name in device_names(device)])
+        self.register('tags', [tag['name'] for tag in ls_data['tags']])
+        self.register('rirs', [ls_data['rir']['name']])
+        self.register('vrfs', [vrf['name'] for vrf in ls_data['vrfs']])
+        self.register('vlans', [vlan_key(vlan) for vlan in ls_data['vlans']])
+        leaf_asn = ls_data['asns']['leaf']['range_start']
+        self.register('asns', [ls_data['asns']['spine']['asn']] +
+                      list(range(leaf_asn, leaf_asn + ls_data['devices']['leafs']['qty'])))
+
+    def get(self, kind, key):
+        if key not in self.ids[kind]:
+            self.register(kind, [key])
+        return self.ids[kind].get(key)
+
+    def id(self, kind, key):
+        obj_id = self.get(kind, key)
+        if obj_id is None:
+            raise KeyError(f"{kind} '{key}' not found in Netbox")
+        return obj_id
+
+    def ref(self, kind, ref):
+        return self.id(kind, ref[self.KINDS[kind][2]])
+
+def vlan_key(vlan):
+    return (vlan['name'], vlan['vid'])
+
+def vlan_keys(ls_data):
+    # Trunks list their VLANs by vid, which is unique within a data file.
+    return {vlan['vid']: vlan_key(vlan) for vlan in ls_data['vlans']}
+
+class IdCache:
+    # SQLite copy of the resolver's ids, kept between runs so a load against
+    # a NetBox that hardly changed doesn't look every name up again.  It
+    # remembers the newest object change it has seen.  The next run reads
+    # the change log from there and drops the ids of objects that were
+    # updated (their name may have changed) or deleted since.  Updates the
+    # last run made itself are recognised by their request id and skipped.
+    # If the log no longer reaches back that far, or reading it would take
+    # more requests than looking the names up again, the cache starts over.
+    CONTENT_TYPES = {
+        'dcim.site': 'sites',
+        'dcim.devicerole': 'roles',
+        'dcim.manufacturer': 'manufacturers',
+        'dcim.devicetype': 'device_types',
+        'dcim.device': 'devices',
+        'extras.tag': 'tags',
+        'ipam.rir': 'rirs',
+        'ipam.vrf': 'vrfs',
+        'ipam.vlan': 'vlans',
+        'ipam.asn': 'asns',
+    }
+
+    def __init__(self, path, url):
+        self.path = path
+        self.url = url
+        self.change = None
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS ids "
+                        "(kind TEXT, key, id INTEGER, PRIMARY KEY (kind, key))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS requests (id TEXT PRIMARY KEY)")
+
+    def meta(self, name):
+        row = self.db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row and row[0]
+
+    def sync(self, nb, refs):
+        ids = {kind: dict() for kind in refs.KINDS}
+        if self.meta('url') == self.url and self.meta('change_id') is not None:
+            for kind, key, obj_id in self.db.execute("SELECT kind, key, id FROM ids"):
+                if kind == 'vlans':
+                    # Saved as JSON; caches from before VLANs were keyed on
+                    # (name, vid) hold plain vids, which are dropped.
+                    key = json.loads(key) if isinstance(key, str) else None
+                    if not isinstance(key, list):
+                        continue
+                    key = tuple(key)
+                if kind in ids:
+                    ids[kind][key] = obj_id
+        cached = sum(len(kind_ids) for kind_ids in ids.values())
+
+        if not cached:
+            # Only the starting point is needed: the newest change, or the
+            # start of an empty log.
+            self.change = (0, None)
+            for change in nb.extras.object_changes.filter(limit=1, offset=0).response:
+                self.change = (change['id'], change['time'])
+            return
+
+        last_id = self.meta('change_id')
+        self.change = (last_id, self.meta('change_time'))
+        filters = {'time_after': self.change[1]} if last_id else {}
+        own = {row[0] for row in self.db.execute("SELECT id FROM requests")}
+        stale = {kind: set() for kind in ids}
+        reached = not last_id
+        # Changes come in pages of 1000, lookups one kind and batch at a time.
+        max_changes = 1000 * (len(self.CONTENT_TYPES) + cached // BATCH_SIZE)
+        changes = 0
+        for i, change in enumerate(nb.extras.object_changes.filter(limit=1000,
+                                                                   **filters).response):
+            if i == 0:
+                self.change = (change['id'], change['time'])
+            if change['id'] <= last_id:
+                reached = reached or change['id'] == last_id
+                continue
+            changes += 1
+            if changes > max_changes:
+                log(f"More than {max_changes} changes since the last sync of {self.path}, "
+                    f"looking up every name again")
+                return
+            kind = self.CONTENT_TYPES.get(change['changed_object_type'])
+            action = change['action']['value']
+            # The last run's own updates leave its ids valid; its deletes
+            # (--teardown) don't.
+            if action == 'update' and change.get('request_id') in own:
+                continue
+            if kind is not None and action != 'create':
+                stale[kind].add(change['changed_object_id'])
+
+        if not reached:
+            log(f"The change log doesn't reach back to the last sync of {self.path}, "
+                f"looking up every name again")
+            return
+        dropped = 0
+        for kind, kind_ids in ids.items():
+            kind_ids = {key: obj_id for key, obj_id in kind_ids.items()
+                        if obj_id not in stale[kind]}
+            dropped += len(ids[kind]) - len(kind_ids)
+            refs.ids[kind].update(kind_ids)
+        log(f"Using {cached - dropped} cached id(s) from {self.path}, {dropped} invalidated by "
+            f"{changes} change(s) since the last sync")
+
+    def save(self, refs):
+        with self.db:
+            self.db.execute("DELETE FROM ids")
+            self.db.executemany("INSERT INTO ids VALUES (?, ?, ?)",
+                                [(kind, json.dumps(key) if isinstance(key, tuple) else key,
+                                  obj_id) for kind, kind_ids in refs.ids.items()
+                                 for key, obj_id in kind_ids.items()])
+            self.db.execute("DELETE FROM meta")
+            self.db.execute("DELETE FROM requests")
+            if self.change is not None:
+                self.db.executemany("INSERT INTO meta VALUES (?, ?)",
+                                    [('url', self.url), ('change_id', self.change[0]),
+                                     ('change_time', self.change[1])])
+                self.db.executemany("INSERT INTO requests VALUES (?)",
+                                    [(request_id,) for request_id in REQUEST_IDS])
+
+    def close(self):
+        self.db.close()
+
+def device_names(device):
+    return [f"{device['prefix']}{i:02d}" for i in range(1, device['qty'] + 1)]
+
+def parse_ls_data(data):
+    return yaml.load(data, Loader=YamlLoader)
+
+# The keys the loader reads from a data file and their types.  A list holds
+# the schema of its items; keys ending in '?' are optional and a '*' key
+# holds the schema of every other key of its mapping.  Other keys are
+# allowed and ignored.
+NAMED = {'name': str}
+DEVICES = {'device_role': NAMED, 'device_type': {'model': str}, 'prefix': str, 'qty': int,
+           'site': NAMED}
+LS_SCHEMA = {
+    'sites': [{'name': str, 'slug': str}],
+    'roles': [{'name': str, 'slug': str}],
+    'manufacturers': [{'name': str, 'slug': str}],
+    'device_types': [{'model': str, 'slug': str, 'manufacturer': NAMED, 'interface_qty': int,
+                      'interface_prefix': str}],
+    'devices': {'spines': DEVICES, 'leafs': DEVICES, '*': DEVICES},
+    'transit_prefix': {'prefix': str, 'site': NAMED},
+    'loopback_prefix': {'prefix': str, 'site': NAMED},
+    'rir': {'name': str, 'slug': str},
+    'asns': {'leaf': {'range_start': int, 'sameasn?': bool}, 'spine': {'asn': int}},
+    'tags': [{'name': str, 'slug': str}],
+    'vlans': [{'name': str, 'vid': int, 'vni?': int,
+               'svi?': {'vrf': str, 'ip?': str, 'anycast-gateway?': bool, 'vrf-svi?': bool}}],
+    'vrfs': [{'name': str, 'vni?': int}],
+    'statics?': [{'prefix': str, 'nexthop': str, 'vrf': str, 'origindevice': str}],
+    'ext_interfaces?': [{'device': str, 'interface': str, 'ip': str, 'vrf': str}],
+    'trunk_interfaces?': [{'device': str, 'interface': str, 'vlans': [int]}],
+}
+
+def check_shape(value, schema, path, errors):
+    if isinstance(schema, list):
+        if not isinstance(value, list):
+            errors.append(f"{path}: expected a list")
+            return
+        if isinstance(schema[0], type):
+            # Lists of scalars (trunk VLANs) are checked without recursing.
+            value = [(i, item) for i, item in enumerate(value) if type(item) is not schema[0]]
+        else:
+            value = enumerate(value)
+        for i, item in value:
+            check_shape(item, schema[0], f"{path}[{i}]", errors)
+    elif isinstance(schema, dict):
+        if not isinstance(value, dict):
+            errors.append(f"{path or 'document'}: expected a mapping")
+            return
+        for key, subschema in schema.items():
+            if key == '*':
+                for name in value:
+                    if name not in schema and f"{name}?" not in schema:
+                        check_shape(value[name], subschema,
+                                    f"{path}.{name}" if path else str(name), errors)
+                continue
+            name = key.rstrip('?')
+            if value.get(name) is not None:
+                check_shape(value[name], subschema, f"{path}.{name}" if path else name, errors)
+            elif not key.endswith('?'):
+                errors.append(f"{path or 'document'}: missing {name}")
+    elif not isinstance(value, schema) or isinstance(value, bool) and schema is not bool:
+        errors.append(f"{path}: expected {schema.__name__}, got {value!r}")
+
+def check_ls_data(ls_data):
+    # Validate a data file before anything is sent: the shape of every
+    # section, then the references between sections and the sizes the
+    # fabric needs.  Returns a list of errors, empty if the file is good.
+    errors = list()
+    check_shape(ls_data, LS_SCHEMA, '', errors)
+    if errors:
+        return errors
+
+    def unique(section, field):
+        keys = Counter(item[field] for item in ls_data.get(section) or [])
+        for key, count in keys.items():
+            if count > 1:
+                errors.append(f"{section}: {field} {key} is listed more than once")
+        return set(keys)
+
+    def network(path, value, strict=True):
+        try:
+            if strict:
+                return ipaddress.ip_network(value)
+            return ipaddress.ip_interface(value)
+        except ValueError as E:
+            errors.append(f"{path}: {E}")
+
+    sites = unique('sites', 'name')
+    roles = unique('roles', 'name')
+    manufacturers = unique('manufacturers', 'name')
+    device_types = {dt['model']: dt for dt in ls_data['device_types']}
+    unique('device_types', 'model')
+    tags = unique('tags', 'name')
+    vrfs = unique('vrfs', 'name')
+    vids = unique('vlans', 'vid')
+
+    for i, dt in enumerate(ls_data['device_types']):
+        if dt['manufacturer']['name'] not in manufacturers:
+            errors.append(f"device_types[{i}].manufacturer: unknown manufacturer "
+                          f"{dt['manufacturer']['name']}")
+        if not dt['interface_prefix'].lower().startswith('ethernet'):
+            errors.append(f"device_types[{i}].interface_prefix: {dt['interface_prefix']} "
+                          f"doesn't name Ethernet interfaces")
+
+    devices = dict()
+    spines = ls_data['devices']['spines']['qty']
+    leafs = ls_data['devices']['leafs']['qty']
+    for role, device in ls_data['devices'].items():
+        path = f"devices.{role}"
+        for field, known in (('device_role', roles), ('site', sites)):
+            if device[field]['name'] not in known:
+                errors.append(f"{path}.{field}: unknown {field.replace('device_', '')} "
+                              f"{device[field]['name']}")
+        dt = device_types.get(device['device_type']['model'])
+        if dt is None:
+            errors.append(f"{path}.device_type: unknown device type "
+                          f"{device['device_type']['model']}")
+        elif role in ('spines', 'leafs'):
+            # Every spine links to every leaf, one port per link.
+            ports = leafs if role == 'spines' else spines
+            if dt['interface_qty'] < ports:
+                errors.append(f"{path}: {dt['model']} has {dt['interface_qty']} interface(s), "
+                              f"{role} need {ports}")
+        if device['qty'] < 1:
+            errors.append(f"{path}.qty: need at least one device")
+        for name in device_names(device):
+            devices[name] = dt
+
+    # create_loopback_prefix() reserves the first /32 of a new loopback
+    # container, and an existing one was created with it reserved.
+    for section, count, prefixlen in (('transit_prefix', spines * leafs, 31),
+                                      ('loopback_prefix', spines + leafs + 1, 32)):
+        if ls_data[section]['site']['name'] not in sites:
+            errors.append(f"{section}.site: unknown site {ls_data[section]['site']['name']}")
+        prefix = network(f"{section}.prefix", ls_data[section]['prefix'])
+        if prefix is not None and prefix.prefixlen <= prefixlen and \
+                2 ** (prefixlen - prefix.prefixlen) < count:
+            errors.append(f"{section}.prefix: {prefix} has room for "
+                          f"{2 ** (prefixlen - prefix.prefixlen)} /{prefixlen}(s), "
+                          f"the fabric needs {count}" +
+                          (" (one reserved)" if section == 'loopback_prefix' else ""))
 
-def create_intf_templates(nb, ls_data):
+    leaf_asn = ls_data['asns']['leaf']['range_start']
+    if leaf_asn + leafs - 1 > 4294967295:
+        errors.append(f"asns.leaf.range_start: leaf ASN range ends at {leaf_asn + leafs - 1}, "
+                      f"past 4294967295")
+
+    for i, vlan in enumerate(ls_data['vlans']):
+        svi = vlan.get('svi')
+        if not svi:
+            continue
+        if svi['vrf'] not in vrfs:
+            errors.append(f"vlans[{i}].svi.vrf: unknown VRF {svi['vrf']}")
+        if svi.get('ip'):
+            network(f"vlans[{i}].svi.ip", svi['ip'], strict=False)
+        for tag in ('anycast-gateway', 'vrf-svi'):
+            if svi.get(tag) and tag not in tags:
+                errors.append(f"vlans[{i}].svi.{tag}: tag {tag} isn't in tags")
+
+    for i, route in enumerate(ls_data.get('statics') or []):
+        network(f"statics[{i}].prefix", route['prefix'])
+        if route['vrf'] not in vrfs:
+            errors.append(f"statics[{i}].vrf: unknown VRF {route['vrf']}")
+        if route['origindevice'] not in devices:
+            errors.append(f"statics[{i}].origindevice: unknown device {route['origindevice']}")
+
+    for i, ext_intf in enumerate(ls_data.get('ext_interfaces') or []):
+        network(f"ext_interfaces[{i}].ip", ext_intf['ip'], strict=False)
+        if ext_intf['vrf'] not in vrfs:
+            errors.append(f"ext_interfaces[{i}].vrf: unknown VRF {ext_intf['vrf']}")
+        if ext_intf['device'] not in devices:
+            errors.append(f"ext_interfaces[{i}].device: unknown device {ext_intf['device']}")
+
+    interfaces = {model: {f"{dt['interface_prefix']}{n}" for n in range(1, dt['interface_qty'] + 1)}
+                  for model, dt in device_types.items()}
+    for i, trunk_intf in enumerate(ls_data.get('trunk_interfaces') or []):
+        dt = devices.get(trunk_intf['device'])
+        if trunk_intf['device'] not in devices:
+            errors.append(f"trunk_interfaces[{i}].device: unknown device {trunk_intf['device']}")
+        elif dt is not None and trunk_intf['interface'] not in interfaces[dt['model']]:
+            errors.append(f"trunk_interfaces[{i}].interface: {trunk_intf['device']} has no "
+                          f"interface {trunk_intf['interface']}")
+        for vid in trunk_intf['vlans']:
+            if vid not in vids:
+                errors.append(f"trunk_interfaces[{i}].vlans: unknown VLAN {vid}")
+
+    return errors
+
+def exit_if_invalid(parser, path, ls_data):
+    # Stop before anything is sent; long lists are cut at 20 errors.
+    errors = check_ls_data(ls_data)
+    if errors:
+        if len(errors) > 20:
+            errors[20:] = [f"... and {len(errors) - 20} more"]
+        parser.error(f"{path} is not valid:\n  " + "\n  ".join(errors))
+
+def create_sites(nb, ls_data, refs):
+    created = bulk_create(nb.dcim.sites,
+                          [{'name': site['name'], 'slug': site['slug']} for site in ls_data['sites']],
+                          [site['name'] for site in ls_data['sites']],
+                          'site', skip_error="name already exists")
+    refs.register('sites', [site['name'] for site in ls_data['sites']], created)
+
+def create_roles(nb, ls_data, refs):
+    created = bulk_create(nb.dcim.device_roles,
+                          [{'name': role['name'], 'slug': role['slug']} for role in ls_data['roles']],
+                          [role['name'] for role in ls_data['roles']],
+                          'role', skip_error="name already exists")
+    refs.register('roles', [role['name'] for role in ls_data['roles']], created)
+
+def create_manufacturers(nb, ls_data, refs):
+    created = bulk_create(nb.dcim.manufacturers,
+                          [{'name': manufacturer['name'], 'slug': manufacturer['slug']}
+                           for manufacturer in ls_data['manufacturers']],
+                          [manufacturer['name'] for manufacturer in ls_data['manufacturers']],
+                          'manufacturer', skip_error="name already exists")
+    refs.register('manufacturers', [m['name'] for m in ls_data['manufacturers']], created)
+
+def create_devicetypes(nb, ls_data, refs):
+    created = bulk_create(nb.dcim.device_types,
+                          [{'model': devicetype['model'],
+                            'manufacturer': refs.ref('manufacturers', devicetype['manufacturer']),
+                            'slug': devicetype['slug']} for devicetype in ls_data['device_types']],
+                          [devicetype['model'] for devicetype in ls_data['device_types']],
+                          'device type', skip_error="must make a unique set")
+    refs.register('device_types', [dt['model'] for dt in ls_data['device_types']], created)
+
+def create_intf_templates(nb, ls_data, refs):
+    payloads = list()
+    labels = list()
     for devicetype in ls_data['device_types']:
-        print("Adding interface templates to device type...", end='')
         for i in range(1, devicetype['interface_qty'] + 1):
-            try:
-                nb.dcim.interface_templates.create(name=f"{devicetype['interface_prefix']}{i}",
-                                                   device_type={'model': devicetype['model']},
-                                                   type='1000base-t')
-            except pynetbox.core.query.RequestError as E:
-                if E.error.find("must make a unique set") != -1:
-                    print(f"interface {devicetype['interface_prefix']}{i} already exists, skipping")
-                    continue
-                else:
-                    raise
-        print("done")
+            payloads.append({'name': f"{devicetype['interface_prefix']}{i}",
+                             'device_type': refs.id('device_types', devicetype['model']),
+                             'type': '1000base-t'})
+            labels.append(f"{devicetype['model']} {devicetype['interface_prefix']}{i}")
 
-def create_tags(nb, ls_data):
-    for tag in ls_data['tags']:
-        print(f"Adding tag {tag['name']}...", end='')
-        try:
-            nb.extras.tags.create(**tag)
-            print("done")
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("already exists") != -1:
-                print(f"tag {tag['name']} already exists, skipping")
-                continue
-            else:
-                raise
+    bulk_create(nb.dcim.interface_templates, payloads, labels,
+                'interface template', skip_error="must make a unique set")
 
-def create_devices(nb, ls_data):
+def create_tags(nb, ls_data, refs):
+    created = bulk_create(nb.extras.tags, ls_data['tags'],
+                          [tag['name'] for tag in ls_data['tags']], 'tag')
+    refs.register('tags', [tag['name'] for tag in ls_data['tags']], created)
+
+def create_devices(nb, ls_data, refs):
     created_devices = dict()
     for role, device in ls_data['devices'].items():
-        created_devices[role] = list()
-        for i in range(1, device['qty'] + 1):
-            devicename = f"{device['prefix']}{i:02d}"
-            try:
-                print(f"Creating device '{devicename}'...", end='')
-                created_devices[role].append(nb.dcim.devices.create(
-                                                name=devicename,
-                                                device_role=device['device_role'],
-                                                device_type=device['device_type'],
-                                                site=device['site'])
-                                             )
-                print("done")
-
-            except pynetbox.core.query.RequestError as E:
-                if E.error.find("name already exists") != -1:
-                    print("device already exists, skipping")
-                    existing_device = nb.dcim.devices.get(name=devicename)
-                    created_devices[role].append(existing_device)
-                    continue
-                else:
-                    raise
+        devicenames = device_names(device)
+        wanted = [name for name in devicenames if in_scope(name)]
+        created = bulk_create(nb.dcim.devices,
+                              [{'name': devicename,
+                                'device_role': refs.ref('roles', device['device_role']),
+                                'device_type': refs.ref('device_types', device['device_type']),
+                                'site': refs.ref('sites', device['site'])}
+                               for devicename in wanted],
+                              wanted, 'device', skip_error="name already exists")
+
+        handles = {record.name: Device(record.id, record.name, record.site.id)
+                   for record in created if record is not None}
+        existing = [name for name in devicenames if name not in handles]
+        handles.update((d['name'], Device(d['id'], d['name'], d['site']['id']))
+                       for d in raw_filter(nb.dcim.devices, 'name', existing))
+        devices = [handles[name] for name in devicenames]
+
+        refs.register('devices', devicenames, devices)
+        created_devices[role] = devices
 
     return created_devices
 
-def create_connections(nb, ls_devices):
-    i = 1
-    for spinedev in ls_devices['spines']:
-        j = 1
-        spinename = spinedev.name
-        spineIntfPrefix = get_intf_prefix(nb, spinedev)
-        for leafdev in ls_devices['leafs']:
-            leafname = leafdev.name
-            leafIntfPrefix = get_intf_prefix(nb, spinedev)
-            spineintf = f"{spineIntfPrefix}{j}"
-            leafintf = f"{leafIntfPrefix}{i}"
-            try:
-                print(f"Creating connection between {spinename} {spineintf} "
-                      f"and {leafname} {leafintf}...", end='')
-                nb.dcim.cables.create(
-                    a_terminations = [
-                        {
-                            'object_type': 'dcim.interface',
-                            'object_id': nb.dcim.interfaces.get(name=spineintf,
-                                                                device=spinename).id
-                        }
-                    ],
-                    b_terminations = [
-                        {
-                            'object_type': 'dcim.interface',
-                            'object_id': nb.dcim.interfaces.get(name=leafintf,
-                                                                device=leafname).id
-                        }
-                    ]
-
-                )
-                print("done")
-
-            except pynetbox.core.query.RequestError:
-                print("connection already exists, skipping")
-                j += 1
+def spine_leaf_links(spinenames, leafnames, intf_prefix):
+    # Spine i port j connects to leaf j port i.  Links outside the scope of
+    # an incremental load are left out.
+    links = list()
+    for i, spinename in enumerate(spinenames, 1):
+        for j, leafname in enumerate(leafnames, 1):
+            if not in_scope(spinename, leafname):
                 continue
-
-            j += 1
-        i += 1
-
-
-def create_transit_prefix(nb, ls_data):
-    print(f"Creating transit prefix {ls_data['transit_prefix']['prefix']}...", end='')
+            links.append((spinename, f"{intf_prefix(spinename)}{j}",
+                          leafname, f"{intf_prefix(leafname)}{i}"))
+    return links
+
+def link_label(link):
+    spinename, spineintf, leafname, leafintf = link
+    return f"between {spinename} {spineintf} and {leafname} {leafintf}"
+
+def create_connections(nb, ls_devices, intf_index):
+    payloads = list()
+    labels = list()
+    for link in spine_leaf_links([d.name for d in ls_devices['spines']],
+                                 [d.name for d in ls_devices['leafs']], intf_index.intf_prefix):
+        spinename, spineintf, leafname, leafintf = link
+        payloads.append({
+            'a_terminations': [
+                {
+                    'object_type': 'dcim.interface',
+                    'object_id': intf_index.get(spinename, spineintf).id
+                }
+            ],
+            'b_terminations': [
+                {
+                    'object_type': 'dcim.interface',
+                    'object_id': intf_index.get(leafname, leafintf).id
+                }
+            ]
+        })
+        labels.append(link_label(link))
+
+    bulk_create(nb.dcim.cables, payloads, labels, 'connection', skip_error=None)
+
+def create_transit_prefix(nb, ls_data, refs):
     transit_prefix = nb.ipam.prefixes.get(prefix=ls_data['transit_prefix']['prefix'])
     if transit_prefix:
-        print("prefix already exists, skipping")
+        log_skip(f"Transit prefix {ls_data['transit_prefix']['prefix']} already exists, skipping")
     else:
         transit_prefix = nb.ipam.prefixes.create(prefix=ls_data['transit_prefix']['prefix'],
-                                                 site=ls_data['transit_prefix']['site'],
+                                                 site=refs.ref('sites', ls_data['transit_prefix']['site']),
                                                  status='container')
-        print("done")
+        log(f"Creating transit prefix {ls_data['transit_prefix']['prefix']}...done")
 
     return transit_prefix
 
-def create_loopback_prefix(nb, ls_data):
-    print(f"Creating loopback prefix {ls_data['loopback_prefix']['prefix']}...", end='')
+def create_loopback_prefix(nb, ls_data, refs):
     loopback_prefix = nb.ipam.prefixes.get(prefix=ls_data['loopback_prefix']['prefix'])
     if loopback_prefix:
-        print("prefix already exists, skipping")
+        log_skip(f"Loopback prefix {ls_data['loopback_prefix']['prefix']} already exists, skipping")
     else:
         loopback_prefix = nb.ipam.prefixes.create(prefix=ls_data['loopback_prefix']['prefix'],
-                                                  site=ls_data['loopback_prefix']['site'],
+                                                  site=refs.ref('sites', ls_data['loopback_prefix']['site']),
                                                   status='container')
         loopback_s32 = loopback_prefix.available_prefixes.create({'prefix_length': 32})
         loopback_s32.available_ips.create({'description': 'RESERVED'})
-
-        print("done")
+        log(f"Creating loopback prefix {ls_data['loopback_prefix']['prefix']}...done")
 
     return loopback_prefix
 
-def create_rir_asn(nb, ls_data, ls_devices):
-    try:
-        print(f"Creating RIR {ls_data['rir']['name']}...", end='')
-        rir = nb.ipam.rirs.create(**ls_data['rir'])
-        print("done")
-
-    except pynetbox.core.query.RequestError as E:
-        if E.error.find("name already exists") != -1:
-            print("RIR already exists, skipping")
-            rir = nb.ipam.rirs.get(name=ls_data['rir']['name'])
-        else:
-            raise
-
-    try:
-        print(f"Creating Spine ASN {ls_data['asns']['spine']['asn']}...", end='')
-        spine_asn = nb.ipam.asns.create(asn=ls_data['asns']['spine']['asn'],
-                                        rir=rir.id, description='Spine ASN')
-        print("done")
-
-    except pynetbox.core.query.RequestError as E:
-        if E.error.find("ASN already exists") != -1:
-            print("ASN already exists, skipping")
-            spine_asn = nb.ipam.asns.get(asn=ls_data['asns']['spine']['asn'])
-        else:
-            raise
+def create_rir_asn(nb, ls_data, ls_devices, refs):
+    if ls_data['rir']['name'] not in refs.ids['rirs']:
+        created = bulk_create(nb.ipam.rirs, [ls_data['rir']], [ls_data['rir']['name']], 'RIR',
+                              skip_error="name already exists")
+        refs.register('rirs', [ls_data['rir']['name']], created)
+    else:
+        log_skip(f"RIR {ls_data['rir']['name']} already exists, skipping")
+    rir = refs.id('rirs', ls_data['rir']['name'])
 
     leaf_asn = ls_data['asns']['leaf']['range_start']
-    leaf_asn_mapping = dict()
+    leafs = ls_devices['leafs']
     if ls_data['asns']['leaf'].get('sameasn'):
-        try:
-            print(f"Creating Leaf ASN {leaf_asn}...", end='')
-            nb_leaf_asn = nb.ipam.asns.create(asn=leaf_asn,
-                                              rir=rir.id, description=f'Leaf ASN')
-            print("done")
-
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("ASN already exists") != -1:
-                print("ASN already exists, skipping")
-                nb_leaf_asn = nb.ipam.asns.get(asn=leaf_asn)
-            else:
-                raise
-        
-        for leaf in ls_devices['leafs']:
-            leaf_asn_mapping[leaf.name] = nb_leaf_asn
-        
-        return spine_asn, leaf_asn_mapping
-
-    for leaf in ls_devices['leafs']:
-        try:
-            print(f"Creating Leaf {leaf.name} ASN {leaf_asn}...", end='')
-            created_leaf_asn = nb.ipam.asns.create(asn=leaf_asn,
-                                                   rir=rir.id, description=f'Leaf {leaf.name} ASN')
-            leaf_asn_mapping[leaf.name] = created_leaf_asn
-            print("done")
-
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("ASN already exists") != -1:
-                print("ASN already exists, skipping")
-                leaf_asn_mapping[leaf.name] = nb.ipam.asns.get(asn=leaf_asn)
-                leaf_asn += 1
-                continue
-            else:
-                raise
-
-        leaf_asn += 1
+        leaf_asns = [leaf_asn] * len(leafs)
+        asns = [(leaf_asn, 'Leaf ASN')]
+    else:
+        leaf_asns = [leaf_asn + i for i in range(len(leafs))]
+        asns = [(asn, f'Leaf {leaf.name} ASN') for leaf, asn in zip(leafs, leaf_asns)
+                if in_scope(leaf.name)]
+    asns.insert(0, (ls_data['asns']['spine']['asn'], 'Spine ASN'))
+    asns = list(dict(reversed(asns)).items())[::-1]
+
+    missing = [(asn, description) for asn, description in asns if refs.get('asns', asn) is None]
+    for asn, description in asns:
+        if refs.get('asns', asn) is not None:
+            log_skip(f"ASN {asn} already exists, skipping")
+    created = bulk_create(nb.ipam.asns,
+                          [{'asn': asn, 'rir': rir, 'description': description}
+                           for asn, description in missing],
+                          [f"{asn} ({description})" for asn, description in missing],
+                          'ASN', skip_error="ASN already exists")
+    refs.register('asns', [asn for asn, description in asns], created)
+
+    spine_asn = refs.id('asns', ls_data['asns']['spine']['asn'])
+    leaf_asn_mapping = dict()
+    for leaf, asn in zip(leafs, leaf_asns):
+        if in_scope(leaf.name):
+            leaf_asn_mapping[leaf.name] = refs.id('asns', asn)
 
     return spine_asn, leaf_asn_mapping
 
-def get_intf_prefix(nb, device):
-    ethernetIntfs = nb.dcim.interfaces.filter(device=device.name, name__ic='Ethernet')
-    intfPrefixMatch = re.match(r'Ethernet(\d+\/|(?=\d+))', list(ethernetIntfs)[0].name)
-    if intfPrefixMatch:
-        intfPrefix = intfPrefixMatch.group(0)
-    else:
-        intfPrefix = None
-
-    return intfPrefix
-
-def create_transit_net_ips_bgp_sessions(
-    nb, transit_prefix, ls_devices, spine_asn, leaf_asn_mapping):
-    i = 1
-    for spinedev in ls_devices['spines']:
-        j = 1
-        spinename = spinedev.name
-        spineIntfPrefix = get_intf_prefix(nb, spinedev)
-        for leafdev in ls_devices['leafs']:
-            leafname = leafdev.name
-            leafIntfPrefix = get_intf_prefix(nb, leafdev)
-            spineintfname = f"{spineIntfPrefix}{j}"
-            leafintfname = f"{leafIntfPrefix}{i}"
-
-            spineintf = nb.dcim.interfaces.get(name=spineintfname, device=spinename)
-            leafintf = nb.dcim.interfaces.get(name=leafintfname, device=leafname)
-
-            print(f"Creating transit network and IPs between {spinename} {spineintfname} "
-                  f"and {leafname} {leafintfname}...", end='')
-            if spineintf.count_ipaddresses == 0 and leafintf.count_ipaddresses == 0:
-                tpfx = transit_prefix
-                tnet = tpfx.available_prefixes.create({'prefix_length': 31})
-                spine_ip = tnet.available_ips.create(
-                    {'assigned_object_id': spineintf.id,
-                    'assigned_object_type':'dcim.interface'})
-                leaf_ip = tnet.available_ips.create(
-                    {'assigned_object_id': leafintf.id,
-                    'assigned_object_type':'dcim.interface'})
-                print("done")
+class Device:
+    # What the stages after create_devices() use of a device.  Kept instead
+    # of the pynetbox Record so tens of thousands of devices stay small.
+    __slots__ = ('id', 'name', 'site_id')
+
+    def __init__(self, id, name, site_id):
+        self.id = id
+        self.name = name
+        self.site_id = site_id
+
+class Interface:
+    # What the link and plan stages use of an interface; ips holds the ids
+    # of the IP addresses assigned to it.
+    __slots__ = ('id', 'count_ipaddresses', 'cable', 'tags', 'mode', 'tagged_vlans', 'ips')
+
+    def __init__(self, id, count_ipaddresses=0, cable=False, tags=(), mode=None,
+                 tagged_vlans=()):
+        self.id = id
+        self.count_ipaddresses = count_ipaddresses
+        self.cable = cable
+        self.tags = tags
+        self.mode = mode
+        self.tagged_vlans = tagged_vlans
+        self.ips = list()
+
+class InterfaceIndex:
+    # Local view of the interfaces and assigned IPs of a set of devices,
+    # keyed by (device name, interface name).  It is filled by a handful of
+    # paginated bulk reads so the per-link stages don't have to GET every
+    # interface and IP one by one.
+    def __init__(self, nb, ls_devices):
+        self.interfaces = dict()
+        self.device_intfs = dict()
+        by_id = dict()
+        devices = scoped_devices(ls_devices)
+        device_ids = [device.id for device in devices]
+        for intf in raw_filter(nb.dcim.interfaces, 'device_id', device_ids):
+            entry = Interface(intf['id'], intf['count_ipaddresses'], intf['cable'] is not None,
+                              [tag['id'] for tag in intf['tags']],
+                              intf['mode'] and intf['mode']['value'],
+                              [vlan['id'] for vlan in intf['tagged_vlans'] or []])
+            device = intf['device']['name']
+            self.interfaces[(device, intf['name'])] = entry
+            self.device_intfs.setdefault(device, list()).append(intf['name'])
+            by_id[intf['id']] = entry
+
+        for ip in raw_filter(nb.ipam.ip_addresses, 'device_id', device_ids):
+            if ip['assigned_object_id'] in by_id:
+                by_id[ip['assigned_object_id']].ips.append(ip['id'])
+
+    def get(self, device, name):
+        return self.interfaces[(device, name)]
+
+    def add_ip(self, device, name, ip):
+        entry = self.interfaces[(device, name)]
+        entry.ips.append(ip.id)
+        entry.count_ipaddresses += 1
+
+    def intf_prefix(self, device):
+        ethernetIntfs = [name for name in self.device_intfs.get(device, [])
+                         if 'ethernet' in name.lower()]
+        intfPrefixMatch = re.match(r'Ethernet(\d+\/|(?=\d+))', ethernetIntfs[0])
+        if intfPrefixMatch:
+            intfPrefix = intfPrefixMatch.group(0)
+        else:
+            intfPrefix = None
+
+        return intfPrefix
+
+class PrefixAllocator:
+    # Hands out free subnets of a container prefix locally.  The existing
+    # child prefixes are read once and the free space is kept as a sorted
+    # list of networks, so allocations don't need an available-prefixes call
+    # (and its server-side lock) per object.  Like NetBox, the lowest free
+    # subnet of the requested size is returned first.  When resuming, the
+    # subnets an interrupted load created (as prefix_kind) but didn't assign
+    # an IP (ip_kind) to yet are handed out again, in the same order.
+    def __init__(self, nb, container, prefix_kind=None, ip_kind=None):
+        self.network = ipaddress.ip_network(container.prefix)
+        self.free = [self.network]
+        for child in nb.ipam.prefixes.filter(within=container.prefix):
+            network = ipaddress.ip_network(child.prefix)
+            if not self.unused(network, prefix_kind, ip_kind):
+                self.reserve(network)
+
+    @staticmethod
+    def unused(network, prefix_kind, ip_kind):
+        if JOURNAL is None or not JOURNAL.done('create', prefix_kind, str(network)):
+            return False
+        return not any(JOURNAL.done('create', ip_kind, f"{address}/{network.prefixlen}")
+                       for address in network)
+
+    def reserve(self, network):
+        free = list()
+        for block in self.free:
+            if block.overlaps(network):
+                if network.subnet_of(block):
+                    free.extend(block.address_exclude(network))
             else:
-                print("IPs already exist, skipping")
-                spine_ip = nb.ipam.ip_addresses.get(device=spinename, interface=spineintfname)
-                leaf_ip = nb.ipam.ip_addresses.get(device=leafname, interface=leafintfname)
+                free.append(block)
+        self.free = sorted(free)
+
+    def allocate(self, prefixlen):
+        for block in self.free:
+            if block.prefixlen <= prefixlen:
+                network = next(block.subnets(new_prefix=prefixlen))
+                self.reserve(network)
+                return network
+
+        raise ValueError(f"No free /{prefixlen} left in {self.network}")
+
+    def allocate_many(self, prefixlen, count):
+        return [self.allocate(prefixlen) for _ in range(count)]
+
+class SharedAllocator:
+    # A PrefixAllocator shared by the processes of a sharded load, kept in
+    # the parent's manager process.  The first shard that needs subnets
+    # reads the container's children; after that every stage takes the
+    # subnets it needs in one locked round trip, so no two shards get the
+    # same one.
+    def __init__(self, nb, container, prefix_kind, ip_kind):
+        self.args = (nb, container, prefix_kind, ip_kind)
+        self.kind = prefix_kind
+
+    def allocate_many(self, prefixlen, count):
+        with SHARD.lock:
+            allocator = SHARD.allocators.get(self.kind) or PrefixAllocator(*self.args)
+            networks = allocator.allocate_many(prefixlen, count)
+            SHARD.allocators[self.kind] = allocator
+        return networks
+
+def prefix_allocator(nb, container, prefix_kind, ip_kind):
+    if SHARD is None:
+        return PrefixAllocator(nb, container, prefix_kind, ip_kind)
+    return SharedAllocator(nb, container, prefix_kind, ip_kind)
+
+def create_transit_net_ips(nb, transit_prefix, ls_devices, intf_index, refs):
+    links = spine_leaf_links([d.name for d in ls_devices['spines']],
+                             [d.name for d in ls_devices['leafs']], intf_index.intf_prefix)
+    new_links = list()
+    tag_updates = list()
+    tag_labels = list()
+    for link in links:
+        spinename, spineintfname, leafname, leafintfname = link
+        spineintf = intf_index.get(spinename, spineintfname)
+        leafintf = intf_index.get(leafname, leafintfname)
+
+        if spineintf.count_ipaddresses == 0 and leafintf.count_ipaddresses == 0:
+            new_links.append(link)
+        else:
+            log_skip(f"Transit IPs {link_label(link)} already exist, skipping")
+
+        tag_updates.append({'id': spineintf.id, 'tags': [refs.get('tags', 'l3base')]})
+        tag_updates.append({'id': leafintf.id, 'tags': [refs.get('tags', 'l3base')]})
+        tag_labels.extend([f"{spineintfname} on {spinename}", f"{leafintfname} on {leafname}"])
+
+    tnets = list()
+    new_ips = list()
+    if new_links:
+        allocator = prefix_allocator(nb, transit_prefix, 'transit network', 'transit IP address')
+        for (spinename, spineintfname, leafname, leafintfname), tnet in zip(
+                new_links, allocator.allocate_many(31, len(new_links))):
+            spine_addr, leaf_addr = tnet
+            tnets.append({'prefix': str(tnet)})
+            new_ips.append({'address': f"{spine_addr}/31",
+                            'assigned_object_id': intf_index.get(spinename, spineintfname).id,
+                            'assigned_object_type': 'dcim.interface'})
+            new_ips.append({'address': f"{leaf_addr}/31",
+                            'assigned_object_id': intf_index.get(leafname, leafintfname).id,
+                            'assigned_object_type': 'dcim.interface'})
+
+    bulk_create(nb.ipam.prefixes, tnets, [p['prefix'] for p in tnets], 'transit network')
+    # Both ends of a link get their address in the same request, so a
+    # failed load can't leave a link half addressed.
+    created = bulk_create(nb.ipam.ip_addresses, new_ips,
+                          [ip['address'] for ip in new_ips], 'transit IP address', group=2)
+    for (spinename, spineintfname, leafname, leafintfname), spine_ip, leaf_ip in zip(
+            new_links, created[0::2], created[1::2]):
+        intf_index.add_ip(spinename, spineintfname, spine_ip)
+        intf_index.add_ip(leafname, leafintfname, leaf_ip)
+
+    if refs.get('tags', 'l3base') is None:
+        log_skip("Tag 'l3base' not found, skipping")
+    else:
+        bulk_update(nb.dcim.interfaces, tag_updates, 'L3 base interface tag', tag_labels)
+
+def create_bgp_sessions(nb, ls_devices, intf_index, spine_asn, leaf_asn_mapping):
+    # Two sessions per link, one from each end.  The sessions that already
+    # exist are read once up front (a plan has read them already), so only
+    # the missing ones are sent and a rerun doesn't POST at all.
+    devices = {device.name: device for ls_device in ls_devices.values() for device in ls_device}
+    links = spine_leaf_links([d.name for d in ls_devices['spines']],
+                             [d.name for d in ls_devices['leafs']], intf_index.intf_prefix)
+    existing = set()
+    if PLAN is None:
+        device_ids = {devices[name].id for link in links for name in (link[0], link[2])}
+        existing = {(session['device']['id'], session['name']) for session in
+                    raw_filter(nb.plugins.bgp.session, 'device_id', device_ids)}
+
+    sessions = list()
+    for spinename, spineintfname, leafname, leafintfname in links:
+        spinedev = devices[spinename]
+        leafdev = devices[leafname]
+        spine_ip = intf_index.get(spinename, spineintfname).ips[0]
+        leaf_ip = intf_index.get(leafname, leafintfname).ips[0]
+        for device, name, local_as, remote_as, local_ip, remote_ip in (
+                (spinedev, f'{spinename}-->{leafname}', spine_asn,
+                 leaf_asn_mapping[leafname], spine_ip, leaf_ip),
+                (leafdev, f'{leafname}-->{spinename}', leaf_asn_mapping[leafname],
+                 spine_asn, leaf_ip, spine_ip)):
+            if (device.id, name) in existing:
+                log_skip(f"BGP session {name} already exists, skipping")
+                continue
+            sessions.append({'name': name,
+                             'site': device.site_id,
+                             'device': device.id,
+                             'local_as': local_as,
+                             'remote_as': remote_as,
+                             'local_address': local_ip,
+                             'remote_address': remote_ip})
 
-            try:
-                print(f"Applying L3 base tags to {spineintfname} and {leafintfname}...", end='')
-                spineintf.update({'tags': [{'name':'l3base'}]})
-                leafintf.update({'tags': [{'name':'l3base'}]})
-                print("done")
-
-            except pynetbox.core.query.RequestError as E:
-                if E.error.find("Related object not found") != -1:
-                    print("Tag 'l3base' not found, skipping")
-                else:
-                    raise
+    bulk_create(nb.plugins.bgp.session, sessions, [s['name'] for s in sessions], 'BGP session')
 
-            try:
-                print(f"Creating BGP sessions between {spinename} {spineintfname} "
-                      f"and {leafname} {leafintfname}...", end='')
-
-                nb.plugins.bgp.session.create(name=f'{spinename}-->{leafname}',
-                                              site=spinedev.site.id,
-                                              device=spinedev.id,
-                                              local_as=spine_asn.id,
-                                              remote_as=leaf_asn_mapping[leafname].id,
-                                              local_address=spine_ip.id,
-                                              remote_address=leaf_ip.id
-                                              )
-
-                nb.plugins.bgp.session.create(name=f'{leafname}-->{spinename}',
-                                              site=leafdev.site.id,
-                                              device=leafdev.id,
-                                              local_as=leaf_asn_mapping[leafname].id,
-                                              remote_as=spine_asn.id,
-                                              local_address=leaf_ip.id,
-                                              remote_address=spine_ip.id
-                                              )
-                print("done")
-
-            except pynetbox.core.query.RequestError as E:
-                if E.error.find("already exists") != -1:
-                    print("BGP session already exists, skipping")
-                    j += 1
-                    continue
-                else:
-                    raise
+def create_loopbacks_ips(nb, ls_devices, loopback_prefix):
+    devices = [device for ls_device in ls_devices.values() for device in ls_device
+               if in_scope(device.name)]
+    created = bulk_create(nb.dcim.interfaces,
+                          [{'name': 'Loopback0', 'device': device.id, 'type': 'virtual'}
+                           for device in devices],
+                          [f"Loopback0 on {device.name}" for device in devices],
+                          'loopback interface', skip_error="must make a unique set")
+
+    existing = [device.id for device, intf in zip(devices, created) if intf is None]
+    if existing:
+        existing_intfs = {intf.device.id: intf for intf in
+                          bulk_filter(nb.dcim.interfaces, 'device_id', existing, name='Loopback0')}
+        created = [intf or existing_intfs[device.id] for device, intf in zip(devices, created)]
+
+    unnumbered = list()
+    for device, loopback_intf in zip(devices, created):
+        if loopback_intf.count_ipaddresses == 0:
+            unnumbered.append(loopback_intf)
+        else:
+            log_skip(f"Loopback0 IP address for {device.name} already exists, skipping")
+
+    loopback_s32s = list()
+    loopback_ips = list()
+    if unnumbered:
+        allocator = prefix_allocator(nb, loopback_prefix, 'loopback network',
+                                     'loopback IP address')
+        for loopback_intf, loopback_s32 in zip(unnumbered,
+                                               allocator.allocate_many(32, len(unnumbered))):
+            loopback_s32s.append({'prefix': str(loopback_s32)})
+            loopback_ips.append({'address': str(loopback_s32),
+                                 'assigned_object_id': loopback_intf.id,
+                                 'assigned_object_type': 'dcim.interface'})
+
+    bulk_create(nb.ipam.prefixes, loopback_s32s,
+                [p['prefix'] for p in loopback_s32s], 'loopback network')
+    bulk_create(nb.ipam.ip_addresses, loopback_ips,
+                [ip['address'] for ip in loopback_ips], 'loopback IP address')
+
+def create_vrfs(nb, ls_data, refs):
+    bulk_create(nb.extras.custom_fields,
+                [{'content_types': ['ipam.vrf'], 'type': 'integer', 'name': 'l3vni'}],
+                ['l3vni'], 'custom field')
+
+    vrfnames = [vrf['name'] for vrf in ls_data['vrfs']]
+    missing = [name for name in vrfnames if refs.get('vrfs', name) is None]
+    for name in vrfnames:
+        if name not in missing:
+            log_skip(f"VRF {name} already exists, skipping")
+
+    created = bulk_create(nb.ipam.vrfs,
+                          [{'name': name, 'enforce_unique': False} for name in missing],
+                          missing, 'VRF')
+    refs.register('vrfs', vrfnames, created)
+
+    bulk_update(nb.ipam.vrfs,
+                [{'id': refs.id('vrfs', vrf['name']), 'custom_fields': {'l3vni': vrf['vni']}}
+                 for vrf in ls_data['vrfs'] if vrf.get('vni')],
+                'VRF L3 VNI', [vrf['name'] for vrf in ls_data['vrfs'] if vrf.get('vni')])
+
+def create_vlans_vnis(nb, ls_data, refs):
+    bulk_create(nb.extras.custom_fields,
+                [{'content_types': ['ipam.l2vpn'], 'type': 'boolean', 'name': 'vnivrf'}],
+                ['vnivrf'], 'custom field')
+
+    vlans = ls_data['vlans']
+    missing = [vlan for vlan in vlans if refs.get('vlans', vlan_key(vlan)) is None]
+    for vlan in vlans:
+        if vlan not in missing:
+            log_skip(f"vlan {vlan['name']} already exists, skipping")
+
+    created = bulk_create(nb.ipam.vlans,
+                          [{'name': vlan['name'], 'vid': vlan['vid']} for vlan in missing],
+                          [vlan['name'] for vlan in missing], 'VLAN')
+    refs.register('vlans', [vlan_key(vlan) for vlan in vlans], created)
+
+    vni_vlans = [vlan for vlan in vlans if vlan.get('vni')]
+    created = bulk_create(nb.ipam.l2vpns,
+                          [{'name': vlan['name'], 'slug': vlan['name'], 'type': 'vxlan-evpn',
+                            'identifier': vlan['vni']} for vlan in vni_vlans],
+                          [f"VNI {vlan['vni']}" for vlan in vni_vlans], 'L2VPN')
+    nb_l2vpns = {nb_l2vpn.name: nb_l2vpn for nb_l2vpn in created if nb_l2vpn}
+    existing = [vlan['name'] for vlan in vni_vlans if vlan['name'] not in nb_l2vpns]
+    if existing:
+        for nb_l2vpn in nb.ipam.l2vpns.filter(name=existing):
+            nb_l2vpns[nb_l2vpn.name] = nb_l2vpn
+
+    bulk_create(nb.ipam.l2vpn_terminations,
+                [{'l2vpn': nb_l2vpns[vlan['name']].id,
+                  'assigned_object_type': 'ipam.vlan',
+                  'assigned_object_id': refs.id('vlans', vlan_key(vlan))}
+                 for vlan in vni_vlans],
+                [f"between VNI {vlan['vni']} and VLAN {vlan['vid']}" for vlan in vni_vlans],
+                'L2VPN termination')
+
+    bulk_update(nb.ipam.l2vpns,
+                [{'id': nb_l2vpns[vlan['name']].id, 'custom_fields': {'vnivrf': True}}
+                 for vlan in vni_vlans if vlan.get('svi', {}).get('vrf-svi')],
+                'L2VPN VRF SVI flag',
+                [f"VNI {vlan['vni']}" for vlan in vni_vlans if vlan.get('svi', {}).get('vrf-svi')])
+
+def create_svis(nb, ls_data, refs, ls_devices):
+    svis = list()
+    payloads = list()
+    for vlan in ls_data['vlans']:
+        svi = vlan.get('svi')
+        if not svi:
+            continue
 
-            j += 1
-        i += 1
+        tags = list()
+        if svi.get('anycast-gateway'):
+            tags.append(refs.id('tags', 'anycast-gateway'))
+        if svi.get('vrf-svi'):
+            tags.append(refs.id('tags', 'vrf-svi'))
 
-def create_loopbacks_ips(nb, ls_devices, loopback_prefix):
-    for ls_device in ls_devices.values():
-        for device in ls_device:
-            try:
-                print(f"Creating Loopback0 on {device.name}...", end='')
-                loopback_intf = nb.dcim.interfaces.create(
-                    name='Loopback0',
-                    device=device.id,
-                    type='virtual')
-                print("done")
-
-            except pynetbox.core.query.RequestError as E:
-                if E.error.find("must make a unique set") != -1:
-                    print("interface already exists, skipping")
-                    loopback_intf = nb.dcim.interfaces.get(name='Loopback0', device=device.name)
-                else:
-                    raise
+        svi_name = f"Vlan{vlan['vid']}"
+        for leaf in ls_devices['leafs']:
+            if not in_scope(leaf.name):
+                continue
+            svis.append((svi, svi_name, leaf))
+            payloads.append({'name': svi_name,
+                             'device': leaf.id,
+                             'type': 'virtual',
+                             'vrf': refs.id('vrfs', svi['vrf']),
+                             'tags': tags})
+
+    created = bulk_create(nb.dcim.interfaces, payloads,
+                          [f"{svi_name} on {leaf.name}" for svi, svi_name, leaf in svis],
+                          'SVI interface', skip_error="must make a unique set")
+
+    existing = [(svi_name, leaf) for (svi, svi_name, leaf), nb_svi in zip(svis, created)
+                if nb_svi is None]
+    if existing:
+        existing_svis = dict()
+        for nb_svi in nb.dcim.interfaces.filter(name=list({name for name, leaf in existing}),
+                                                device_id=list({leaf.id for name, leaf in existing})):
+            existing_svis[(nb_svi.device.id, nb_svi.name)] = nb_svi
+        created = [nb_svi or existing_svis[(leaf.id, svi_name)]
+                   for (svi, svi_name, leaf), nb_svi in zip(svis, created)]
+
+    ips = list()
+    labels = list()
+    for (svi, svi_name, leaf), nb_svi in zip(svis, created):
+        if not svi.get('ip'):
+            continue
+        if nb_svi.count_ipaddresses == 0:
+            ips.append({'assigned_object_id': nb_svi.id,
+                        'assigned_object_type': 'dcim.interface',
+                        'address': svi['ip'],
+                        'vrf': refs.id('vrfs', svi['vrf'])})
+            labels.append(f"{svi['ip']} on {leaf.name} {svi_name}")
+        else:
+            log_skip(f"IP address on {leaf.name} {svi_name} already exists, skipping")
 
-            print(f"Creating Loopback0 IP address for {device.name}...", end='')
-            if loopback_intf.count_ipaddresses == 0:
-                loopback_s32 = loopback_prefix.available_prefixes.create({'prefix_length': 32})
-                loopback_s32.available_ips.create(
-                    {'assigned_object_id': loopback_intf.id,
-                    'assigned_object_type': 'dcim.interface'})
-                print("done")
-            else:
-                print("IP already exists, skipping")
+    bulk_create(nb.ipam.ip_addresses, ips, labels, 'SVI IP address')
 
-def create_vrfs(nb, ls_data):
-    try:
-        print("Creating custom prefix field l3vni...", end='')
-        nb.extras.custom_fields.create(content_types=['ipam.vrf'], type='integer', name='l3vni')
-        print("done")
+def create_statics(nb, ls_data, refs):
+    fields = list()
+    for cf in ['staticroute', 'nexthop', 'bgp_originate']:
+        if cf == 'nexthop':
+            cftype = 'text'
+        else:
+            cftype = 'boolean'
 
-    except pynetbox.core.query.RequestError as E:
-        if E.error.find("already exists") != -1:
-            print("field already exists, skipping")
+        fields.append({'content_types': ['ipam.prefix'], 'type': cftype, 'name': cf})
+
+    fields.append({'content_types': ['ipam.prefix'],
+                   'type': 'object', 'object_type': 'dcim.device', 'name': 'origindevice'})
+    bulk_create(nb.extras.custom_fields, fields, [cf['name'] for cf in fields], 'custom field')
+
+    routes = new_items(ls_data, 'statics')
+    if not routes:
+        return
+
+    existing = {p.prefix for p in nb.ipam.prefixes.filter(prefix=[route['prefix'] for route in routes])}
+    for prefix in existing:
+        log_skip(f"prefix {prefix} already exists, skipping")
+
+    missing = [route for route in routes if route['prefix'] not in existing]
+    bulk_create(nb.ipam.prefixes,
+                [{'prefix': route['prefix'],
+                  'vrf': refs.id('vrfs', route['vrf']),
+                  'custom_fields': {
+                      'staticroute': True,
+                      'nexthop': route['nexthop'],
+                      'bgp_originate': True,
+                      'origindevice': refs.id('devices', route['origindevice'])
+                  }} for route in missing],
+                [route['prefix'] for route in missing], 'static route prefix')
+
+def create_ext_intfs(nb, ls_data, refs):
+    ext_intfs = new_items(ls_data, 'ext_interfaces')
+    if not ext_intfs:
+        return
+
+    created = bulk_create(nb.dcim.interfaces,
+                          [{'name': ext_intf['interface'],
+                            'device': refs.id('devices', ext_intf['device']),
+                            'vrf': refs.id('vrfs', ext_intf['vrf']),
+                            'type': 'virtual'} for ext_intf in ext_intfs],
+                          [f"{ext_intf['interface']} on {ext_intf['device']}" for ext_intf in ext_intfs],
+                          'external interface', skip_error="must make a unique set")
+
+    if None in created:
+        existing_intfs = dict()
+        for nb_intf in nb.dcim.interfaces.filter(
+                name=[ext_intf['interface'] for ext_intf in ext_intfs],
+                device_id=[refs.id('devices', ext_intf['device']) for ext_intf in ext_intfs]):
+            existing_intfs[(nb_intf.device.name, nb_intf.name)] = nb_intf
+        created = [nb_ext_intf or existing_intfs[(ext_intf['device'], ext_intf['interface'])]
+                   for ext_intf, nb_ext_intf in zip(ext_intfs, created)]
+
+    ips = list()
+    labels = list()
+    for ext_intf, nb_ext_intf in zip(ext_intfs, created):
+        if nb_ext_intf.count_ipaddresses == 0:
+            ips.append({'assigned_object_id': nb_ext_intf.id,
+                        'assigned_object_type': 'dcim.interface',
+                        'address': ext_intf['ip'],
+                        'vrf': refs.id('vrfs', ext_intf['vrf'])})
+            labels.append(f"{ext_intf['ip']} on {ext_intf['device']} {ext_intf['interface']}")
         else:
-            raise
+            log_skip(f"IP address for {ext_intf['interface']} already exists, skipping")
+
+    bulk_create(nb.ipam.ip_addresses, ips, labels, 'external IP address')
+
+def create_trunk_intfs(nb, ls_data, refs):
+    trunk_intfs = [t for t in new_items(ls_data, 'trunk_interfaces') if in_shard(t['device'])]
+    if not trunk_intfs:
+        return
+
+    nb_intfs = dict()
+    for nb_intf in nb.dcim.interfaces.filter(device_id=list({refs.id('devices', t['device'])
+                                                             for t in trunk_intfs}),
+                                             name=list({t['interface'] for t in trunk_intfs})):
+        nb_intfs[(nb_intf.device.name, nb_intf.name)] = nb_intf
+
+    keys = vlan_keys(ls_data)
+    bulk_update(nb.dcim.interfaces,
+                [{'id': nb_intfs[(trunk_intf['device'], trunk_intf['interface'])].id,
+                  'mode': 'tagged',
+                  'tagged_vlans': [refs.id('vlans', keys[v]) for v in trunk_intf['vlans']]}
+                 for trunk_intf in trunk_intfs],
+                'trunk interface', [f"{t['interface']} on {t['device']}" for t in trunk_intfs])
+
+class Plan:
+    # The create/update/no-op action for every object ls_data describes,
+    # keyed by the kind and label bulk_create()/bulk_update() use for it.
+    # Labels the plan doesn't know about are always treated as pending.
+    def __init__(self):
+        self.actions = dict()
+
+    def create(self, kind, label, exists):
+        self.actions.setdefault(kind, dict())[label] = 'noop' if exists else 'create'
+
+    def update(self, kind, label, unchanged):
+        self.actions.setdefault(kind, dict())[label] = 'noop' if unchanged else 'update'
+
+    def pending(self, kind, label):
+        return self.actions.get(kind, {}).get(label) != 'noop'
+
+    def changes(self):
+        return sum(action != 'noop' for actions in self.actions.values()
+                   for action in actions.values())
+
+    def show(self):
+        log("Plan:")
+        totals = Counter()
+        for kind, actions in self.actions.items():
+            for label, action in actions.items():
+                if action != 'noop':
+                    log(f"  {'+' if action == 'create' else '~'} {kind} {label}")
+
+        for kind, actions in self.actions.items():
+            counts = Counter(actions.values())
+            totals.update(counts)
+            log(f"  {kind:<28} {counts['create']:6} to create {counts['update']:6} to update "
+                f"{counts['noop']:6} unchanged")
+        log(f"Plan: {totals['create']} to create, {totals['update']} to update, "
+            f"{totals['noop']} unchanged")
+
+def plan_changes(nb, ls_data, refs):
+    # Expand ls_data into the objects the load creates or updates, read the
+    # current state with bulk filtered GETs (names cached by refs.prefetch()
+    # are not read again) and record what each object needs.
+    plan = Plan()
+    for section, kind in (('sites', 'site'), ('roles', 'role'), ('manufacturers', 'manufacturer'),
+                          ('device_types', 'device type'), ('tags', 'tag')):
+        field = refs.KINDS[section][2]
+        for item in ls_data[section]:
+            plan.create(kind, item[field], item[field] in refs.ids[section])
+
+    templates = {(t.device_type.model, t.name) for t in bulk_filter(
+        nb.dcim.interface_templates, 'devicetype_id', refs.ids['device_types'].values())}
+    for devicetype in ls_data['device_types']:
+        for i in range(1, devicetype['interface_qty'] + 1):
+            name = f"{devicetype['interface_prefix']}{i}"
+            plan.create('interface template', f"{devicetype['model']} {name}",
+                        (devicetype['model'], name) in templates)
 
-    nb_vrfs = dict()
-    for vrf in ls_data['vrfs']:
-        print(f"Creating VRF {vrf['name']}...", end='')
-        nb_vrf = nb.ipam.vrfs.get(name=vrf['name'])
-        if nb_vrf:
-            nb_vrfs[nb_vrf.name] = nb_vrf
-            print(f"VRF {vrf['name']} already exists, skipping")
+    intf_prefixes = {dt['model']: dt['interface_prefix'] for dt in ls_data['device_types']}
+    devicenames = dict()
+    intf_prefix = dict()
+    for role, device in ls_data['devices'].items():
+        devicenames[role] = device_names(device)
+        for name in devicenames[role]:
+            plan.create('device', name, name in refs.ids['devices'])
+            intf_prefix[name] = intf_prefixes[device['device_type']['model']]
+
+    devices = [Device(d['id'], d['name'], d['site']['id'])
+               for d in raw_filter(nb.dcim.devices, 'name', intf_prefix)]
+    intfs = InterfaceIndex(nb, {'devices': devices}).interfaces
+
+    custom_fields = ['l3vni', 'vnivrf']
+    if ls_data.get('statics'):
+        custom_fields += ['staticroute', 'nexthop', 'bgp_originate', 'origindevice']
+    existing = {cf.name for cf in bulk_filter(nb.extras.custom_fields, 'name', custom_fields)}
+    for name in custom_fields:
+        plan.create('custom field', name, name in existing)
+
+    statics = [route['prefix'] for route in ls_data.get('statics') or []]
+    containers = [ls_data['transit_prefix']['prefix'], ls_data['loopback_prefix']['prefix']]
+    existing = {p.prefix for p in bulk_filter(nb.ipam.prefixes, 'prefix', containers + statics)}
+    for prefix in containers:
+        plan.create('container prefix', prefix, prefix in existing)
+
+    plan.create('RIR', ls_data['rir']['name'],
+                nb.ipam.rirs.get(name=ls_data['rir']['name']) is not None)
+    asns = {ls_data['asns']['spine']['asn']: 'Spine ASN'}
+    leaf_asn = ls_data['asns']['leaf']['range_start']
+    for i, leafname in enumerate(devicenames['leafs']):
+        if ls_data['asns']['leaf'].get('sameasn'):
+            asns.setdefault(leaf_asn, 'Leaf ASN')
         else:
-            nb_vrf = nb.ipam.vrfs.create(name=vrf['name'], enforce_unique=False)
-            nb_vrfs[nb_vrf.name] = nb_vrf
-            print("done")
-        
+            asns.setdefault(leaf_asn + i, f'Leaf {leafname} ASN')
+    for asn, description in asns.items():
+        plan.create('ASN', f"{asn} ({description})", asn in refs.ids['asns'])
+
+    for name in intf_prefix:
+        loopback = intfs.get((name, 'Loopback0'))
+        plan.create('loopback interface', f"Loopback0 on {name}", loopback is not None)
+        plan.create('loopback IP address', name,
+                    loopback is not None and loopback.count_ipaddresses > 0)
+
+    l3base = refs.ids['tags'].get('l3base')
+    absent = Interface(None)
+    sessions = {session['name'] for session in raw_filter(
+        nb.plugins.bgp.session, 'device_id', [device.id for device in devices])}
+    for link in spine_leaf_links(devicenames['spines'], devicenames['leafs'], intf_prefix.get):
+        spinename, spineintfname, leafname, leafintfname = link
+        spineintf = intfs.get((spinename, spineintfname), absent)
+        leafintf = intfs.get((leafname, leafintfname), absent)
+        plan.create('connection', link_label(link), spineintf.cable or leafintf.cable)
+        plan.create('transit IP address', link_label(link),
+                    spineintf.count_ipaddresses or leafintf.count_ipaddresses)
+        plan.update('L3 base interface tag', f"{spineintfname} on {spinename}",
+                    spineintf.tags == [l3base])
+        plan.update('L3 base interface tag', f"{leafintfname} on {leafname}",
+                    leafintf.tags == [l3base])
+        for name in (f'{spinename}-->{leafname}', f'{leafname}-->{spinename}'):
+            plan.create('BGP session', name, name in sessions)
+
+    vrfs = {vrf.name: vrf for vrf in bulk_filter(nb.ipam.vrfs, 'name',
+                                                 [vrf['name'] for vrf in ls_data['vrfs']])}
+    for vrf in ls_data['vrfs']:
+        nb_vrf = vrfs.get(vrf['name'])
+        plan.create('VRF', vrf['name'], nb_vrf is not None)
         if vrf.get('vni'):
-            print(f"Adding L3 VNI to {vrf['name']}...", end='')
-            nb_vrf.update({'custom_fields': {'l3vni': vrf['vni']}})
-            print("done")
-    
-    return nb_vrfs
+            plan.update('VRF L3 VNI', vrf['name'],
+                        nb_vrf is not None and nb_vrf.custom_fields.get('l3vni') == vrf['vni'])
+
+    vni_vlans = [vlan for vlan in ls_data['vlans'] if vlan.get('vni')]
+    l2vpns = {l2vpn.name: l2vpn for l2vpn in bulk_filter(nb.ipam.l2vpns, 'name',
+                                                         [vlan['name'] for vlan in vni_vlans])}
+    terminations = {(t.l2vpn.id, t.assigned_object_id) for t in bulk_filter(
+        nb.ipam.l2vpn_terminations, 'l2vpn_id', [l2vpn.id for l2vpn in l2vpns.values()])
+                    if t.assigned_object_type == 'ipam.vlan'}
+    for vlan in ls_data['vlans']:
+        plan.create('VLAN', vlan['name'], vlan_key(vlan) in refs.ids['vlans'])
+    for vlan in vni_vlans:
+        l2vpn = l2vpns.get(vlan['name'])
+        plan.create('L2VPN', f"VNI {vlan['vni']}", l2vpn is not None)
+        plan.create('L2VPN termination', f"between VNI {vlan['vni']} and VLAN {vlan['vid']}",
+                    l2vpn is not None and
+                    (l2vpn.id, refs.ids['vlans'].get(vlan_key(vlan))) in terminations)
+        if vlan.get('svi', {}).get('vrf-svi'):
+            plan.update('L2VPN VRF SVI flag', f"VNI {vlan['vni']}",
+                        l2vpn is not None and l2vpn.custom_fields.get('vnivrf') is True)
 
-def create_vlans_vnis(nb, ls_data, nb_vrfs, ls_devices):
-    try:
-        print("Creating custom field for L3 VNI...", end='')
-        nb.extras.custom_fields.create(content_types=['ipam.l2vpn'], type='boolean', name='vnivrf')
-        print("done")
-    except pynetbox.core.query.RequestError as E:
-        if E.error.find("already exists") != -1:
-            print("field already exists, skipping")
+    for vlan in ls_data['vlans']:
+        svi = vlan.get('svi')
+        if not svi:
+            continue
+
+        svi_name = f"Vlan{vlan['vid']}"
+        for leafname in devicenames['leafs']:
+            nb_svi = intfs.get((leafname, svi_name))
+            plan.create('SVI interface', f"{svi_name} on {leafname}", nb_svi is not None)
+            if svi.get('ip'):
+                plan.create('SVI IP address', f"{svi['ip']} on {leafname} {svi_name}",
+                            nb_svi is not None and nb_svi.count_ipaddresses > 0)
+
+    for prefix in statics:
+        plan.create('static route prefix', prefix, prefix in existing)
+
+    for ext_intf in ls_data.get('ext_interfaces') or []:
+        nb_intf = intfs.get((ext_intf['device'], ext_intf['interface']))
+        plan.create('external interface', f"{ext_intf['interface']} on {ext_intf['device']}",
+                    nb_intf is not None)
+        plan.create('external IP address',
+                    f"{ext_intf['ip']} on {ext_intf['device']} {ext_intf['interface']}",
+                    nb_intf is not None and nb_intf.count_ipaddresses > 0)
+
+    keys = vlan_keys(ls_data)
+    for trunk_intf in ls_data.get('trunk_interfaces') or []:
+        nb_intf = intfs.get((trunk_intf['device'], trunk_intf['interface']))
+        vlan_ids = [refs.ids['vlans'].get(keys[vid]) for vid in trunk_intf['vlans']]
+        plan.update('trunk interface', f"{trunk_intf['interface']} on {trunk_intf['device']}",
+                    nb_intf is not None and nb_intf.mode == 'tagged' and
+                    None not in vlan_ids and sorted(nb_intf.tagged_vlans) == sorted(vlan_ids))
+
+    return plan
+
+CUSTOM_FIELDS = ('l3vni', 'vnivrf', 'staticroute', 'nexthop', 'bgp_originate', 'origindevice')
+
+def fabric_objects(nb, ls_data, refs):
+    # Every NetBox object ls_data describes, by kind, read with one filtered
+    # query per kind (per BATCH_SIZE ids).  The objects named in ls_data are
+    # found through the resolver, the rest through the devices and the
+    # transit/loopback containers they hang off.
+    containers = [ls_data['transit_prefix']['prefix'], ls_data['loopback_prefix']['prefix']]
+    objects = dict()
+    for kind in ('sites', 'roles', 'manufacturers', 'device_types', 'tags', 'vrfs', 'vlans',
+                 'asns', 'devices'):
+        objects[kind] = list(bulk_filter(refs.endpoint(kind), 'id', refs.ids[kind].values()))
+    device_ids = [device.id for device in objects['devices']]
+
+    objects['interface_templates'] = list(bulk_filter(
+        nb.dcim.interface_templates, 'devicetype_id', refs.ids['device_types'].values()))
+    objects['custom_fields'] = list(nb.extras.custom_fields.filter(name=list(CUSTOM_FIELDS)))
+    objects['rirs'] = list(nb.ipam.rirs.filter(name=ls_data['rir']['name']))
+    objects['l2vpns'] = list(bulk_filter(
+        nb.ipam.l2vpns, 'name', [vlan['name'] for vlan in ls_data['vlans'] if vlan.get('vni')]))
+    objects['l2vpn_terminations'] = list(bulk_filter(
+        nb.ipam.l2vpn_terminations, 'l2vpn_id', [l2vpn.id for l2vpn in objects['l2vpns']]))
+    objects['interfaces'] = list(bulk_filter(nb.dcim.interfaces, 'device_id', device_ids))
+    objects['cables'] = list(bulk_filter(
+        nb.dcim.cables, 'id', sorted({intf.cable.id for intf in objects['interfaces']
+                                      if intf.cable is not None})))
+
+    ips = {ip.id: ip for ip in bulk_filter(nb.ipam.ip_addresses, 'device_id', device_ids)}
+    ips.update((ip.id, ip) for ip in nb.ipam.ip_addresses.filter(parent=containers))
+    objects['ip_addresses'] = [ips[ip_id] for ip_id in sorted(ips)]
+
+    prefixes = list(nb.ipam.prefixes.filter(prefix=containers))
+    prefixes.extend(nb.ipam.prefixes.filter(within=containers))
+    statics = {(route['prefix'], refs.get('vrfs', route['vrf']))
+               for route in ls_data.get('statics') or []}
+    if statics:
+        prefixes.extend(p for p in bulk_filter(nb.ipam.prefixes, 'prefix',
+                                               [prefix for prefix, vrf in statics])
+                        if (p.prefix, p.vrf and p.vrf.id) in statics)
+    objects['prefixes'] = prefixes
+
+    objects['bgp_sessions'] = list(bulk_filter(nb.plugins.bgp.session, 'device_id', device_ids))
+    return objects
+
+def teardown(nb, ls_data, refs, dry_run=False):
+    # Delete everything ls_data describes, dependents first, each kind as
+    # bulk DELETEs.  Interface templates, physical interfaces and L2VPN
+    # terminations are removed by NetBox along with their parents.
+    objects = fabric_objects(nb, ls_data, refs)
+    steps = [
+        (nb.plugins.bgp.session, 'bgp_sessions', 'BGP session'),
+        (nb.ipam.ip_addresses, 'ip_addresses', 'IP address'),
+        (nb.dcim.cables, 'cables', 'cable'),
+        (nb.dcim.interfaces, 'virtual_interfaces', 'interface'),
+        (nb.dcim.devices, 'devices', 'device'),
+        (nb.ipam.prefixes, 'prefixes', 'prefix'),
+        (nb.ipam.asns, 'asns', 'ASN'),
+        (nb.ipam.rirs, 'rirs', 'RIR'),
+        (nb.ipam.l2vpns, 'l2vpns', 'L2VPN'),
+        (nb.ipam.vlans, 'vlans', 'VLAN'),
+        (nb.ipam.vrfs, 'vrfs', 'VRF'),
+        (nb.extras.custom_fields, 'custom_fields', 'custom field'),
+        (nb.extras.tags, 'tags', 'tag'),
+        (nb.dcim.device_types, 'device_types', 'device type'),
+        (nb.dcim.manufacturers, 'manufacturers', 'manufacturer'),
+        (nb.dcim.device_roles, 'roles', 'role'),
+        (nb.dcim.sites, 'sites', 'site'),
+    ]
+    objects['virtual_interfaces'] = [intf for intf in objects['interfaces']
+                                     if getattr(intf.type, 'value', intf.type) == 'virtual']
+
+    for endpoint, kind, label in steps:
+        ids = [record.id for record in objects[kind]]
+        if dry_run:
+            log(f"  - {len(ids):6} {label}(s)")
+        elif ids:
+            bulk_delete(endpoint, ids, label)
+
+VERIFY_SETTINGS_QUERY = """
+query {
+  vrf_list { name custom_fields }
+  vlan_list { vid name }
+}"""
+
+VERIFY_DEVICES_QUERY = """
+query ($name: [String]) {
+  device_list(name: $name) {
+    name
+    site { name }
+    device_role { name }
+    device_type { model }
+    interfaces {
+      name
+      mode
+      vrf { name }
+      tags { name }
+      tagged_vlans { name vid }
+      link_peers { ... on InterfaceType { name device { name } } }
+      ip_addresses { address vrf { name } }
+    }
+  }
+}"""
+
+def graphql(nb, query, **variables):
+    # Sent through the client's session, so its pool and retries apply.
+    url = re.sub(r'/api/?$', '', nb.base_url)
+    headers = {'Accept': 'application/json'}
+    if nb.token:
+        headers['Authorization'] = f"Token {nb.token}"
+    resp = nb.http_session.post(f"{url}/graphql/", headers=headers,
+                                json={'query': query, 'variables': variables})
+    resp.raise_for_status()
+    result = resp.json()
+    if result.get('errors'):
+        raise RuntimeError("GraphQL query failed: " +
+                           "; ".join(error['message'] for error in result['errors']))
+    return result['data']
+
+def verify(nb, ls_data):
+    # Read the fabric back through GraphQL, one query for the VRFs and VLANs
+    # and one per BATCH_SIZE devices with their interfaces, cable peers and
+    # IPs, and compare it with what ls_data expands to.  Transit and
+    # loopback addresses are allocated at load time, so those are checked
+    # for their container, prefix length and uniqueness rather than value.
+    # Returns the differences as a list of messages.
+    drift = list()
+
+    def differ(label, field, actual, expected):
+        if actual != expected:
+            drift.append(f"{label}: {field} is {actual}, expected {expected}")
+
+    data = graphql(nb, VERIFY_SETTINGS_QUERY)
+    vrfs = {vrf['name']: vrf for vrf in data['vrf_list']}
+    for vrf in ls_data['vrfs']:
+        if vrf['name'] not in vrfs:
+            drift.append(f"VRF {vrf['name']}: missing")
+        elif vrf.get('vni'):
+            differ(f"VRF {vrf['name']}", 'l3vni',
+                   (vrfs[vrf['name']]['custom_fields'] or {}).get('l3vni'), vrf['vni'])
+    vlans = {vlan_key(vlan) for vlan in data['vlan_list']}
+    found_vrfs = sum(vrf['name'] in vrfs for vrf in ls_data['vrfs'])
+    found_vlans = sum(vlan_key(vlan) in vlans for vlan in ls_data['vlans'])
+    for vlan in ls_data['vlans']:
+        if vlan_key(vlan) not in vlans:
+            drift.append(f"VLAN {vlan['name']} ({vlan['vid']}): missing")
+
+    devices = dict()
+    for device in ls_data['devices'].values():
+        for name in device_names(device):
+            devices[name] = device
+    found = dict()
+    for names in chunked(list(devices), BATCH_SIZE):
+        for nb_device in graphql(nb, VERIFY_DEVICES_QUERY, name=names)['device_list']:
+            found[nb_device['name']] = nb_device
+
+    interfaces = dict()
+    for name, device in devices.items():
+        nb_device = found.get(name)
+        if nb_device is None:
+            drift.append(f"{name}: missing")
+            continue
+        differ(name, 'site', nb_device['site']['name'], device['site']['name'])
+        differ(name, 'role', nb_device['device_role']['name'], device['device_role']['name'])
+        differ(name, 'device type', nb_device['device_type']['model'],
+               device['device_type']['model'])
+        for intf in nb_device['interfaces']:
+            interfaces[(name, intf['name'])] = intf
+
+    def interface(device, name, vrf=None, tags=()):
+        # The interface, after checking its VRF and tags; None if it (or its
+        # device) is missing.
+        if device not in found:
+            return None
+        intf = interfaces.get((device, name))
+        if intf is None:
+            drift.append(f"{device} {name}: missing")
+            return None
+        differ(f"{device} {name}", 'VRF', intf['vrf'] and intf['vrf']['name'], vrf)
+        for tag in tags:
+            if tag not in [t['name'] for t in intf['tags']]:
+                drift.append(f"{device} {name}: tag {tag} missing")
+        return intf
+
+    def addresses(intf):
+        return [(ip['address'], ip['vrf'] and ip['vrf']['name']) for ip in intf['ip_addresses']]
+
+    intf_prefixes = {dt['model']: dt['interface_prefix'] for dt in ls_data['device_types']}
+    for name, device in devices.items():
+        devicetype = [dt for dt in ls_data['device_types']
+                      if dt['model'] == device['device_type']['model']][0]
+        for i in range(1, devicetype['interface_qty'] + 1):
+            interface(name, f"{devicetype['interface_prefix']}{i}")
+
+    transit = ipaddress.ip_network(ls_data['transit_prefix']['prefix'])
+    seen = dict()
+    for link in spine_leaf_links(device_names(ls_data['devices']['spines']),
+                                 device_names(ls_data['devices']['leafs']),
+                                 lambda name: intf_prefixes[devices[name]['device_type']['model']]):
+        spinename, spineintf, leafname, leafintf = link
+        ends = [interface(spinename, spineintf, tags=['l3base']),
+                interface(leafname, leafintf, tags=['l3base'])]
+        if None in ends:
+            continue
+        for (device, name), intf, peer in (((spinename, spineintf), ends[0], (leafname, leafintf)),
+                                           ((leafname, leafintf), ends[1],
+                                            (spinename, spineintf))):
+            differ(f"{device} {name}", 'cable peer',
+                   ', '.join(f"{p['device']['name']} {p['name']}" for p in intf['link_peers'])
+                   or None, ' '.join(peer))
+        ips = [addresses(intf) for intf in ends]
+        networks = {ipaddress.ip_interface(address).network for end in ips for address, vrf in end}
+        network = networks.pop() if len(networks) == 1 else None
+        if ([len(end) for end in ips] != [1, 1] or network is None
+                or network.prefixlen != 31 or not network.subnet_of(transit)):
+            drift.append(f"Transit IPs {link_label(link)}: "
+                         f"{[address for end in ips for address, vrf in end]}, "
+                         f"expected a /31 of {transit}")
         else:
-            raise
+            if network in seen:
+                drift.append(f"Transit IPs {link_label(link)}: {network} also used "
+                             f"{link_label(seen[network])}")
+            seen[network] = link
+
+    loopback = ipaddress.ip_network(ls_data['loopback_prefix']['prefix'])
+    seen = dict()
+    for name in devices:
+        intf = interface(name, 'Loopback0')
+        if intf is None:
+            continue
+        ips = [address for address, vrf in addresses(intf)]
+        network = len(ips) == 1 and ipaddress.ip_interface(ips[0]).network
+        if not network or network.prefixlen != 32 or not network.subnet_of(loopback):
+            drift.append(f"{name} Loopback0: IPs are {ips}, expected a /32 of {loopback}")
+        elif network in seen:
+            drift.append(f"{name} Loopback0: {ips[0]} also used by {seen[network]}")
+        else:
+            seen[network] = name
 
     for vlan in ls_data['vlans']:
-        print(f"Creating VLAN {vlan['name']}...", end='')
-        nb_vlan = nb.ipam.vlans.get(name=vlan['name'], vid=vlan['vid'])
-        if nb_vlan:
-            print(f"vlan {vlan['name']} already exists, skipping")
+        svi = vlan.get('svi')
+        if not svi:
+            continue
+        tags = [tag for tag in ('anycast-gateway', 'vrf-svi') if svi.get(tag)]
+        for leafname in device_names(ls_data['devices']['leafs']):
+            intf = interface(leafname, f"Vlan{vlan['vid']}", svi['vrf'], tags)
+            if intf is not None and svi.get('ip'):
+                differ(f"{leafname} Vlan{vlan['vid']}", 'IPs', addresses(intf),
+                       [(svi['ip'], svi['vrf'])])
+
+    for ext_intf in ls_data.get('ext_interfaces') or []:
+        intf = interface(ext_intf['device'], ext_intf['interface'], ext_intf['vrf'])
+        if intf is not None:
+            differ(f"{ext_intf['device']} {ext_intf['interface']}", 'IPs', addresses(intf),
+                   [(ext_intf['ip'], ext_intf['vrf'])])
+
+    for trunk_intf in ls_data.get('trunk_interfaces') or []:
+        intf = interface(trunk_intf['device'], trunk_intf['interface'])
+        if intf is not None:
+            label = f"{trunk_intf['device']} {trunk_intf['interface']}"
+            differ(label, 'mode', intf['mode'] and intf['mode'].lower(), 'tagged')
+            keys = vlan_keys(ls_data)
+            differ(label, 'tagged VLANs', sorted(vlan_key(v) for v in intf['tagged_vlans']),
+                   sorted(keys[vid] for vid in trunk_intf['vlans']))
+
+    log(f"Checked {len(found)} device(s), {len(interfaces)} interface(s), "
+        f"{found_vrfs} VRF(s) and {found_vlans} VLAN(s)")
+    return drift
+
+class Delta:
+    # What changed between the data file of the last successful load and the
+    # current one.  If the only change to the devices is a higher qty, the
+    # new device names are the scope of the load: per-device and per-link
+    # objects are only created for them and the links to them.  Changes to
+    # the sections listed in SCOPED leave the scope alone, any other change
+    # puts every device in scope (scope None).  Stages that only load
+    # unchanged sections are skipped altogether.
+    SCOPED = ('sites', 'roles', 'manufacturers', 'tags', 'vrfs', 'statics', 'ext_interfaces',
+              'trunk_interfaces')
+
+    def __init__(self, applied, ls_data):
+        self.applied = applied
+        self.changed = {section for section in set(applied) | set(ls_data)
+                        if applied.get(section) != ls_data.get(section)}
+        self.scope = set()
+        for role, device in ls_data['devices'].items():
+            old = applied['devices'].get(role)
+            if old is not None and dict(old, qty=device['qty']) == device and \
+                    old['qty'] <= device['qty']:
+                self.scope.update(device_names(device)[old['qty']:])
+            else:
+                self.scope = None
+                break
+        if self.changed - {'devices'} - set(self.SCOPED):
+            self.scope = None
+
+    def new_items(self, section, items):
+        if self.scope is None:
+            return items
+        applied = {json.dumps(item, sort_keys=True) for item in self.applied.get(section) or []}
+        return [item for item in items if json.dumps(item, sort_keys=True) not in applied]
+
+    def touches(self, *names):
+        return self.scope is None or any(name in self.scope for name in names)
+
+    def skips(self, stage):
+        return bool(stage.sections) and not self.changed & set(stage.sections)
+
+    def show(self):
+        log(f"Changed since the last load: {', '.join(sorted(self.changed)) or 'nothing'}")
+        if not self.changed:
+            return
+        if self.scope is None:
+            log("Incremental load covers all devices")
+        else:
+            log(f"Incremental load covers {len(self.scope)} new device(s)")
+
+class Shard:
+    # One of the processes of a sharded load and the part of the fabric it
+    # loads.  owners maps every leaf to the index of its shard: the objects
+    # of a leaf, and the links to it, belong to that shard, and spine
+    # objects belong to the first one.  lock and allocators are manager
+    # proxies shared by all shards (see SharedAllocator).
+    def __init__(self, index, count, owners, lock, allocators):
+        self.index = index
+        self.count = count
+        self.owners = owners
+        self.lock = lock
+        self.allocators = allocators
+
+    def owns(self, names):
+        for name in names:
+            if name in self.owners:
+                return self.owners[name] == self.index
+        return self.index == 0
+
+class Journal:
+    # Append-only log of the finished stages and bulk writes of a load, one
+    # JSON object per line: the labels and ids of every created or updated
+    # batch, and the outputs of every finished stage together with the
+    # resolver ids learned so far.  A load started with --resume replays it,
+    # so finished stages are skipped without any request and the stage that
+    # was interrupted doesn't resend the batches that went through.
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.ops = dict()
+        self.stages = dict()
+        self.refs = dict()
+        self.finished = False
+
+    def load(self):
+        # Stop at a line torn by a crash; open() cuts it off before appending.
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry['op'] == 'start' and entry['digest'] != self.digest:
+                    return False
+                self.apply(entry)
+                self.size += len(line)
+        return True
+
+    def apply(self, entry):
+        if entry['op'] in ('create', 'update'):
+            self.ops.setdefault((entry['op'], entry['kind']), dict()).update(entry['items'])
+        elif entry['op'] == 'stage':
+            self.stages[entry['name']] = entry['outputs']
+            for kind, ids in entry['refs'].items():
+                # JSON has no tuples; VLAN keys come back as lists.
+                self.refs.setdefault(kind, dict()).update(
+                    (tuple(key) if isinstance(key, list) else key, obj_id)
+                    for key, obj_id in ids)
+        elif entry['op'] == 'finished':
+            self.finished = True
+
+    def open(self, lsdata, resume):
+        if resume and self.size:
+            os.truncate(self.path, self.size)
+            self.attach()
         else:
-            nb_vlan = nb.ipam.vlans.create(name=vlan['name'], vid=vlan['vid'])
-            print("done")
+            open(self.path, 'wb').close()
+            self.attach()
+            self.write({'op': 'start', 'lsdata': lsdata, 'digest': self.digest})
+
+    def attach(self):
+        # Unbuffered appends put every entry in the file with one write(), so
+        # the processes of a sharded load can share it without tearing lines.
+        self.file = open(self.path, 'ab', buffering=0)
+
+    def write(self, entry):
+        line = (json.dumps(entry, default=self.encode) + '\n').encode()
+        with self.lock:
+            self.file.write(line)
+
+    def done(self, op, kind, label):
+        return label in self.ops.get((op, kind), ())
+
+    def record(self, op, kind, labels, ids):
+        items = dict(zip(labels, ids))
+        with self.lock:
+            self.ops.setdefault((op, kind), dict()).update(items)
+        self.write({'op': op, 'kind': kind, 'items': items})
+
+    def finish_stage(self, stage, context):
+        # Only the resolver ids not journaled yet are written; they are kept
+        # as [key, id] pairs as ASN keys are numbers and VLAN keys pairs.
+        refs = context['refs']
+        new_refs = dict()
+        with refs.lock:
+            for kind, ids in refs.ids.items():
+                known = self.refs.setdefault(kind, dict())
+                new = [[key, obj_id] for key, obj_id in ids.items() if known.get(key) != obj_id]
+                known.update(ids)
+                if new:
+                    new_refs[kind] = new
+        outputs = {name: context[name] for name in stage.outputs}
+        self.stages[stage.name] = outputs
+        self.write({'op': 'stage', 'name': stage.name, 'outputs': outputs, 'refs': new_refs})
+
+    def finish(self):
+        self.write({'op': 'finished'})
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    def restore_refs(self, refs):
+        for kind, ids in self.refs.items():
+            refs.ids[kind].update(ids)
+
+    def finished_stages(self, stages, deps):
+        # Stages that don't journal their output (local views like the
+        # interface index) only have to run again if a stage using them does.
+        finished = set()
+        for stage in reversed(stages):
+            users = [other.name for other in stages if stage.name in deps[other.name]]
+            if stage.name in self.stages or (not stage.journal and users and
+                                             all(name in finished for name in users)):
+                finished.add(stage.name)
+        return [stage for stage in stages if stage.name in finished]
+
+    def restore_outputs(self, stage, nb):
+        if stage.name not in self.stages:
+            return dict()
+        return {name: self.decode(value, nb) for name, value in self.stages[stage.name].items()}
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, Device):
+            return {'__device__': [value.id, value.name, value.site_id]}
+        if isinstance(value, pynetbox.core.response.Record):
+            return {'__record__': [value.endpoint.app.name, value.endpoint.name],
+                    'values': dict(value)}
+        raise TypeError(f"Cannot journal {type(value).__name__} values")
+
+    @classmethod
+    def decode(cls, value, nb):
+        if isinstance(value, list):
+            return [cls.decode(v, nb) for v in value]
+        if isinstance(value, dict) and '__device__' in value:
+            return Device(*value['__device__'])
+        if isinstance(value, dict) and '__record__' in value:
+            app, name = value['__record__']
+            endpoint = getattr(getattr(nb, app), name.replace('-', '_'))
+            return endpoint.return_obj(value['values'], nb, endpoint)
+        if isinstance(value, dict):
+            return {k: cls.decode(v, nb) for k, v in value.items()}
+        return value
+
+class Stage:
+    # One step of the load.  args names the context values handed to func
+    # positionally, outputs names the value(s) it returns and after lists
+    # extra outputs that must exist first (e.g. objects only referenced
+    # through the resolver).  Stages depend on whichever stages produce
+    # their args/after names.  Stages whose outputs can't be journaled set
+    # journal=False and are run again on resume when needed.  sections lists
+    # the ls_data sections a stage loads when it loads nothing else, so an
+    # incremental load can skip it if they didn't change.  Sharded stages do
+    # the per-leaf work a sharded load splits across processes.
+    def __init__(self, name, func, args, outputs=(), after=(), journal=True, sections=(),
+                 sharded=False):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.outputs = outputs
+        self.after = after
+        self.journal = journal
+        self.sections = sections
+        self.sharded = sharded
+
+def run_stage(stage, context):
+    METRICS.set_stage(stage.name)
+    start = time.monotonic()
+    try:
+        result = stage.func(*[context[arg] for arg in stage.args])
+    finally:
+        METRICS.wall(stage.name, time.monotonic() - start)
+    return result, start, time.monotonic()
+
+def run_stages(stages, context, workers=WORKERS):
+    # Run every stage as soon as the stages it depends on have finished,
+    # up to workers at a time, then report the critical path through the
+    # dependency graph using the measured stage times.
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    deps = {stage.name: {producers[n] for n in stage.args + stage.after if n in producers}
+            for stage in stages}
+    pending = list(stages)
+    running = dict()
+    timings = dict()
+    if JOURNAL is not None:
+        for stage in JOURNAL.finished_stages(stages, deps):
+            pending.remove(stage)
+            context.update(JOURNAL.restore_outputs(stage, context['nb']))
+            timings[stage.name] = 0.0
+            log_skip(f"Stage {stage.name} finished in the interrupted load, skipping")
+
+    if DELTA is not None:
+        for stage in [stage for stage in pending if DELTA.skips(stage)]:
+            pending.remove(stage)
+            context.update(dict.fromkeys(stage.outputs))
+            timings[stage.name] = 0.0
+            log_skip(f"Stage {stage.name} loads nothing that changed, skipping")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for stage in list(pending):
+                if deps[stage.name] <= timings.keys():
+                    pending.remove(stage)
+                    running[pool.submit(run_stage, stage, context)] = stage
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                result, start, end = future.result()
+                if len(stage.outputs) == 1:
+                    context[stage.outputs[0]] = result
+                elif stage.outputs:
+                    context.update(zip(stage.outputs, result))
+                if JOURNAL is not None and stage.journal:
+                    JOURNAL.finish_stage(stage, context)
+                timings[stage.name] = end - start
+
+    print_critical_path(stages, deps, timings)
+    return context
+
+def run_shards(stages, context, processes, options):
+    # Run the sharded stages in worker processes, each loading a contiguous
+    # block of leafs over its own HTTP session and backend, once the shared
+    # stages have run in this one.  The workers get the shared stage
+    # outputs, resolver ids and journal state as they are now, append to
+    # the same journal file, and send back their metrics to merge.
+    leafs = [leaf.name for leaf in context['ls_devices']['leafs']]
+    count = max(1, min(processes, len(leafs)))
+    owners = {name: i * count // len(leafs) for i, name in enumerate(leafs)}
+    produced = {output for stage in stages for output in stage.outputs}
+    shared = {arg for stage in stages for arg in stage.args
+              if arg not in produced and arg not in ('nb', 'ls_data', 'refs')}
+    job = dict(options,
+               ls_data=context['ls_data'],
+               context=json.loads(json.dumps({name: context[name] for name in shared},
+                                             default=Journal.encode)),
+               refs=context['refs'].ids,
+               plan=PLAN,
+               delta=DELTA,
+               journal=(JOURNAL.path, JOURNAL.digest, JOURNAL.ops, JOURNAL.stages, JOURNAL.refs))
+
+    # spawn, not fork: the parent has the backend's event loop and the
+    # connection pools running in threads.
+    mp = multiprocessing.get_context('spawn')
+    errors = list()
+    with mp.Manager() as manager:
+        lock = manager.Lock()
+        allocators = manager.dict()
+        with concurrent.futures.ProcessPoolExecutor(count, mp_context=mp) as pool:
+            futures = [pool.submit(load_shard, job, Shard(index, count, owners, lock, allocators))
+                       for index in range(count)]
+            for future in futures:
+                try:
+                    METRICS.merge(future.result())
+                except Exception as E:
+                    errors.append(E)
+    if errors:
+        raise errors[0]
+
+def load_shard(job, shard):
+    # Entry point of a shard process (see run_shards()).  Only the text of a
+    # failure goes back to the parent: a RequestError can't be rebuilt from
+    # its message, and other exceptions may refer to objects (sessions,
+    # locks) that don't pickle.
+    try:
+        return run_shard(job, shard)
+    except Exception as E:
+        raise RuntimeError(f"Shard {shard.index + 1}/{shard.count} failed: "
+                           f"{type(E).__name__}: {E}\n{traceback.format_exc()}") from None
+
+def run_shard(job, shard):
+    # Its stages are journaled under their own names, e.g. svis[2/4], so a
+    # resumed sharded load skips the ones each shard finished.
+    global BATCH_SIZE, BACKEND, PLAN, JOURNAL, DELTA, SHARD
+    BATCH_SIZE = job['batch_size']
+    PLAN = job['plan']
+    DELTA = job['delta']
+    SHARD = shard
+    nb = pynetbox.api(job['url'], job['token'])
+    nb.http_session = build_session(job['pool_size'], job['retries'], job['backoff'])
+    if job['backend'] == 'async':
+        limit = job['adaptive'] and ConcurrencyLimit(job['concurrency'], *job['adaptive'])
+        BACKEND = AsyncBackend(nb, job['concurrency'], job['pool_size'], job['retries'],
+                               job['backoff'], limit)
+    refs = RefResolver(nb)
+    for kind, ids in job['refs'].items():
+        refs.ids[kind].update(ids)
+    path, digest, ops, stage_outputs, journal_refs = job['journal']
+    JOURNAL = Journal(path, digest)
+    JOURNAL.ops, JOURNAL.stages, JOURNAL.refs = ops, stage_outputs, journal_refs
+    JOURNAL.attach()
+
+    stages = [stage for stage in build_stages(job['ls_data']) if stage.sharded]
+    for stage in stages:
+        stage.name = f"{stage.name}[{shard.index + 1}/{shard.count}]"
+    context = {'nb': nb, 'ls_data': job['ls_data'], 'refs': refs}
+    context.update(Journal.decode(job['context'], nb))
+    try:
+        run_stages(stages, context, job['workers'])
+    finally:
+        BACKEND.close()
+        JOURNAL.close()
+    return {name.split('[')[0]: entry for name, entry in METRICS.stages.items()}
+
+def print_critical_path(stages, deps, timings):
+    finish = dict()
+    previous = dict()
+    for stage in stages:
+        # stages are listed in a valid dependency order
+        before = max(deps[stage.name], key=lambda name: finish[name], default=None)
+        previous[stage.name] = before
+        finish[stage.name] = timings[stage.name] + (finish[before] if before else 0)
+
+    path = [max(finish, key=finish.get)]
+    while previous[path[-1]]:
+        path.append(previous[path[-1]])
+
+    total = sum(timings.values())
+    log(f"Critical path ({finish[path[0]]:.2f}s of {total:.2f}s total stage time):")
+    for name in reversed(path):
+        log(f"  {name:<20} {timings[name]:8.2f}s")
+
+def build_stages(ls_data):
+    stages = [
+        Stage('sites', create_sites, ('nb', 'ls_data', 'refs'), ('sites',), sections=('sites',)),
+        Stage('roles', create_roles, ('nb', 'ls_data', 'refs'), ('roles',), sections=('roles',)),
+        Stage('manufacturers', create_manufacturers, ('nb', 'ls_data', 'refs'), ('manufacturers',),
+              sections=('manufacturers',)),
+        Stage('device_types', create_devicetypes, ('nb', 'ls_data', 'refs'), ('device_types',),
+              after=('manufacturers',), sections=('device_types',)),
+        Stage('intf_templates', create_intf_templates, ('nb', 'ls_data', 'refs'),
+              ('intf_templates',), after=('device_types',), sections=('device_types',)),
+        Stage('devices', create_devices, ('nb', 'ls_data', 'refs'), ('ls_devices',),
+              after=('sites', 'roles', 'intf_templates')),
+        Stage('tags', create_tags, ('nb', 'ls_data', 'refs'), ('tags',), sections=('tags',)),
+        Stage('intf_index', InterfaceIndex, ('nb', 'ls_devices'), ('intf_index',),
+              journal=False, sharded=True),
+        Stage('connections', create_connections, ('nb', 'ls_devices', 'intf_index'),
+              ('connections',), sharded=True),
+        Stage('transit_prefix', create_transit_prefix, ('nb', 'ls_data', 'refs'),
+              ('transit_prefix',), after=('sites',)),
+        Stage('loopback_prefix', create_loopback_prefix, ('nb', 'ls_data', 'refs'),
+              ('loopback_prefix',), after=('sites',)),
+        Stage('rir_asn', create_rir_asn, ('nb', 'ls_data', 'ls_devices', 'refs'),
+              ('spine_asn', 'leaf_asn_mapping')),
+        Stage('transit_ips', create_transit_net_ips,
+              ('nb', 'transit_prefix', 'ls_devices', 'intf_index', 'refs'), ('transit_ips',),
+              after=('tags',), sharded=True),
+        Stage('bgp_sessions', create_bgp_sessions,
+              ('nb', 'ls_devices', 'intf_index', 'spine_asn', 'leaf_asn_mapping'),
+              ('bgp_sessions',), after=('transit_ips',), sharded=True),
+        Stage('loopbacks', create_loopbacks_ips, ('nb', 'ls_devices', 'loopback_prefix'),
+              ('loopbacks',), sharded=True),
+        Stage('vrfs', create_vrfs, ('nb', 'ls_data', 'refs'), ('vrfs',), sections=('vrfs',)),
+        Stage('vlans_vnis', create_vlans_vnis, ('nb', 'ls_data', 'refs'), ('vlans',),
+              after=('vrfs', 'tags'), sections=('vlans',)),
+        Stage('svis', create_svis, ('nb', 'ls_data', 'refs', 'ls_devices'), ('svis',),
+              after=('vlans',), sharded=True),
+    ]
 
-        nb_l2vpn = None
-        if vlan.get('vni'):
-            try:
-                print(f"Creating L2VPN VNI {vlan['vni']}...", end='')
-                nb_l2vpn = nb.ipam.l2vpns.create(
-                    name=vlan['name'], slug=vlan['name'], type='vxlan-evpn', identifier=vlan['vni'])
-                print("done")
-            except pynetbox.core.query.RequestError as E:
-                if E.error.find("already exists") != -1:
-                    nb_l2vpn = nb.ipam.l2vpns.get(name=vlan['name'])
-                    print("L2VPN VNI already exists, skipping")
-                else:
-                    raise
+    if ls_data.get('statics'):
+        stages.append(Stage('statics', create_statics, ('nb', 'ls_data', 'refs'), ('statics',),
+                            after=('vrfs', 'ls_devices'), sections=('statics',)))
 
-            try:
-                print(f"Creating L2VPN termination between VNI {vlan['vni']}"
-                      f" and VLAN {vlan['vid']}...", end='')
-                nb.ipam.l2vpn_terminations.create(l2vpn=nb_l2vpn.id,
-                                                  assigned_object_type='ipam.vlan',
-                                                  assigned_object_id=nb_vlan.id)
-                print("done")
-            except pynetbox.core.query.RequestError as E:
-                if E.error.find("already exists") != -1:
-                    print("L2VPN termination already exists")
-                else:
-                    raise
+    if ls_data.get('ext_interfaces'):
+        stages.append(Stage('ext_intfs', create_ext_intfs, ('nb', 'ls_data', 'refs'),
+                            ('ext_intfs',), after=('vrfs', 'ls_devices'),
+                            sections=('ext_interfaces',)))
 
-        svi = vlan.get('svi')
-        if svi:
-            nb_vrf = nb_vrfs[svi['vrf']]
-            svi_name = f"Vlan{vlan['vid']}"
-            for leaf in ls_devices['leafs']:
-                try:
-                    tags = list()
-                    if svi.get('anycast-gateway'):
-                        tags.append({'name': 'anycast-gateway'})
-                    if svi.get('vrf-svi'):
-                        tags.append({'name': 'vrf-svi'})
-                        nb_l2vpn.update({'custom_fields': {'vnivrf': True}})
-
-                    print(f"Creating interface {svi_name} on {leaf.name}...", end='')
-                    nb_svi = nb.dcim.interfaces.create(name=svi_name,
-                                                       device=leaf.id,
-                                                       type='virtual',
-                                                       vrf=nb_vrf.id,
-                                                       tags=tags)
-                    print("done")
-
-                except pynetbox.core.query.RequestError as E:
-                    if E.error.find("must make a unique set") != -1:
-                        print("interface already exists, skipping")
-                        nb_svi = nb.dcim.interfaces.get(name=svi_name, device=leaf.name)
-                    else:
-                        raise
-                
-                if svi.get('ip'):
-                    print(f"Adding IP address {svi['ip']} to interface {svi_name}...", end='')
-                    if nb_svi.count_ipaddresses == 0:
-                        nb.ipam.ip_addresses.create(
-                            assigned_object_id=nb_svi.id,
-                            assigned_object_type='dcim.interface',
-                            address=svi['ip'],
-                            vrf=nb_vrf.id
-                            )
-                        print("done")
-                    else:
-                        print("IP already exists, skipping")
+    if ls_data.get('trunk_interfaces'):
+        stages.append(Stage('trunks', create_trunk_intfs, ('nb', 'ls_data', 'refs'),
+                            ('trunks',), after=('vlans', 'ls_devices'),
+                            sections=('trunk_interfaces',), sharded=True))
 
-def create_statics(nb, ls_data, nb_vrfs):
-    for cf in ['staticroute', 'nexthop', 'bgp_originate']:
-        if cf == 'nexthop':
-            cftype = 'text'
-        else:
-            cftype = 'boolean'
-        
-        try:
-            print(f"Creating custom prefix field {cf}...", end='')
-            nb.extras.custom_fields.create(content_types=['ipam.prefix'], type=cftype, name=cf)
-            print("done")
+    return stages
 
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("already exists") != -1:
-                print("field already exists, skipping")
-                continue
-            else:
-                raise
-    try:
-        print("Creating custom prefix field origindevice...", end='')
-        nb.extras.custom_fields.create(content_types=['ipam.prefix'], 
-            type='object', object_type='dcim.device', name='origindevice')
-        print("done")
-
-    except pynetbox.core.query.RequestError as E:
-        if E.error.find("already exists") != -1:
-            print("field already exists, skipping")
-        else:
-            raise
+def main(argv=None):
+    global BATCH_SIZE, BACKEND, PLAN, JOURNAL, DELTA
+    parser = argparse.ArgumentParser(description='Load leaf/spine topology into Netbox')
+    parser.add_argument('lsdata', help="The leaf/spine data file in YAML format")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help="Maximum number of objects sent in one bulk API request")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="Number of independent load stages run concurrently")
+    parser.add_argument('--backend', choices=['sync', 'async'], default='sync',
+                        help="Send bulk writes one at a time through pynetbox (sync) "
+                             "or pipelined over an aiohttp connection pool (async)")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help="Maximum number of in-flight requests for the async backend "
+                             "(with --adaptive, the starting point)")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Let the async backend raise or lower its in-flight limit from the "
+                             "p95 latency and 5xx rate of its recent replies")
+    parser.add_argument('--min-concurrency', type=int, default=MIN_CONCURRENCY,
+                        help=f"Lowest in-flight limit --adaptive goes down to "
+                             f"(default: {MIN_CONCURRENCY})")
+    parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENCY,
+                        help=f"Highest in-flight limit --adaptive goes up to "
+                             f"(default: {MAX_CONCURRENCY})")
+    parser.add_argument('--target-latency', type=float, metavar='MS',
+                        help="p95 latency above which --adaptive backs off (default: twice "
+                             "the lowest p95 seen)")
+    parser.add_argument('--pool-size', type=int, default=os.environ.get('NB_POOL_SIZE'),
+                        help="HTTP connection pool size (default: --workers; env NB_POOL_SIZE)")
+    parser.add_argument('--retries', type=int, default=os.environ.get('NB_RETRIES', RETRIES),
+                        help="Retries for connection errors and 5xx replies (env NB_RETRIES)")
+    parser.add_argument('--backoff', type=float, default=os.environ.get('NB_BACKOFF', BACKOFF),
+                        help="Base of the jittered exponential retry backoff in seconds "
+                             "(env NB_BACKOFF)")
+    parser.add_argument('--plan', action='store_true',
+                        help="Compare the data with what is already in Netbox, print the "
+                             "objects to create or update and only send those changes")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Print the plan and exit without making any changes")
+    parser.add_argument('--report', metavar='FILE',
+                        help="Write per-stage timings, API call counts, payload sizes and "
+                             "latency percentiles to FILE as JSON")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Compare the data file with the one last loaded successfully and "
+                             "only load what changed; new devices only get their own objects "
+                             "and links")
+    parser.add_argument('--teardown', action='store_true',
+                        help="Delete everything the data file describes, in reverse "
+                             "dependency order (with --dry-run, only count it)")
+    parser.add_argument('--journal', metavar='FILE',
+                        help="Journal of the finished stages and writes "
+                             "(default: the data file name with .journal appended)")
+    parser.add_argument('--cache', metavar='FILE', default=os.environ.get('NB_ID_CACHE'),
+                        help="SQLite file keeping the ids of named objects between runs, "
+                             "kept current through NetBox's change log (default: $NB_ID_CACHE)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Split the per-leaf stages (cabling, transit IPs, BGP sessions, "
+                             "loopbacks, SVIs, trunks) across this many worker processes, "
+                             "each with its own HTTP session")
+    parser.add_argument('--verify', action='store_true',
+                        help="Read the fabric back through NetBox's GraphQL API, report where "
+                             "it differs from the data file and exit non-zero if it does; "
+                             "nothing is written")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted load from its journal, skipping the "
+                             "work it finished")
+    args = parser.parse_args(argv)
+    start = time.monotonic()
+    PLAN = None
+    JOURNAL = None
+    DELTA = None
+    BATCH_SIZE = args.batch_size
+    pool_size = args.pool_size or args.workers
+
+    with open(args.lsdata, 'rb') as ndf:
+        lsdata = ndf.read()
+    ls_data = parse_ls_data(lsdata)
+    exit_if_invalid(parser, args.lsdata, ls_data)
+
+    adaptive = None
+    if args.adaptive:
+        if args.backend != 'async':
+            parser.error("--adaptive requires --backend async")
+        if not 1 <= args.min_concurrency <= args.max_concurrency:
+            parser.error("--min-concurrency must be between 1 and --max-concurrency")
+        adaptive = (args.min_concurrency, args.max_concurrency,
+                    args.target_latency and args.target_latency / 1000)
 
-    for route in ls_data['statics']:
-        nb_origindevice = nb.dcim.devices.get(name=route['origindevice'])
-        print(f"Creating prefix {route['prefix']} as a static route...", end='')
-        static_pfx = nb.ipam.prefixes.get(prefix=route['prefix'])
-        if static_pfx:
-            print("prefix already exists, skipping")
-        else:
-            nb.ipam.prefixes.create(
-                                    prefix=route['prefix'], 
-                                    vrf=nb_vrfs[route['vrf']].id,
-                                    custom_fields={
-                                        'staticroute': True,
-                                        'nexthop': route['nexthop'],
-                                        'bgp_originate': True,
-                                        'origindevice': nb_origindevice.id
-                                    }
-                                   )
-            print("done")
-
-def create_ext_intfs(nb, ls_data, nb_vrfs):
-    for ext_intf in ls_data['ext_interfaces']:
-        nb_device = nb.dcim.devices.get(name=ext_intf['device'])
-        try:
-            print(f"Creating {ext_intf['interface']} on {ext_intf['device']}...", end='')
-            nb_ext_intf = nb.dcim.interfaces.create(
-                name=ext_intf['interface'],
-                device=nb_device.id,
-                vrf=nb_vrfs[ext_intf['vrf']].id,
-                type='virtual')
-            print("done")
-
-        except pynetbox.core.query.RequestError as E:
-            if E.error.find("must make a unique set") != -1:
-                print("interface already exists, skipping")
-                nb_ext_intf = nb.dcim.interfaces.get(
-                    name=ext_intf['interface'], 
-                    device=nb_device.name)
-            else:
-                raise
+    nb = pynetbox.api(NB_URL, NB_API_TOKEN)
+    nb.http_session = build_session(pool_size, args.retries, args.backoff)
+    if args.backend == 'async':
+        if aiohttp is None:
+            parser.error("the async backend requires the aiohttp package")
+        limit = adaptive and ConcurrencyLimit(args.concurrency, *adaptive)
+        BACKEND = AsyncBackend(nb, args.concurrency, pool_size, args.retries, args.backoff,
+                               limit)
+    else:
+        BACKEND = SyncBackend()
 
-        print(f"Creating IP address for {ext_intf['interface']}...", end='')
-        if nb_ext_intf.count_ipaddresses == 0:
-            nb.ipam.ip_addresses.create(
-                assigned_object_id=nb_ext_intf.id,
-                assigned_object_type='dcim.interface',
-                address=ext_intf['ip'],
-                vrf=nb_vrfs[ext_intf['vrf']].id)
-            print("done")
+    if args.verify:
+        METRICS.set_stage('verify')
+        try:
+            drift = verify(nb, ls_data)
+        finally:
+            METRICS.wall('verify', time.monotonic() - start)
+            BACKEND.close()
+            if args.report:
+                write_report(args, start, pool_size)
+        for message in drift:
+            log(message)
+        log(f"Verified in {time.monotonic() - start:.2f}s: "
+            f"{len(drift) or 'no'} difference(s) from {args.lsdata}")
+        if drift:
+            parser.exit(1)
+        return
+
+    journal = Journal(args.journal or f"{args.lsdata}.journal",
+                      hashlib.sha256(lsdata).hexdigest())
+    applied_file = f"{args.lsdata}.applied"
+    METRICS.set_stage('prefetch')
+    refs = RefResolver(nb)
+    if args.resume:
+        if not os.path.exists(journal.path):
+            log(f"No journal {journal.path} to resume from, starting a full load")
+        elif not journal.load():
+            parser.error(f"{journal.path} was written for a different {args.lsdata}")
+        elif journal.finished:
+            log(f"The load journaled in {journal.path} already finished")
+            BACKEND.close()
+            return
+        journal.restore_refs(refs)
+    if args.incremental and not args.teardown:
+        if os.path.exists(applied_file):
+            with open(applied_file, 'rb') as f:
+                DELTA = Delta(parse_ls_data(f), ls_data)
+            DELTA.show()
+            if not DELTA.changed:
+                BACKEND.close()
+                return
         else:
-            print("IP already exists, skipping")
-
-def create_trunk_intfs(nb, ls_data):
-    for trunk_intf in ls_data['trunk_interfaces']:
-        nb_device = nb.dcim.devices.get(name=trunk_intf['device'])
-        nb_intf = nb.dcim.interfaces.get(device=trunk_intf['device'], name=trunk_intf['interface'])
-        print(f"Making interface {trunk_intf['device']} {trunk_intf['interface']} a trunk...", 
-              end='')
-        nb_intf.update(
-            {'mode':'tagged', 
-            'tagged_vlans': [nb.ipam.vlans.get(vid=v) for v in trunk_intf['vlans']]})
-        print("done")
-        
-def main():
-    nb = pynetbox.api(NB_URL, NB_API_TOKEN)
-    parser = argparse.ArgumentParser(description='Load leaf/spine topology into Netbox')
-    parser.add_argument('lsdata', help="The leaf/spine data file in YAML format")
-    args = parser.parse_args()
-    with open(args.lsdata) as ndf:
-        ls_data = yaml.load(ndf, Loader=yaml.Loader)
-
-    create_sites(nb, ls_data)
-    create_roles(nb, ls_data)
-    create_manufacturers(nb, ls_data)
-    create_devicetypes(nb, ls_data)
-    create_intf_templates(nb, ls_data)
-    ls_devices = create_devices(nb, ls_data)
-    create_tags(nb, ls_data)
-    create_connections(nb, ls_devices)
-    transit_prefix = create_transit_prefix(nb, ls_data)
-    loopback_prefix = create_loopback_prefix(nb, ls_data)
-    spine_asn, leaf_asn_mapping =  create_rir_asn(nb, ls_data, ls_devices)
-    create_transit_net_ips_bgp_sessions(nb, transit_prefix, ls_devices, spine_asn, leaf_asn_mapping)
-    create_loopbacks_ips(nb, ls_devices, loopback_prefix)
-    nb_vrfs = create_vrfs(nb, ls_data)
-    create_vlans_vnis(nb, ls_data, nb_vrfs, ls_devices)
+            log(f"No previously loaded {applied_file}, loading everything")
+    cache = None
+    if args.cache:
+        cache = IdCache(args.cache, NB_URL)
+        cache.sync(nb, refs)
+    refs.prefetch(ls_data)
+    METRICS.wall('prefetch', time.monotonic() - start)
 
-    if ls_data.get('statics'):
-        create_statics(nb, ls_data, nb_vrfs)
-    
-    if ls_data.get('ext_interfaces'):
-        create_ext_intfs(nb, ls_data, nb_vrfs)
-    
-    if ls_data.get('trunk_interfaces'):
-        create_trunk_intfs(nb, ls_data)
+    stages = build_stages(ls_data)
+
+    try:
+        if args.teardown:
+            METRICS.set_stage('teardown')
+            teardown_start = time.monotonic()
+            if args.dry_run:
+                log("Teardown would delete:")
+            teardown(nb, ls_data, refs, args.dry_run)
+            METRICS.wall('teardown', time.monotonic() - teardown_start)
+            if not args.dry_run:
+                for path in (journal.path, applied_file):
+                    if os.path.exists(path):
+                        os.remove(path)
+            return
+
+        if args.plan or args.dry_run:
+            METRICS.set_stage('plan')
+            plan_start = time.monotonic()
+            PLAN = plan_changes(nb, ls_data, refs)
+            METRICS.wall('plan', time.monotonic() - plan_start)
+            PLAN.show()
+            if args.dry_run or not PLAN.changes():
+                return
+
+        JOURNAL = journal
+        JOURNAL.open(args.lsdata, args.resume)
+        context = {'nb': nb, 'ls_data': ls_data, 'refs': refs}
+        if args.processes > 1:
+            run_stages([stage for stage in stages if not stage.sharded], context, args.workers)
+            run_shards([stage for stage in stages if stage.sharded], context, args.processes,
+                       {'url': NB_URL, 'token': NB_API_TOKEN, 'batch_size': BATCH_SIZE,
+                        'backend': args.backend, 'concurrency': args.concurrency,
+                        'adaptive': adaptive, 'pool_size': pool_size, 'retries': args.retries,
+                        'backoff': args.backoff, 'workers': args.workers})
+        else:
+            run_stages(stages, context, args.workers)
+        JOURNAL.finish()
+        # The base the next --incremental load is compared against.
+        with open(applied_file, 'wb') as f:
+            f.write(lsdata)
+    finally:
+        BACKEND.close()
+        journal.close()
+        if cache is not None:
+            cache.save(refs)
+            cache.close()
+        if args.report:
+            write_report(args, start, pool_size)
+
+def write_report(args, start, pool_size):
+    report = METRICS.report(time.monotonic() - start, lsdata=args.lsdata,
+                            batch_size=args.batch_size, workers=args.workers,
+                            backend=args.backend, concurrency=args.concurrency,
+                            adaptive=args.adaptive, pool_size=pool_size,
+                            plan=args.plan or args.dry_run, teardown=args.teardown,
+                            incremental=args.incremental, processes=args.processes,
+                            verify=args.verify)
+    if args.adaptive:
+        # The main process's limit; shard processes adapt their own.
+        report['concurrency_limit'] = BACKEND.limit.summary()
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,472 @@
+import os
+import sys
+import time
+import argparse
+import ipaddress
+
+# Loads a leaf/spine data file straight into NetBox's database through its
+# Django models, in the environment manage.py nbshell runs in: NetBox's own
+# venv python with its settings.  Run it as
+#   sudo /opt/netbox/venv/bin/python3 /vagrant/orm_load_ls_data.py <YAMLDATA>
+NETBOX_DIR = os.environ.get('NETBOX_DIR', '/opt/netbox/netbox')
+sys.path.insert(0, NETBOX_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'netbox.settings')
+
+import django
+django.setup()
+
+from django.db import transaction
+from django.core.management import call_command
+from django.contrib.contenttypes.models import ContentType
+from dcim.models import (Site, DeviceRole, Manufacturer, DeviceType, InterfaceTemplate, Device,
+                         Interface, Cable, CableTermination)
+from ipam.models import RIR, ASN, VRF, VLAN, L2VPN, L2VPNTermination, Prefix, IPAddress
+from extras.models import Tag, TaggedItem, CustomField
+from netbox_bgp.models import BGPSession
+import load_ls_data
+from load_ls_data import log, log_skip, device_names, spine_leaf_links, link_label
+
+BATCH_SIZE = 1000
+
+def ensure(model, label, defaults=None, **lookup):
+    # The setup objects (sites, types, tags, VRFs, VLANs, ...) are few and
+    # go through save(), so NetBox's signals and search cache see them as
+    # they would an API write.
+    obj, created = model.objects.get_or_create(defaults=defaults or {}, **lookup)
+    if created:
+        log(f"Creating {label}...done")
+    else:
+        log_skip(f"{label} already exists, skipping")
+    return obj
+
+def ensure_custom_field(name, model, cftype, object_type=None):
+    cf = ensure(CustomField, f"custom field {name}", name=name,
+                defaults={'type': cftype, 'object_type': object_type})
+    cf.content_types.add(ContentType.objects.get_for_model(model))
+
+def bulk_create(model, objects, kind):
+    # The per-device objects are inserted BATCH_SIZE rows per INSERT,
+    # without save() and the post_save signals that maintain cable paths,
+    # prefix depths and the search cache; rebuild() catches those up.
+    if objects:
+        objects = model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+        log(f"Creating {len(objects)} {kind}(s)...done")
+    return objects
+
+def tag_rows(objects, tag, existing=()):
+    content_type = ContentType.objects.get_for_model(Interface)
+    return [TaggedItem(content_type=content_type, object_id=obj.pk, tag=tag)
+            for obj in objects if (obj.pk, tag.pk) not in existing]
+
+class OrmPrefixAllocator(load_ls_data.PrefixAllocator):
+    # The loader's allocator, reading the container's children from the
+    # database instead of the API.
+    def __init__(self, container):
+        self.network = ipaddress.ip_network(str(container.prefix))
+        self.free = [self.network]
+        for child in Prefix.objects.filter(prefix__net_contained=str(container.prefix)):
+            self.reserve(ipaddress.ip_network(str(child.prefix)))
+
+def create_setup(ls_data, objs):
+    objs['sites'] = {site['name']: ensure(Site, f"site {site['name']}", name=site['name'],
+                                          defaults={'slug': site['slug']})
+                     for site in ls_data['sites']}
+    objs['roles'] = {role['name']: ensure(DeviceRole, f"role {role['name']}", name=role['name'],
+                                          defaults={'slug': role['slug']})
+                     for role in ls_data['roles']}
+    manufacturers = {m['name']: ensure(Manufacturer, f"manufacturer {m['name']}", name=m['name'],
+                                       defaults={'slug': m['slug']})
+                     for m in ls_data['manufacturers']}
+    objs['device_types'] = dict()
+    for devicetype in ls_data['device_types']:
+        device_type = ensure(DeviceType, f"device type {devicetype['model']}",
+                             model=devicetype['model'],
+                             manufacturer=manufacturers[devicetype['manufacturer']['name']],
+                             defaults={'slug': devicetype['slug']})
+        objs['device_types'][devicetype['model']] = device_type
+        existing = set(device_type.interfacetemplates.values_list('name', flat=True))
+        bulk_create(InterfaceTemplate,
+                    [InterfaceTemplate(device_type=device_type, type='1000base-t',
+                                       name=f"{devicetype['interface_prefix']}{i}")
+                     for i in range(1, devicetype['interface_qty'] + 1)
+                     if f"{devicetype['interface_prefix']}{i}" not in existing],
+                    'interface template')
+
+    objs['tags'] = {tag['name']: ensure(Tag, f"tag {tag['name']}", name=tag['name'],
+                                        defaults={k: v for k, v in tag.items() if k != 'name'})
+                    for tag in ls_data['tags']}
+    objs['rir'] = ensure(RIR, f"RIR {ls_data['rir']['name']}", name=ls_data['rir']['name'],
+                         defaults={k: v for k, v in ls_data['rir'].items() if k != 'name'})
+
+def create_vrfs_vlans(ls_data, objs):
+    ensure_custom_field('l3vni', VRF, 'integer')
+    objs['vrfs'] = dict()
+    for vrf in ls_data['vrfs']:
+        nb_vrf = ensure(VRF, f"VRF {vrf['name']}", name=vrf['name'],
+                        defaults={'enforce_unique': False})
+        if vrf.get('vni') and nb_vrf.custom_field_data.get('l3vni') != vrf['vni']:
+            nb_vrf.custom_field_data['l3vni'] = vrf['vni']
+            nb_vrf.save()
+        objs['vrfs'][vrf['name']] = nb_vrf
+
+    ensure_custom_field('vnivrf', L2VPN, 'boolean')
+    vlan_type = ContentType.objects.get_for_model(VLAN)
+    objs['vlans'] = dict()
+    for vlan in ls_data['vlans']:
+        # A vid is only unique within a site or group, so match the name too.
+        nb_vlan = ensure(VLAN, f"vlan {vlan['name']}", name=vlan['name'], vid=vlan['vid'])
+        objs['vlans'][vlan['vid']] = nb_vlan
+        if not vlan.get('vni'):
+            continue
+        l2vpn = ensure(L2VPN, f"L2VPN VNI {vlan['vni']}", name=vlan['name'],
+                       defaults={'slug': vlan['name'], 'type': 'vxlan-evpn',
+                                 'identifier': vlan['vni']})
+        ensure(L2VPNTermination,
+               f"L2VPN termination between VNI {vlan['vni']} and VLAN {vlan['vid']}",
+               l2vpn=l2vpn, assigned_object_type=vlan_type, assigned_object_id=nb_vlan.pk)
+        if vlan.get('svi', {}).get('vrf-svi') and not l2vpn.custom_field_data.get('vnivrf'):
+            l2vpn.custom_field_data['vnivrf'] = True
+            l2vpn.save()
+
+def create_devices(ls_data, objs):
+    # Device.save() instantiates the device type's interface templates;
+    # bulk_create() doesn't, so the interfaces of new devices are built from
+    # the templates here and inserted in bulk as well.
+    objs['devices'] = dict()
+    for role, device in ls_data['devices'].items():
+        names = device_names(device)
+        existing = {d.name: d for d in
+                    Device.objects.filter(name__in=names).select_related('site')}
+        for name in existing:
+            log_skip(f"device {name} already exists, skipping")
+        device_type = objs['device_types'][device['device_type']['model']]
+        created = bulk_create(Device,
+                              [Device(name=name, device_type=device_type,
+                                      device_role=objs['roles'][device['device_role']['name']],
+                                      site=objs['sites'][device['site']['name']])
+                               for name in names if name not in existing],
+                              'device')
+        templates = list(device_type.interfacetemplates.all())
+        bulk_create(Interface, [template.instantiate(device=nb_device)
+                                for nb_device in created for template in templates],
+                    'device interface')
+        existing.update((d.name, d) for d in created)
+        objs['devices'][role] = [existing[name] for name in names]
+
+def interface_index(objs):
+    # (device name, interface name) -> Interface for every fabric device,
+    # with the device (and its site) attached for the cable terminations.
+    devices = {d.pk: d for ds in objs['devices'].values() for d in ds}
+    index = dict()
+    for intf in Interface.objects.filter(device__in=list(devices.values())):
+        intf.device = devices[intf.device_id]
+        index[(intf.device.name, intf.name)] = intf
+    return index
+
+def numbered(objs):
+    # Interface id -> its lowest IP address, for the fabric devices.
+    devices = [d for ds in objs['devices'].values() for d in ds]
+    ips = dict()
+    for ip in IPAddress.objects.filter(interface__device__in=devices).order_by('-pk'):
+        ips[ip.assigned_object_id] = ip
+    return ips
+
+def links(ls_data, objs):
+    intf_prefix = {name: devicetype['interface_prefix']
+                   for device in ls_data['devices'].values() for name in device_names(device)
+                   for devicetype in ls_data['device_types']
+                   if devicetype['model'] == device['device_type']['model']}
+    return spine_leaf_links([d.name for d in objs['devices']['spines']],
+                            [d.name for d in objs['devices']['leafs']], intf_prefix.__getitem__)
+
+def create_connections(ls_data, objs, index):
+    # Cable.save() creates the CableTerminations and points the interfaces
+    # at the cable; done in bulk here, the same three writes per link.
+    new_links = list()
+    for link in links(ls_data, objs):
+        spinename, spineintf, leafname, leafintf = link
+        if index[(spinename, spineintf)].cable_id or index[(leafname, leafintf)].cable_id:
+            log_skip(f"connection {link_label(link)} already exists, skipping")
+        else:
+            new_links.append(link)
+
+    cables = bulk_create(Cable, [Cable() for link in new_links], 'connection')
+    terminations = list()
+    cabled = list()
+    for cable, (spinename, spineintf, leafname, leafintf) in zip(cables, new_links):
+        for cable_end, intf in (('A', index[(spinename, spineintf)]),
+                                ('B', index[(leafname, leafintf)])):
+            termination = CableTermination(cable=cable, cable_end=cable_end, termination=intf)
+            termination.cache_related_objects()
+            terminations.append(termination)
+            intf.cable = cable
+            intf.cable_end = cable_end
+            cabled.append(intf)
+    bulk_create(CableTermination, terminations, 'cable termination')
+    Interface.objects.bulk_update(cabled, ['cable', 'cable_end'], batch_size=BATCH_SIZE)
+
+def create_rir_asns(ls_data, objs):
+    leafs = objs['devices']['leafs']
+    leaf_asn = ls_data['asns']['leaf']['range_start']
+    if ls_data['asns']['leaf'].get('sameasn'):
+        leaf_asns = [leaf_asn] * len(leafs)
+        asns = [(leaf_asn, 'Leaf ASN')]
+    else:
+        leaf_asns = [leaf_asn + i for i in range(len(leafs))]
+        asns = [(asn, f'Leaf {leaf.name} ASN') for leaf, asn in zip(leafs, leaf_asns)]
+    asns.insert(0, (ls_data['asns']['spine']['asn'], 'Spine ASN'))
+    asns = list(dict(reversed(asns)).items())[::-1]
+
+    existing = {nb_asn.asn: nb_asn for nb_asn in
+                ASN.objects.filter(asn__in=[asn for asn, description in asns])}
+    for asn in existing:
+        log_skip(f"ASN {asn} already exists, skipping")
+    created = bulk_create(ASN, [ASN(asn=asn, rir=objs['rir'], description=description)
+                                for asn, description in asns if asn not in existing], 'ASN')
+    existing.update((nb_asn.asn, nb_asn) for nb_asn in created)
+    objs['spine_asn'] = existing[ls_data['asns']['spine']['asn']]
+    objs['leaf_asns'] = {leaf.name: existing[asn] for leaf, asn in zip(leafs, leaf_asns)}
+
+def create_containers(ls_data, objs):
+    for kind in ('transit_prefix', 'loopback_prefix'):
+        label = f"{kind.split('_')[0]} prefix {ls_data[kind]['prefix']}"
+        container = Prefix.objects.filter(prefix=ls_data[kind]['prefix']).first()
+        if container:
+            log_skip(f"{label.capitalize()} already exists, skipping")
+        else:
+            container = Prefix(prefix=ls_data[kind]['prefix'], status='container',
+                               site=objs['sites'][ls_data[kind]['site']['name']])
+            container.save()
+            if kind == 'loopback_prefix':
+                reserved = OrmPrefixAllocator(container).allocate(32)
+                Prefix(prefix=str(reserved)).save()
+                IPAddress(address=str(reserved), description='RESERVED').save()
+            log(f"Creating {label}...done")
+        objs[kind] = container
+
+def create_transit_net_ips(ls_data, objs, index, ips):
+    new_links = list()
+    for link in links(ls_data, objs):
+        spinename, spineintf, leafname, leafintf = link
+        if index[(spinename, spineintf)].pk in ips or index[(leafname, leafintf)].pk in ips:
+            log_skip(f"Transit IPs {link_label(link)} already exist, skipping")
+        else:
+            new_links.append(link)
+
+    tnets = list()
+    new_ips = list()
+    if new_links:
+        allocator = OrmPrefixAllocator(objs['transit_prefix'])
+        for (spinename, spineintf, leafname, leafintf), tnet in zip(
+                new_links, allocator.allocate_many(31, len(new_links))):
+            spine_addr, leaf_addr = tnet
+            tnets.append(Prefix(prefix=str(tnet)))
+            new_ips.append(IPAddress(address=f"{spine_addr}/31",
+                                     assigned_object=index[(spinename, spineintf)]))
+            new_ips.append(IPAddress(address=f"{leaf_addr}/31",
+                                     assigned_object=index[(leafname, leafintf)]))
+    bulk_create(Prefix, tnets, 'transit network')
+    for ip in bulk_create(IPAddress, new_ips, 'transit IP address'):
+        ips[ip.assigned_object_id] = ip
+
+    l3base = objs['tags']['l3base']
+    link_intfs = [index[(device, intf)] for spinename, spineintf, leafname, leafintf
+                  in links(ls_data, objs) for device, intf in ((spinename, spineintf),
+                                                                (leafname, leafintf))]
+    tagged = set(TaggedItem.objects.filter(
+        content_type=ContentType.objects.get_for_model(Interface), tag=l3base,
+        object_id__in=[intf.pk for intf in link_intfs]).values_list('object_id', 'tag_id'))
+    bulk_create(TaggedItem, tag_rows(link_intfs, l3base, tagged), 'L3 base interface tag')
+
+def create_bgp_sessions(ls_data, objs, index, ips):
+    devices = {d.name: d for ds in objs['devices'].values() for d in ds}
+    existing = set(BGPSession.objects.filter(device__in=list(devices.values()))
+                   .values_list('device_id', 'name'))
+    sessions = list()
+    for spinename, spineintf, leafname, leafintf in links(ls_data, objs):
+        spine_ip = ips[index[(spinename, spineintf)].pk]
+        leaf_ip = ips[index[(leafname, leafintf)].pk]
+        spine_asn = objs['spine_asn']
+        leaf_asn = objs['leaf_asns'][leafname]
+        for device, name, local_as, remote_as, local_ip, remote_ip in (
+                (devices[spinename], f'{spinename}-->{leafname}', spine_asn, leaf_asn,
+                 spine_ip, leaf_ip),
+                (devices[leafname], f'{leafname}-->{spinename}', leaf_asn, spine_asn,
+                 leaf_ip, spine_ip)):
+            if (device.pk, name) in existing:
+                log_skip(f"BGP session {name} already exists, skipping")
+                continue
+            sessions.append(BGPSession(name=name, site=device.site, device=device,
+                                       local_as=local_as, remote_as=remote_as,
+                                       local_address=local_ip, remote_address=remote_ip))
+    bulk_create(BGPSession, sessions, 'BGP session')
+
+def create_virtual_intfs(index, wanted, kind):
+    # wanted: (device, name, vrf) of the virtual interfaces to have; returns
+    # their Interfaces, creating the missing ones.
+    missing = [Interface(device=device, name=name, type='virtual', vrf=vrf)
+               for device, name, vrf in wanted if (device.name, name) not in index]
+    for device, name, vrf in wanted:
+        if (device.name, name) in index:
+            log_skip(f"{kind} {name} on {device.name} already exists, skipping")
+    for intf in bulk_create(Interface, missing, kind):
+        index[(intf.device.name, intf.name)] = intf
+    return [index[(device.name, name)] for device, name, vrf in wanted]
+
+def create_loopbacks_ips(objs, index, ips):
+    devices = [d for ds in objs['devices'].values() for d in ds]
+    loopbacks = create_virtual_intfs(index, [(d, 'Loopback0', None) for d in devices],
+                                     'loopback interface')
+    unnumbered = list()
+    for device, intf in zip(devices, loopbacks):
+        if intf.pk in ips:
+            log_skip(f"Loopback0 IP address for {device.name} already exists, skipping")
+        else:
+            unnumbered.append(intf)
+
+    loopback_s32s = list()
+    loopback_ips = list()
+    if unnumbered:
+        allocator = OrmPrefixAllocator(objs['loopback_prefix'])
+        for intf, loopback_s32 in zip(unnumbered, allocator.allocate_many(32, len(unnumbered))):
+            loopback_s32s.append(Prefix(prefix=str(loopback_s32)))
+            loopback_ips.append(IPAddress(address=str(loopback_s32), assigned_object=intf))
+    bulk_create(Prefix, loopback_s32s, 'loopback network')
+    bulk_create(IPAddress, loopback_ips, 'loopback IP address')
+
+def create_svis(ls_data, objs, index, ips):
+    svis = [(vlan, leaf) for vlan in ls_data['vlans'] if vlan.get('svi')
+            for leaf in objs['devices']['leafs']]
+    intfs = create_virtual_intfs(index,
+                                 [(leaf, f"Vlan{vlan['vid']}", objs['vrfs'][vlan['svi']['vrf']])
+                                  for vlan, leaf in svis], 'SVI interface')
+
+    interface_type = ContentType.objects.get_for_model(Interface)
+    tagged = set(TaggedItem.objects.filter(
+        content_type=interface_type, object_id__in=[intf.pk for intf in intfs])
+        .values_list('object_id', 'tag_id'))
+    tags = list()
+    new_ips = list()
+    for (vlan, leaf), intf in zip(svis, intfs):
+        svi = vlan['svi']
+        for flag in ('anycast-gateway', 'vrf-svi'):
+            if svi.get(flag):
+                tags.extend(tag_rows([intf], objs['tags'][flag], tagged))
+        if not svi.get('ip'):
+            continue
+        if intf.pk in ips:
+            log_skip(f"IP address on {leaf.name} {intf.name} already exists, skipping")
+        else:
+            new_ips.append(IPAddress(address=svi['ip'], vrf=objs['vrfs'][svi['vrf']],
+                                     assigned_object=intf))
+    bulk_create(TaggedItem, tags, 'SVI interface tag')
+    bulk_create(IPAddress, new_ips, 'SVI IP address')
+
+def create_statics(ls_data, objs):
+    for cf, cftype in (('staticroute', 'boolean'), ('nexthop', 'text'),
+                       ('bgp_originate', 'boolean')):
+        ensure_custom_field(cf, Prefix, cftype)
+    ensure_custom_field('origindevice', Prefix, 'object', ContentType.objects.get_for_model(Device))
+
+    routes = ls_data.get('statics') or []
+    existing = {str(p.prefix) for p in
+                Prefix.objects.filter(prefix__in=[route['prefix'] for route in routes])}
+    for prefix in existing:
+        log_skip(f"prefix {prefix} already exists, skipping")
+    devices = {d.name: d for ds in objs['devices'].values() for d in ds}
+    bulk_create(Prefix,
+                [Prefix(prefix=route['prefix'], vrf=objs['vrfs'][route['vrf']],
+                        custom_field_data={'staticroute': True,
+                                           'nexthop': route['nexthop'],
+                                           'bgp_originate': True,
+                                           'origindevice': devices[route['origindevice']].pk})
+                 for route in routes if route['prefix'] not in existing],
+                'static route prefix')
+
+def create_ext_intfs(ls_data, objs, index, ips):
+    ext_intfs = ls_data.get('ext_interfaces') or []
+    devices = {d.name: d for ds in objs['devices'].values() for d in ds}
+    intfs = create_virtual_intfs(index,
+                                 [(devices[e['device']], e['interface'], objs['vrfs'][e['vrf']])
+                                  for e in ext_intfs], 'external interface')
+    new_ips = list()
+    for ext_intf, intf in zip(ext_intfs, intfs):
+        if intf.pk in ips:
+            log_skip(f"IP address for {ext_intf['interface']} already exists, skipping")
+        else:
+            new_ips.append(IPAddress(address=ext_intf['ip'], vrf=objs['vrfs'][ext_intf['vrf']],
+                                     assigned_object=intf))
+    bulk_create(IPAddress, new_ips, 'external IP address')
+
+def create_trunk_intfs(ls_data, objs, index):
+    trunk_intfs = ls_data.get('trunk_interfaces') or []
+    if not trunk_intfs:
+        return
+
+    intfs = [index[(t['device'], t['interface'])] for t in trunk_intfs]
+    for intf in intfs:
+        intf.mode = 'tagged'
+    Interface.objects.bulk_update(intfs, ['mode'], batch_size=BATCH_SIZE)
+    through = Interface.tagged_vlans.through
+    existing = set(through.objects.filter(interface__in=intfs).values_list('interface_id',
+                                                                           'vlan_id'))
+    bulk_create(through, [through(interface_id=intf.pk, vlan_id=objs['vlans'][vid].pk)
+                          for trunk_intf, intf in zip(trunk_intfs, intfs)
+                          for vid in trunk_intf['vlans']
+                          if (intf.pk, objs['vlans'][vid].pk) not in existing],
+                'trunk interface VLAN')
+    log(f"Updating {len(intfs)} trunk interface(s)...done")
+
+def load(ls_data):
+    objs = dict()
+    create_setup(ls_data, objs)
+    create_vrfs_vlans(ls_data, objs)
+    create_devices(ls_data, objs)
+    create_containers(ls_data, objs)
+    create_rir_asns(ls_data, objs)
+    index = interface_index(objs)
+    ips = numbered(objs)
+    create_connections(ls_data, objs, index)
+    create_transit_net_ips(ls_data, objs, index, ips)
+    create_bgp_sessions(ls_data, objs, index, ips)
+    create_loopbacks_ips(objs, index, ips)
+    create_svis(ls_data, objs, index, ips)
+    create_statics(ls_data, objs)
+    create_ext_intfs(ls_data, objs, index, ips)
+    create_trunk_intfs(ls_data, objs, index)
+
+def rebuild():
+    # What the skipped post_save signals would have kept current.  Search
+    # indexes are rebuilt for the core apps only; the BGP plugin has none.
+    for label, command, args in (('cable paths', 'trace_paths', ()),
+                                 ('prefix hierarchy', 'rebuild_prefixes', ()),
+                                 ('search cache', 'reindex', ('dcim', 'ipam'))):
+        start = time.monotonic()
+        call_command(command, *args, verbosity=0)
+        log(f"Rebuilding {label}...done ({time.monotonic() - start:.2f}s)")
+
+def main(argv=None):
+    global BATCH_SIZE
+    parser = argparse.ArgumentParser(
+        description="Load leaf/spine topology straight into Netbox's database through its "
+                    "Django models (run with NetBox's venv python)")
+    parser.add_argument('lsdata', help="The leaf/spine data file in YAML format")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help="Maximum number of rows inserted by one bulk INSERT")
+    args = parser.parse_args(argv)
+    start = time.monotonic()
+    BATCH_SIZE = args.batch_size
+
+    with open(args.lsdata, 'rb') as ndf:
+        ls_data = load_ls_data.parse_ls_data(ndf)
+    load_ls_data.exit_if_invalid(parser, args.lsdata, ls_data)
+
+    # One transaction: a load that fails leaves nothing behind to resume.
+    with transaction.atomic():
+        load(ls_data)
+    rebuild()
+
+    log(f"Done in {time.monotonic() - start:.2f}s")
+
+if __name__ == '__main__':
+    main()
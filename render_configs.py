@@ -0,0 +1,246 @@
+import os
+import time
+import argparse
+import ipaddress
+import multiprocessing
+import concurrent.futures
+import jinja2
+import pynetbox
+import load_ls_data
+from load_ls_data import log, raw_filter, device_names
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Template per device type manufacturer.
+PLATFORMS = {'Cisco': 'nxos', 'Arista': 'eos'}
+
+def ref_id(value):
+    # Object custom fields hold a nested object in NetBox 3.4 and a plain id
+    # in older releases.
+    return value['id'] if isinstance(value, dict) else value
+
+def name_of(nested, field='name'):
+    return nested and nested[field]
+
+def fetch_fabric(nb, ls_data, refs):
+    # Everything the configs are built from, read once with one filtered
+    # query per kind (per BATCH_SIZE ids) however many devices there are.
+    device_ids = list(refs.ids['devices'].values())
+    fabric = dict()
+    fabric['devices'] = list(raw_filter(nb.dcim.devices, 'id', device_ids))
+    fabric['interfaces'] = list(raw_filter(nb.dcim.interfaces, 'device_id', device_ids))
+    fabric['ip_addresses'] = list(raw_filter(nb.ipam.ip_addresses, 'device_id', device_ids))
+    fabric['cables'] = list(raw_filter(nb.dcim.cables, 'id',
+                                       sorted({intf['cable']['id'] for intf in fabric['interfaces']
+                                               if intf['cable']})))
+    fabric['bgp_sessions'] = list(raw_filter(nb.plugins.bgp.session, 'device_id', device_ids))
+    fabric['asns'] = list(raw_filter(nb.ipam.asns, 'id', refs.ids['asns'].values()))
+    fabric['vrfs'] = list(raw_filter(nb.ipam.vrfs, 'id', refs.ids['vrfs'].values()))
+    fabric['vlans'] = list(raw_filter(nb.ipam.vlans, 'id', refs.ids['vlans'].values()))
+    vni_vlans = [vlan['name'] for vlan in ls_data['vlans'] if vlan.get('vni')]
+    fabric['l2vpns'] = list(raw_filter(nb.ipam.l2vpns, 'name', vni_vlans))
+    fabric['l2vpn_terminations'] = list(raw_filter(nb.ipam.l2vpn_terminations, 'l2vpn_id',
+                                                   [l2vpn['id'] for l2vpn in fabric['l2vpns']]))
+    fabric['statics'] = [prefix for prefix in raw_filter(
+                             nb.ipam.prefixes, 'prefix',
+                             [route['prefix'] for route in ls_data.get('statics') or []])
+                         if (prefix['custom_fields'] or {}).get('staticroute')]
+    for kind, objects in fabric.items():
+        log(f"Fetching {len(objects)} {kind.replace('_', ' ')}...done")
+    return fabric
+
+def build_models(ls_data, fabric):
+    # One plain dict per device with everything its template needs: routed
+    # fabric links (tag l3base), trunks, SVIs (tags anycast-gateway and
+    # vrf-svi), the VLANs and VRFs with their VNIs (custom fields l3vni and
+    # vnivrf), BGP neighbors and the static routes it originates (custom
+    # fields staticroute, nexthop, bgp_originate and origindevice).
+    platforms = {dt['model']: PLATFORMS.get(dt['manufacturer']['name'])
+                 for dt in ls_data['device_types']}
+    roles = {name: device['device_role']['name'] for device in ls_data['devices'].values()
+             for name in device_names(device)}
+    intfs = {intf['id']: intf for intf in fabric['interfaces']}
+    ips = dict()
+    for ip in fabric['ip_addresses']:
+        ips.setdefault(ip['assigned_object_id'], list()).append(ip)
+    ip_addresses = {ip['id']: ip['address'] for ip in fabric['ip_addresses']}
+    asns = {asn['id']: asn['asn'] for asn in fabric['asns']}
+    peers = dict()
+    for cable in fabric['cables']:
+        a_ids = [term['object_id'] for term in cable['a_terminations']]
+        b_ids = [term['object_id'] for term in cable['b_terminations']]
+        for ends, other in ((a_ids, b_ids), (b_ids, a_ids)):
+            for intf_id in ends:
+                peers[intf_id] = [intfs[peer] for peer in other if peer in intfs]
+
+    vnis = dict()
+    l3vnis = dict()
+    l2vpns = {l2vpn['id']: l2vpn for l2vpn in fabric['l2vpns']}
+    for term in fabric['l2vpn_terminations']:
+        l2vpn = l2vpns[term['l2vpn']['id']]
+        vnis[term['assigned_object_id']] = l2vpn['identifier']
+        if (l2vpn['custom_fields'] or {}).get('vnivrf'):
+            l3vnis[term['assigned_object_id']] = True
+    vlans = {vlan['id']: {'vid': vlan['vid'], 'name': vlan['name'], 'vni': vnis.get(vlan['id']),
+                          'l3vni': l3vnis.get(vlan['id'], False)}
+             for vlan in fabric['vlans']}
+    vlans_by_vid = {vlan['vid']: vlan for vlan in vlans.values()}
+    vrfs = {vrf['name']: {'name': vrf['name'],
+                          'l3vni': (vrf['custom_fields'] or {}).get('l3vni')}
+            for vrf in fabric['vrfs']}
+
+    models = dict()
+    for device in fabric['devices']:
+        models[device['id']] = {
+            'name': device['name'],
+            'role': roles.get(device['name']),
+            'platform': platforms.get(device['device_type']['model']),
+            'asn': None, 'router_id': None, 'loopback': None,
+            'interfaces': list(), 'svis': list(), 'neighbors': list(), 'statics': list(),
+            'vlans': dict(), 'vrfs': dict(),
+        }
+
+    for intf in fabric['interfaces']:
+        model = models[intf['device']['id']]
+        tags = [tag['name'] for tag in intf['tags']]
+        vrf = name_of(intf['vrf'])
+        addresses = [ip['address'] for ip in ips.get(intf['id'], [])]
+        if vrf:
+            model['vrfs'][vrf] = vrfs[vrf]
+        if intf['name'] == 'Loopback0':
+            model['loopback'] = addresses[0] if addresses else None
+            model['router_id'] = addresses and str(ipaddress.ip_interface(addresses[0]).ip)
+        elif intf['name'].startswith('Vlan'):
+            vlan = vlans_by_vid[int(intf['name'][4:])]
+            model['vlans'][vlan['vid']] = vlan
+            model['svis'].append({'name': intf['name'], 'vid': vlan['vid'], 'vrf': vrf,
+                                  'address': addresses[0] if addresses else None,
+                                  'anycast': 'anycast-gateway' in tags,
+                                  'vrf_svi': 'vrf-svi' in tags})
+        elif 'l3base' in tags or addresses or (intf['mode'] and intf['mode']['value']):
+            mode = intf['mode'] and intf['mode']['value']
+            trunk_vlans = [vlans[vlan['id']]['vid'] for vlan in intf['tagged_vlans'] or []]
+            for vid in trunk_vlans:
+                model['vlans'][vid] = vlans_by_vid[vid]
+            peer = peers.get(intf['id'])
+            encapsulation = intf['name'].partition('.')[2]
+            model['interfaces'].append({
+                'name': intf['name'],
+                'routed': 'l3base' in tags or bool(addresses),
+                'address': addresses[0] if addresses else None,
+                'vrf': vrf,
+                'encapsulation': encapsulation or None,
+                'mode': mode,
+                'trunk_vlans': trunk_vlans,
+                'description': peer and f"to {peer[0]['device']['name']} {peer[0]['name']}",
+            })
+
+    for session in fabric['bgp_sessions']:
+        model = models[session['device']['id']]
+        model['asn'] = asns.get(session['local_as']['id'])
+        model['neighbors'].append({
+            'address': str(ipaddress.ip_interface(
+                ip_addresses.get(session['remote_address']['id'],
+                                 session['remote_address'].get('address'))).ip),
+            'remote_as': asns.get(session['remote_as']['id']),
+            'description': session['name'].split('-->')[-1],
+        })
+
+    for prefix in fabric['statics']:
+        cf = prefix['custom_fields']
+        model = models.get(ref_id(cf.get('origindevice')))
+        if model is None:
+            continue
+        vrf = name_of(prefix['vrf'])
+        if vrf:
+            model['vrfs'][vrf] = vrfs[vrf]
+        model['statics'].append({'prefix': prefix['prefix'], 'nexthop': cf.get('nexthop'),
+                                 'vrf': vrf, 'originate': bool(cf.get('bgp_originate'))})
+
+    for model in models.values():
+        model['vlans'] = sorted(model['vlans'].values(), key=lambda vlan: vlan['vid'])
+        model['vrfs'] = sorted(model['vrfs'].values(), key=lambda vrf: vrf['name'])
+    return sorted(models.values(), key=lambda model: model['name'])
+
+ENVIRONMENT = None
+
+def init_renderer(template_dir):
+    # Each render process compiles a template once, on first use; jinja2
+    # keeps the compiled templates cached in the environment after that.
+    global ENVIRONMENT
+    ENVIRONMENT = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                                     undefined=jinja2.StrictUndefined, trim_blocks=True,
+                                     lstrip_blocks=True, keep_trailing_newline=True)
+
+def render_device(model):
+    template = ENVIRONMENT.get_template(f"{model['platform']}.j2")
+    return model['name'], template.render(device=model)
+
+def render_all(models, output_dir, processes, template_dir):
+    # Configs are written as they come back from the render processes, and
+    # only if they changed, so an unchanged fabric leaves the files alone.
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {'written': 0, 'unchanged': 0}
+    if processes > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_renderer, initargs=(template_dir,))
+        results = executor.map(render_device, models,
+                               chunksize=max(1, len(models) // (processes * 4)))
+    else:
+        executor = None
+        init_renderer(template_dir)
+        results = map(render_device, models)
+
+    try:
+        for name, config in results:
+            path = os.path.join(output_dir, f"{name}.cfg")
+            if os.path.exists(path):
+                with open(path) as f:
+                    if f.read() == config:
+                        counts['unchanged'] += 1
+                        continue
+            with open(path, 'w') as f:
+                f.write(config)
+            counts['written'] += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    log(f"Rendering {len(models)} device config(s) to {output_dir}...done "
+        f"({counts['written']} written, {counts['unchanged']} unchanged)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render NX-OS and EOS configs for every device of a loaded leaf/spine fabric')
+    parser.add_argument('lsdata', help="The leaf/spine data file the fabric was loaded from")
+    parser.add_argument('-o', '--output-dir', default='configs',
+                        help="Directory to write the <device>.cfg files to (default: configs)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="Number of processes rendering configs (default: one per CPU)")
+    parser.add_argument('--template-dir', default=TEMPLATE_DIR,
+                        help="Directory with the nxos.j2 and eos.j2 templates")
+    parser.add_argument('--batch-size', type=int, default=load_ls_data.BATCH_SIZE,
+                        help="Maximum number of ids in one filtered API read")
+    args = parser.parse_args(argv)
+    start = time.monotonic()
+
+    with open(args.lsdata, 'rb') as ndf:
+        ls_data = load_ls_data.parse_ls_data(ndf)
+    load_ls_data.exit_if_invalid(parser, args.lsdata, ls_data)
+    for dt in ls_data['device_types']:
+        if dt['manufacturer']['name'] not in PLATFORMS:
+            parser.error(f"no template for {dt['manufacturer']['name']} devices "
+                         f"(known: {', '.join(PLATFORMS)})")
+
+    load_ls_data.BATCH_SIZE = args.batch_size
+    nb = pynetbox.api(load_ls_data.NB_URL, load_ls_data.NB_API_TOKEN)
+    nb.http_session = load_ls_data.build_session(1)
+    refs = load_ls_data.RefResolver(nb)
+    refs.prefetch(ls_data)
+    models = build_models(ls_data, fetch_fabric(nb, ls_data, refs))
+    render_all(models, args.output_dir, args.processes, args.template_dir)
+
+    log(f"Done in {time.monotonic() - start:.2f}s")
+
+if __name__ == '__main__':
+    main()
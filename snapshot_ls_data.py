@@ -0,0 +1,217 @@
+import gzip
+import json
+import time
+import argparse
+import pynetbox
+import load_ls_data
+from load_ls_data import log, chunked, bulk_filter
+
+# Object kinds in a snapshot, in the order restore creates them, with the
+# fields copied as they are and the fields referring to other snapshot
+# objects (kind None: the kind is given by the object's *_type field).
+KINDS = [
+    ('sites', 'dcim.sites', ('name', 'slug', 'status'), {}),
+    ('roles', 'dcim.device_roles', ('name', 'slug', 'color'), {}),
+    ('manufacturers', 'dcim.manufacturers', ('name', 'slug'), {}),
+    ('device_types', 'dcim.device_types', ('model', 'slug'), {'manufacturer': 'manufacturers'}),
+    ('interface_templates', 'dcim.interface_templates', ('name', 'type'),
+     {'device_type': 'device_types'}),
+    ('tags', 'extras.tags', ('name', 'slug', 'color'), {}),
+    ('custom_fields', 'extras.custom_fields', ('name', 'type', 'content_types', 'object_type'), {}),
+    ('rirs', 'ipam.rirs', ('name', 'slug'), {}),
+    ('asns', 'ipam.asns', ('asn', 'description'), {'rir': 'rirs'}),
+    ('vrfs', 'ipam.vrfs', ('name', 'enforce_unique', 'custom_fields'), {}),
+    ('vlans', 'ipam.vlans', ('name', 'vid', 'status'), {}),
+    ('l2vpns', 'ipam.l2vpns', ('name', 'slug', 'type', 'identifier', 'custom_fields'), {}),
+    ('l2vpn_terminations', 'ipam.l2vpn_terminations', ('assigned_object_type',),
+     {'l2vpn': 'l2vpns', 'assigned_object_id': None}),
+    ('devices', 'dcim.devices', ('name', 'status'),
+     {'device_role': 'roles', 'device_type': 'device_types', 'site': 'sites'}),
+    ('interfaces', 'dcim.interfaces', ('name', 'type', 'mode'),
+     {'device': 'devices', 'vrf': 'vrfs', 'tags': 'tags', 'tagged_vlans': 'vlans'}),
+    ('cables', 'dcim.cables', (), {'a_terminations': None, 'b_terminations': None}),
+    ('prefixes', 'ipam.prefixes', ('prefix', 'status', 'description', 'custom_fields'),
+     {'site': 'sites', 'vrf': 'vrfs'}),
+    ('ip_addresses', 'ipam.ip_addresses', ('address', 'description', 'assigned_object_type'),
+     {'vrf': 'vrfs', 'assigned_object_id': None}),
+    ('bgp_sessions', 'plugins.bgp.session', ('name', 'status'),
+     {'site': 'sites', 'device': 'devices', 'local_as': 'asns', 'remote_as': 'asns',
+      'local_address': 'ip_addresses', 'remote_address': 'ip_addresses'}),
+]
+
+# Singular labels for the log, as load_ls_data's bulk_create callers use.
+LABELS = {
+    'sites': 'site', 'roles': 'role', 'manufacturers': 'manufacturer',
+    'device_types': 'device type', 'interface_templates': 'interface template', 'tags': 'tag',
+    'custom_fields': 'custom field', 'rirs': 'RIR', 'asns': 'ASN', 'vrfs': 'VRF',
+    'vlans': 'VLAN', 'l2vpns': 'L2VPN', 'l2vpn_terminations': 'L2VPN termination',
+    'devices': 'device', 'interfaces': 'interface', 'cables': 'cable', 'prefixes': 'prefix',
+    'ip_addresses': 'IP address', 'bgp_sessions': 'BGP session',
+}
+
+OBJECT_KINDS = {'dcim.interface': 'interfaces', 'ipam.vlan': 'vlans', 'dcim.device': 'devices'}
+
+def endpoint(nb, path):
+    for name in path.split('.'):
+        nb = getattr(nb, name)
+    return nb
+
+def plain(value):
+    # Reduce API values to what a write takes: choices to their value and
+    # nested objects to their id.
+    if isinstance(value, list):
+        return [plain(v) for v in value]
+    if isinstance(value, dict):
+        if 'value' in value and 'label' in value:
+            return value['value']
+        if 'id' in value:
+            return value['id']
+        return {k: plain(v) for k, v in value.items() if k != 'object' and v is not None}
+    return value
+
+def export_snapshot(nb, ls_data, refs):
+    objects = load_ls_data.fabric_objects(nb, ls_data, refs)
+    device_types = {device.id: device.device_type.id for device in objects['devices']}
+    templates = {(template.device_type.id, template.name)
+                 for template in objects['interface_templates']}
+    snapshot = dict()
+    for kind, path, fields, references in KINDS:
+        rows = list()
+        for record in objects[kind]:
+            values = dict(record)
+            row = {'id': record.id}
+            for field in fields + tuple(references):
+                value = plain(values.get(field))
+                if value not in (None, [], {}):
+                    row[field] = value
+            if kind == 'interfaces' and (device_types[row['device']], row['name']) in templates:
+                row['template'] = True
+            rows.append(row)
+        snapshot[kind] = rows
+        log(f"Exporting {len(rows)} {kind.replace('_', ' ')}...done")
+
+    return snapshot
+
+def payload(row, fields, references, ids, cf_kinds):
+    # The write payload of a snapshot row, with every reference translated
+    # to the id its object got in this restore.
+    data = {field: row[field] for field in fields if field in row}
+    for field, kind in references.items():
+        if field not in row:
+            continue
+        value = row[field]
+        if field.endswith('_terminations'):
+            data[field] = [{'object_type': term['object_type'],
+                            'object_id': ids[OBJECT_KINDS[term['object_type']]][term['object_id']]}
+                           for term in value]
+        elif kind is None:
+            data[field] = ids[OBJECT_KINDS[row[field.replace('_id', '_type')]]][value]
+        elif isinstance(value, list):
+            data[field] = [ids[kind][v] for v in value]
+        else:
+            data[field] = ids[kind][value]
+    if 'custom_fields' in data:
+        data['custom_fields'] = {name: ids[cf_kinds[name]][value] if cf_kinds.get(name) else value
+                                 for name, value in data['custom_fields'].items()}
+    return data
+
+def send(nb_endpoint, verb, payloads, kind):
+    batches = list(chunked(payloads, load_ls_data.BATCH_SIZE))
+    records = list()
+    for batch, (created, E) in zip(batches,
+                                   load_ls_data.BACKEND.send(nb_endpoint, verb, batches)):
+        if E is not None:
+            raise E
+        records.extend(created)
+    log(f"{'Creating' if verb == 'post' else 'Updating'} {len(payloads)} {kind}(s)...done")
+    return records
+
+def restore_snapshot(nb, snapshot):
+    # Interfaces instantiated from device type templates already exist once
+    # the devices do; they are read back in one filtered query per batch of
+    # devices and only patched with what the load changed on them.
+    ids = {kind: dict() for kind, path, fields, references in KINDS}
+    cf_kinds = {cf['name']: OBJECT_KINDS.get(cf.get('object_type'))
+                for cf in snapshot['custom_fields']}
+    for kind, path, fields, references in KINDS:
+        rows = snapshot[kind]
+        nb_endpoint = endpoint(nb, path)
+        label = LABELS[kind]
+        if kind == 'interfaces':
+            instantiated = {(intf.device.id, intf.name): intf.id for intf in
+                            bulk_filter(nb_endpoint, 'device_id', ids['devices'].values())}
+            updates = list()
+            new_rows = list()
+            for row in rows:
+                key = (ids['devices'][row['device']], row['name'])
+                if row.get('template') and key in instantiated:
+                    ids[kind][row['id']] = instantiated[key]
+                    changes = payload(row, ('mode',), {f: k for f, k in references.items()
+                                                       if f != 'device'}, ids, cf_kinds)
+                    if changes:
+                        updates.append(dict(changes, id=instantiated[key]))
+                else:
+                    new_rows.append(row)
+            if updates:
+                send(nb_endpoint, 'patch', updates, 'template interface')
+            rows = new_rows
+
+        if rows:
+            created = send(nb_endpoint, 'post',
+                           [payload(row, fields, references, ids, cf_kinds) for row in rows],
+                           label)
+            for row, record in zip(rows, created):
+                ids[kind][row['id']] = record.id
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export the Netbox objects of a loaded leaf/spine fabric to a snapshot file, '
+                    'or restore them from one')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="Write a snapshot of a loaded fabric")
+    export_parser.add_argument('lsdata', help="The leaf/spine data file the fabric was loaded from")
+    export_parser.add_argument('snapshot', help="Snapshot file to write (gzipped JSON)")
+    restore_parser = subparsers.add_parser(
+        'restore', help="Recreate a fabric from a snapshot in a Netbox that doesn't have it")
+    restore_parser.add_argument('snapshot', help="Snapshot file written by export")
+    for subparser in (export_parser, restore_parser):
+        subparser.add_argument('--batch-size', type=int, default=load_ls_data.BATCH_SIZE,
+                               help="Maximum number of objects sent in one bulk API request")
+        subparser.add_argument('--backend', choices=['sync', 'async'], default='sync',
+                               help="Send bulk writes through pynetbox (sync) or pipelined "
+                                    "over an aiohttp connection pool (async)")
+        subparser.add_argument('--concurrency', type=int, default=load_ls_data.CONCURRENCY,
+                               help="Maximum number of in-flight requests for the async backend")
+    args = parser.parse_args(argv)
+    start = time.monotonic()
+    if args.command == 'export':
+        with open(args.lsdata, 'rb') as ndf:
+            ls_data = load_ls_data.parse_ls_data(ndf)
+        load_ls_data.exit_if_invalid(parser, args.lsdata, ls_data)
+
+    load_ls_data.BATCH_SIZE = args.batch_size
+    nb = pynetbox.api(load_ls_data.NB_URL, load_ls_data.NB_API_TOKEN)
+    nb.http_session = load_ls_data.build_session(args.concurrency)
+    if args.backend == 'async':
+        if load_ls_data.aiohttp is None:
+            parser.error("the async backend requires the aiohttp package")
+        load_ls_data.BACKEND = load_ls_data.AsyncBackend(nb, args.concurrency, args.concurrency)
+
+    try:
+        if args.command == 'export':
+            refs = load_ls_data.RefResolver(nb)
+            refs.prefetch(ls_data)
+            snapshot = export_snapshot(nb, ls_data, refs)
+            with gzip.open(args.snapshot, 'wt') as f:
+                json.dump({'lsdata': args.lsdata, 'objects': snapshot}, f, separators=(',', ':'))
+        else:
+            with gzip.open(args.snapshot, 'rt') as f:
+                snapshot = json.load(f)
+            restore_snapshot(nb, snapshot['objects'])
+    finally:
+        load_ls_data.BACKEND.close()
+
+    log(f"Done in {time.monotonic() - start:.2f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import os
+import copy
+import json
+import shutil
+from collections import Counter
+import pytest
+import requests
+import load_ls_data
+import bench_ls_data
+from fake_netbox import FakeNetBox
+
+LS_DATA_FILE = os.path.join(os.path.dirname(__file__), 'ls_data_n9kv.yaml')
+
+with open(LS_DATA_FILE, 'rb') as ndf:
+    LS_DATA = load_ls_data.parse_ls_data(ndf)
+
+def fabric(spines, leafs, loopback_prefix):
+    ls_data = copy.deepcopy(LS_DATA)
+    ls_data['devices']['spines']['qty'] = spines
+    ls_data['devices']['leafs']['qty'] = leafs
+    ls_data['loopback_prefix']['prefix'] = loopback_prefix
+    # Keep the data file's extras pointing at devices that still exist.
+    for section in ('statics', 'ext_interfaces', 'trunk_interfaces'):
+        ls_data[section] = list()
+    return ls_data
+
+def loopback_errors(ls_data):
+    return [error for error in load_ls_data.check_ls_data(ls_data)
+            if error.startswith('loopback_prefix')]
+
+def test_loopback_prefix_needs_room_for_the_reserved_address():
+    # 2 spines and 2 leafs need 4 loopbacks plus the reserved first /32.
+    assert loopback_errors(fabric(2, 2, '10.255.0.0/30')) == [
+        "loopback_prefix.prefix: 10.255.0.0/30 has room for 4 /32(s), "
+        "the fabric needs 5 (one reserved)"]
+    assert loopback_errors(fabric(2, 1, '10.255.0.0/30')) == []
+
+def test_malformed_devices_are_reported_not_raised():
+    ls_data = copy.deepcopy(LS_DATA)
+    ls_data['devices']['borders'] = {'prefix': 'border', 'qty': 1}
+    ls_data['devices']['firewalls'] = 2
+    ls_data['devices']['leafs']['qty'] = 'two'
+    assert load_ls_data.check_ls_data(ls_data) == [
+        "devices.leafs.qty: expected int, got 'two'",
+        "devices.borders: missing device_role",
+        "devices.borders: missing device_type",
+        "devices.borders: missing site",
+        "devices.firewalls: expected a mapping"]
+
+def test_other_roles_need_no_port_per_spine():
+    ls_data = copy.deepcopy(LS_DATA)
+    ls_data['devices']['spines']['qty'] = 30
+    ls_data['devices']['borders'] = dict(ls_data['devices']['leafs'], prefix='border', qty=1)
+    assert [error for error in load_ls_data.check_ls_data(ls_data)
+            if error.startswith('devices')] == [
+        "devices.leafs: n9kv-switch has 24 interface(s), leafs need 30"]
+
+@pytest.fixture
+def lsdata(tmp_path):
+    # The loader journals next to the data file.
+    path = str(tmp_path / 'ls_data.yaml')
+    shutil.copy(LS_DATA_FILE, path)
+    return path
+
+def load(fake, lsdata, *args, http=False):
+    load_ls_data.PLAN = None
+    load_ls_data.METRICS = load_ls_data.Metrics()
+    load_ls_data.REQUEST_IDS.clear()
+    with bench_ls_data.fake_netbox(fake, http):
+        load_ls_data.main(list(args) + [lsdata])
+
+def counts(fake):
+    return {table: len(rows) for table, rows in fake.tables.items()
+            if table != 'extras/object-changes'}
+
+def test_cache_drops_ids_of_objects_deleted_during_a_run(lsdata, tmp_path, capsys, monkeypatch):
+    fake = FakeNetBox()
+    cache = str(tmp_path / 'ids.sqlite')
+    load(fake, lsdata, '--cache', cache)
+    load(fake, lsdata, '--cache', cache)
+    # The loads' own updates don't invalidate anything.
+    assert "18 cached id(s)" in capsys.readouterr().out
+
+    vrf_id, vrf = next(iter(fake.tables['ipam/vrfs'].items()))
+    save = load_ls_data.IdCache.save
+
+    def save_after_delete(self, refs):
+        fake.session().delete(f"http://fake-netbox/api/ipam/vrfs/{vrf_id}/")
+        save(self, refs)
+
+    monkeypatch.setattr(load_ls_data.IdCache, 'save', save_after_delete)
+    load(fake, lsdata, '--cache', cache)
+    monkeypatch.setattr(load_ls_data.IdCache, 'save', save)
+    assert vrf_id not in fake.tables['ipam/vrfs']
+
+    capsys.readouterr()
+    load(fake, lsdata, '--cache', cache)
+    assert "1 invalidated" in capsys.readouterr().out
+    assert [other['name'] for other in fake.tables['ipam/vrfs'].values()] == [vrf['name']]
+
+class FlakyNetBox(FakeNetBox):
+    # Drops the connection of the first POST that creates `address`, after
+    # the batches sent before it in the same call were saved.
+    def __init__(self, address):
+        super().__init__()
+        self.address = address
+
+    def send(self, request, **kwargs):
+        if request.method == 'POST' and self.address is not None and \
+                f'"address": "{self.address}"'.encode() in (request.body or b''):
+            self.address = None
+            raise requests.exceptions.ConnectionError("connection dropped")
+        return super().send(request, **kwargs)
+
+@pytest.mark.parametrize('backend', ['sync', 'async'])
+def test_resume_does_not_duplicate_objects(lsdata, tmp_path, backend):
+    # The second of the two batches of loopback addresses fails.
+    args = ['--batch-size', '2', '--backend', backend]
+    http = backend == 'async'
+    clean = FakeNetBox()
+    clean_lsdata = shutil.copy(lsdata, tmp_path / 'clean.yaml')
+    load(clean, str(clean_lsdata), *args, http=http)
+
+    fake = FlakyNetBox('192.168.255.3/32')
+    with pytest.raises(Exception):
+        load(fake, lsdata, *args, http=http)
+    # The batch NetBox saved before the failure is journaled, so the
+    # resumed load doesn't send it again.
+    journaled = dict()
+    with open(f"{lsdata}.journal") as f:
+        for entry in map(json.loads, f):
+            if entry.get('op') == 'create' and entry['kind'] == 'loopback IP address':
+                journaled.update(entry['items'])
+    saved = {ip['address']: ip['id'] for ip in fake.tables['ipam/ip-addresses'].values()}
+    assert journaled == {address: saved[address]
+                         for address in ('192.168.255.1/32', '192.168.255.2/32')}
+
+    load(fake, lsdata, *args, '--resume', http=http)
+    assert counts(fake) == counts(clean)
+    # Anycast gateways share an address, but never on the same interface.
+    addresses = Counter((ip['address'], ip.get('assigned_object_id'))
+                        for ip in fake.tables['ipam/ip-addresses'].values())
+    assert max(addresses.values()) == 1